@@ -1 +1 @@
-from .__main__ import VERSION
+VERSION = "4.2.0-dev"
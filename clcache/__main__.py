@@ -6,48 +6,44 @@
 # full text of which is available in the accompanying LICENSE file at the
 # root directory of this project.
 #
-from collections import defaultdict, namedtuple
-from ctypes import windll, wintypes
-from shutil import copyfile, copyfileobj, rmtree, which
+from shutil import rmtree, which
 import argparse
 import cProfile
-import codecs
 import concurrent.futures
 import contextlib
 import errno
-import gzip
-import hashlib
-import json
+import itertools
 import multiprocessing
 import os
-import pickle
 import re
+import sqlite3
 import subprocess
 import sys
 import threading
+import time
 from tempfile import TemporaryFile
 from typing import Any, List, Tuple, Iterator
-from atomicwrites import atomic_write
 
-VERSION = "4.2.0-dev"
+# This module is also run as a script (see monkey.py), so it uses absolute imports
+from clcache import VERSION
+from clcache.utils import (childDirectories, collapseBasedirToPlaceholder, DEFAULT_EVICTION_POLICY,
+                           ensureDirectoryExists, EVICTION_POLICIES, IncludeNotFoundException, LogicException,
+                           OUTPUT_LOCK, printTraceStatement)
+from clcache.compression import CompressionPolicy
+from clcache.cmdline import (CalledForLinkError, CalledForPreprocessingError, CalledWithPchError, CommandLineAnalyzer,
+                             expandCommandLine, extendCommandLineFromEnvironment, ExternalDebugInfoError,
+                             InvalidArgumentError, MultipleSourceFilesComplexError, NoSourceFileError)
+from clcache.hashing import (createHasher, FileHashCache, getCompilerHash, getFileHashes, getStringHash,
+                             hashAlgorithmName, updateHasherFromFile)
+from clcache.locks import CacheDummyLock, CacheLock, CacheLockException, SharedCacheLock
+from clcache.statistics import Configuration, NUM_REPORTED_SLOWEST_LOCKS, Statistics
+from clcache.index import CacheIndex
+from clcache.entries import CompilerArtifacts, readCacheEntry, writeCacheEntry
+from clcache.restore import copyOrLink, ObjectFileRestorer
+from clcache.blobs import BlobStore
+from clcache.manifest import IncludeHashes, Manifest, ManifestEntry, ManifestRepository
+from clcache.packs import PackedCompilerArtifactsRepository
 
-HashAlgorithm = hashlib.md5
-
-OUTPUT_LOCK = threading.Lock()
-
-# try to use os.scandir or scandir.scandir
-# fall back to os.listdir if not found
-# same for scandir.walk
-try:
-    import scandir # pylint: disable=wrong-import-position
-    WALK = scandir.walk
-    LIST = scandir.scandir
-except ImportError:
-    WALK = os.walk
-    try:
-        LIST = os.scandir # type: ignore # pylint: disable=no-name-in-module
-    except AttributeError:
-        LIST = os.listdir
 
 # The codec that is used by clcache to store compiler STDOUR and STDERR in
 # output.txt and stderr.txt.
@@ -58,26 +54,22 @@ CACHE_COMPILER_OUTPUT_STORAGE_CODEC = 'utf-8'
 # The cl default codec
 CL_DEFAULT_CODEC = 'mbcs'
 
-# Manifest file will have at most this number of hash lists in it. Need to avoi
-# manifests grow too large.
-MAX_MANIFEST_HASHES = 100
+# Console output without any of these bytes is the same in both codecs above
+NON_ASCII_BYTES_REGEX = re.compile(b'[\x80-\xff]')
 
-# String, by which BASE_DIR will be replaced in paths, stored in manifests.
-# ? is invalid character for file name, so it seems ok
-# to use it as mark for relative path.
-BASEDIR_REPLACEMENT = '?'
+# Cleaning the cache frees at least this fraction of its maximum size, to avoid
+# cleaning up too often. Manifests may use MANIFESTS_SIZE_RATIO of the rest.
+CLEAN_LOW_WATERMARK = 0.9
+MANIFESTS_SIZE_RATIO = 0.1
+# Entries are evicted in batches of this many, locking only the sections
+# modified by a batch
+EVICTION_BATCH_SIZE = 100
+# Seconds after starting a process evicting entries before another one is started
+MIN_EVICTION_INTERVAL = 60
 
-# Define some Win32 API constants here to avoid dependency on win32pipe
-NMPWAIT_WAIT_FOREVER = wintypes.DWORD(0xFFFFFFFF)
-ERROR_PIPE_BUSY = 231
+DETACHED_PROCESS = 0x00000008
+CREATE_NEW_PROCESS_GROUP = 0x00000200
 
-# ManifestEntry: an entry in a manifest file
-# `includeFiles`: list of paths to include files, which this source file uses
-# `includesContentsHash`: hash of the contents of the includeFiles
-# `objectHash`: hash of the object in cache
-ManifestEntry = namedtuple('ManifestEntry', ['includeFiles', 'includesContentHash', 'objectHash'])
-
-CompilerArtifacts = namedtuple('CompilerArtifacts', ['objectFilePath', 'stdout', 'stderr'])
 
 def printBinary(stream, rawData):
     with OUTPUT_LOCK:
@@ -85,57 +77,30 @@ def printBinary(stream, rawData):
         stream.flush()
 
 
-def basenameWithoutExtension(path):
-    basename = os.path.basename(path)
-    return os.path.splitext(basename)[0]
-
-
-def filesBeneath(baseDir):
-    for path, _, filenames in WALK(baseDir):
-        for filename in filenames:
-            yield os.path.join(path, filename)
-
-
-def childDirectories(path, absolute=True):
-    supportsScandir = (LIST != os.listdir) # pylint: disable=comparison-with-callable
-    for entry in LIST(path):
-        if supportsScandir:
-            if entry.is_dir():
-                yield entry.path if absolute else entry.name
-        else:
-            absPath = os.path.join(path, entry)
-            if os.path.isdir(absPath):
-                yield absPath if absolute else entry
-
-
-def normalizeBaseDir(baseDir):
-    if baseDir:
-        baseDir = os.path.normcase(baseDir)
-        if baseDir.endswith(os.path.sep):
-            baseDir = baseDir[0:-1]
-        return baseDir
-    else:
-        # Converts empty string to None
-        return None
-
-
 def getCachedCompilerConsoleOutput(path):
     try:
         with open(path, 'rb') as f:
-            return f.read().decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
+            return f.read()
     except IOError:
-        return ''
+        return b''
+
 
 def setCachedCompilerConsoleOutput(path, output):
     with open(path, 'wb') as f:
-        f.write(output.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC))
+        f.write(output)
+
 
-class IncludeNotFoundException(Exception):
-    pass
+def storedConsoleOutput(output):
+    """Encodes console output of the compiler for storing it in the cache"""
+    return output.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
 
 
-class CacheLockException(Exception):
-    pass
+def clConsoleOutput(storedOutput):
+    """Converts console output stored in the cache to the bytes cl would
+    have printed, without decoding it in the common case of ASCII output"""
+    if NON_ASCII_BYTES_REGEX.search(storedOutput) is None:
+        return storedOutput
+    return storedOutput.decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC).encode(CL_DEFAULT_CODEC)
 
 
 class CompilerFailedException(Exception):
@@ -146,241 +111,161 @@ class CompilerFailedException(Exception):
         self.msgErr = msgErr
 
     def getReturnTuple(self):
-        return self.exitCode, self.msgErr, self.msgOut, False
-
-
-class LogicException(Exception):
-    def __init__(self, message):
-        super(LogicException, self).__init__(message)
-        self.message = message
-
-    def __str__(self):
-        return repr(self.message)
-
-
-class Manifest:
-    def __init__(self, entries=None):
-        if entries is None:
-            entries = []
-        self._entries = entries.copy()
-
-    def entries(self):
-        return self._entries
-
-    def addEntry(self, entry):
-        """Adds entry at the top of the entries"""
-        self._entries.insert(0, entry)
-
-    def touchEntry(self, objectHash):
-        """Moves entry in entryIndex position to the top of entries()"""
-        entryIndex = next((i for i, e in enumerate(self.entries()) if e.objectHash == objectHash), 0)
-        self._entries.insert(0, self._entries.pop(entryIndex))
-
-
-class ManifestSection:
-    def __init__(self, manifestSectionDir):
-        self.manifestSectionDir = manifestSectionDir
-        self.lock = CacheLock.forPath(self.manifestSectionDir)
-
-    def manifestPath(self, manifestHash):
-        return os.path.join(self.manifestSectionDir, manifestHash + ".json")
-
-    def manifestFiles(self):
-        return filesBeneath(self.manifestSectionDir)
-
-    def setManifest(self, manifestHash, manifest):
-        manifestPath = self.manifestPath(manifestHash)
-        printTraceStatement("Writing manifest with manifestHash = {} to {}".format(manifestHash, manifestPath))
-        ensureDirectoryExists(self.manifestSectionDir)
-        with atomic_write(manifestPath, overwrite=True) as outFile:
-            # Converting namedtuple to JSON via OrderedDict preserves key names and keys order
-            entries = [e._asdict() for e in manifest.entries()]
-            jsonobject = {'entries': entries}
-            json.dump(jsonobject, outFile, sort_keys=True, indent=2)
-
-    def getManifest(self, manifestHash):
-        fileName = self.manifestPath(manifestHash)
-        if not os.path.exists(fileName):
-            return None
-        try:
-            with open(fileName, 'r') as inFile:
-                doc = json.load(inFile)
-                return Manifest([ManifestEntry(e['includeFiles'], e['includesContentHash'], e['objectHash'])
-                                 for e in doc['entries']])
-        except IOError:
-            return None
-        except ValueError:
-            printErrStr("clcache: manifest file %s was broken" % fileName)
-            return None
-
-
-@contextlib.contextmanager
-def allSectionsLocked(repository):
-    sections = list(repository.sections())
-    for section in sections:
-        section.lock.acquire()
-    try:
-        yield
-    finally:
-        for section in sections:
-            section.lock.release()
-
-
-class ManifestRepository:
-    # Bump this counter whenever the current manifest file format changes.
-    # E.g. changing the file format from {'oldkey': ...} to {'newkey': ...} requires
-    # invalidation, such that a manifest that was stored using the old format is not
-    # interpreted using the new format. Instead the old file will not be touched
-    # again due to a new manifest hash and is cleaned away after some time.
-    MANIFEST_FILE_FORMAT_VERSION = 6
-
-    def __init__(self, manifestsRootDir):
-        self._manifestsRootDir = manifestsRootDir
-
-    def section(self, manifestHash):
-        return ManifestSection(os.path.join(self._manifestsRootDir, manifestHash[:2]))
-
-    def sections(self):
-        return (ManifestSection(path) for path in childDirectories(self._manifestsRootDir))
-
-    def clean(self, maxManifestsSize):
-        manifestFileInfos = []
-        for section in self.sections():
-            for filePath in section.manifestFiles():
-                try:
-                    manifestFileInfos.append((os.stat(filePath), filePath))
-                except OSError:
-                    pass
-
-        manifestFileInfos.sort(key=lambda t: t[0].st_atime, reverse=True)
-
-        remainingObjectsSize = 0
-        for stat, filepath in manifestFileInfos:
-            if remainingObjectsSize + stat.st_size <= maxManifestsSize:
-                remainingObjectsSize += stat.st_size
-            else:
-                os.remove(filepath)
-        return remainingObjectsSize
-
-    @staticmethod
-    def getManifestHash(compilerBinary, commandLine, sourceFile):
-        compilerHash = getCompilerHash(compilerBinary)
-
-        # NOTE: We intentionally do not normalize command line to include
-        # preprocessor options.  In direct mode we do not perform preprocessing
-        # before cache lookup, so all parameters are important.  One of the few
-        # exceptions to this rule is the /MP switch, which only defines how many
-        # compiler processes are running simultaneusly.  Arguments that specify
-        # the compiler where to find the source files are parsed to replace
-        # ocurrences of CLCACHE_BASEDIR by a placeholder.
-        arguments, inputFiles = CommandLineAnalyzer.parseArgumentsAndInputFiles(commandLine)
-        collapseBasedirInCmdPath = lambda path: collapseBasedirToPlaceholder(os.path.normcase(os.path.abspath(path)))
-
-        commandLine = []
-        argumentsWithPaths = ("AI", "I", "FU")
-        for k in sorted(arguments.keys()):
-            if k in argumentsWithPaths:
-                commandLine.extend(["/" + k + collapseBasedirInCmdPath(arg) for arg in arguments[k]])
-            else:
-                commandLine.extend(["/" + k + arg for arg in arguments[k]])
-
-        commandLine.extend(collapseBasedirInCmdPath(arg) for arg in inputFiles)
-
-        additionalData = "{}|{}|{}".format(
-            compilerHash, commandLine, ManifestRepository.MANIFEST_FILE_FORMAT_VERSION)
-        return getFileHash(sourceFile, additionalData)
-
-    @staticmethod
-    def getIncludesContentHashForFiles(includes):
-        try:
-            listOfHashes = getFileHashes(includes)
-        except FileNotFoundError:
-            raise IncludeNotFoundException
-        return ManifestRepository.getIncludesContentHashForHashes(listOfHashes)
-
-    @staticmethod
-    def getIncludesContentHashForHashes(listOfHashes):
-        return HashAlgorithm(','.join(listOfHashes).encode()).hexdigest()
-
-
-class CacheLock:
-    """ Implements a lock for the object cache which
-    can be used in 'with' statements. """
-    INFINITE = 0xFFFFFFFF
-    WAIT_ABANDONED_CODE = 0x00000080
-    WAIT_TIMEOUT_CODE = 0x00000102
-
-    def __init__(self, mutexName, timeoutMs):
-        self._mutexName = 'Local\\' + mutexName
-        self._mutex = None
-        self._timeoutMs = timeoutMs
-
-    def createMutex(self):
-        self._mutex = windll.kernel32.CreateMutexW(
-            None,
-            wintypes.BOOL(False),
-            self._mutexName)
-        assert self._mutex
-
-    def __enter__(self):
-        self.acquire()
-
-    def __exit__(self, typ, value, traceback):
-        self.release()
-
-    def __del__(self):
-        if self._mutex:
-            windll.kernel32.CloseHandle(self._mutex)
-
-    def acquire(self):
-        if not self._mutex:
-            self.createMutex()
-        result = windll.kernel32.WaitForSingleObject(
-            self._mutex, wintypes.INT(self._timeoutMs))
-        if result not in [0, self.WAIT_ABANDONED_CODE]:
-            if result == self.WAIT_TIMEOUT_CODE:
-                errorString = \
-                    'Failed to acquire lock {} after {}ms; ' \
-                    'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
-                        self._mutexName, self._timeoutMs)
-            else:
-                errorString = 'Error! WaitForSingleObject returns {result}, last error {error}'.format(
-                    result=result,
-                    error=windll.kernel32.GetLastError())
-            raise CacheLockException(errorString)
-
-    def release(self):
-        windll.kernel32.ReleaseMutex(self._mutex)
-
-    @staticmethod
-    def forPath(path):
-        timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
-        lockName = path.replace(':', '-').replace('\\', '-')
-        return CacheLock(lockName, timeoutMs)
+        return self.exitCode, self.msgErr.encode(CL_DEFAULT_CODEC), self.msgOut.encode(CL_DEFAULT_CODEC), False
 
 
 class CompilerArtifactsSection:
+    """ Stores every cache entry of a section as a single file <key>.entry
+    (see writeCacheEntry()). If a BlobStore is given, the object file is
+    stored in a blob instead, and <key>.object is a hard link to it. If hard
+    links are used for restoring object files, an entry is a directory <key>
+    holding the object file and console output as separate files instead.
+
+    Reading an entry takes no lock. Entries are published by renaming them
+    into place and removed by removing the entry file first, or by renaming
+    the entry directory to a tombstone before deleting it, so a reader sees an
+    entry either complete or not at all. """
+    ENTRY_FILE_SUFFIX = '.entry'
+    OBJECT_FILE_SUFFIX = '.object'
+    TOMBSTONE_SUFFIX = '.dead'
     OBJECT_FILE = 'object'
     STDOUT_FILE = 'output.txt'
     STDERR_FILE = 'stderr.txt'
 
-    def __init__(self, compilerArtifactsSectionDir):
+    def __init__(self, compilerArtifactsSectionDir, compressionPolicy=None, blobStore=None, index=None):
         self.compilerArtifactsSectionDir = compilerArtifactsSectionDir
+        self.compressionPolicy = compressionPolicy or CompressionPolicy()
+        self.blobStore = blobStore
+        self.index = index
         self.lock = CacheLock.forPath(self.compilerArtifactsSectionDir)
 
+    def cacheEntryFile(self, key):
+        return os.path.join(self.compilerArtifactsSectionDir, key + CompilerArtifactsSection.ENTRY_FILE_SUFFIX)
+
+    def cacheEntryObjectFile(self, key):
+        return os.path.join(self.compilerArtifactsSectionDir, key + CompilerArtifactsSection.OBJECT_FILE_SUFFIX)
+
     def cacheEntryDir(self, key):
         return os.path.join(self.compilerArtifactsSectionDir, key)
 
     def cacheEntries(self):
-        return childDirectories(self.compilerArtifactsSectionDir, absolute=False)
+        entries = []
+        for name in os.listdir(self.compilerArtifactsSectionDir):
+            if name.endswith(CompilerArtifactsSection.ENTRY_FILE_SUFFIX):
+                entries.append(name[:-len(CompilerArtifactsSection.ENTRY_FILE_SUFFIX)])
+            elif not name.endswith(CompilerArtifactsSection.TOMBSTONE_SUFFIX) and \
+                 os.path.isdir(os.path.join(self.compilerArtifactsSectionDir, name)):
+                entries.append(name)
+        return entries
+
+    def tombstones(self):
+        return [os.path.join(self.compilerArtifactsSectionDir, name)
+                for name in os.listdir(self.compilerArtifactsSectionDir)
+                if name.endswith(CompilerArtifactsSection.TOMBSTONE_SUFFIX)]
+
+    def orphanedObjectFiles(self):
+        """Returns the keys of <key>.object files left behind without entry"""
+        keys = []
+        for name in os.listdir(self.compilerArtifactsSectionDir):
+            if name.endswith(CompilerArtifactsSection.OBJECT_FILE_SUFFIX):
+                key = name[:-len(CompilerArtifactsSection.OBJECT_FILE_SUFFIX)]
+                if not os.path.exists(self.cacheEntryFile(key)):
+                    keys.append(key)
+        return keys
 
     def cachedObjectName(self, key):
         return os.path.join(self.cacheEntryDir(key), CompilerArtifactsSection.OBJECT_FILE)
 
+    def entryStat(self, key):
+        try:
+            return os.stat(self.cacheEntryFile(key))
+        except FileNotFoundError:
+            return os.stat(self.cachedObjectName(key))
+
     def hasEntry(self, key):
-        return os.path.exists(self.cacheEntryDir(key))
+        return os.path.exists(self.cacheEntryFile(key)) or os.path.exists(self.cacheEntryDir(key))
+
+    def removeEntry(self, key):
+        """Removes the files of the entry for key. Returns False if the entry
+        is in use by a reader and was left alone, which only happens on
+        Windows."""
+        # Readers which opened the entry file already fail to open the object
+        # file and treat the entry as missing
+        try:
+            os.remove(self.cacheEntryFile(key))
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            return False
+        try:
+            os.remove(self.cacheEntryObjectFile(key))
+        except (FileNotFoundError, PermissionError):
+            # An object file left behind is removed by the next full clean()
+            pass
+
+        cacheEntryDir = self.cacheEntryDir(key)
+        tombstone = '{}.{}.{}{}'.format(cacheEntryDir, os.getpid(), threading.get_ident(),
+                                        CompilerArtifactsSection.TOMBSTONE_SUFFIX)
+        try:
+            os.replace(cacheEntryDir, tombstone)
+        except FileNotFoundError:
+            return True
+        except PermissionError:
+            return False
+        rmtree(tombstone, ignore_errors=True)
+        return True
 
     def setEntry(self, key, artifacts):
+        if "CLCACHE_HARDLINK" in os.environ:
+            size = self._setEntryDirectory(key, artifacts)
+            if self.index is not None:
+                self.index.addEntry(CacheIndex.OBJECT, key, size, cost=artifacts.compileTime)
+            return size
+
+        ensureDirectoryExists(self.compilerArtifactsSectionDir)
+        separateObject, blobDigest, addedBlobSize = None, None, 0
+        if "CLCACHE_DEDUP" in os.environ and self.blobStore is not None and self.blobStore.linksSupported and \
+           artifacts.objectFilePath is not None:
+            separateObject, blobDigest, addedBlobSize = self._linkBlob(key, artifacts.objectFilePath)
+
+        cacheEntryFile = self.cacheEntryFile(key)
+        tempEntryFile = cacheEntryFile + '.new'
+        with open(tempEntryFile, 'wb') as outFile:
+            size = writeCacheEntry(outFile, key, artifacts, self.compressionPolicy, separateObject)
+        os.replace(tempEntryFile, cacheEntryFile)
+
+        if self.index is not None:
+            if addedBlobSize:
+                self.index.addEntry(CacheIndex.BLOB, blobDigest, addedBlobSize)
+            self.index.addEntry(CacheIndex.OBJECT, key, size, blobDigest, artifacts.compileTime)
+        return size + addedBlobSize
+
+    def _linkBlob(self, key, objectFilePath):
+        """Links <key>.object to the blob holding the object file. Returns the
+        CompilerArtifacts locating the object file in it, the hash of the blob
+        and the number of bytes added to the cache, or None if linking
+        failed."""
+        digest, blob, created = self.blobStore.addBlob(objectFilePath, self.compressionPolicy)
+        objectFile = self.cacheEntryObjectFile(key)
+        tempObjectFile = objectFile + '.new'
+        try:
+            os.remove(tempObjectFile)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(self.blobStore.blobPath(digest), tempObjectFile)
+        except OSError as e:
+            # The blob may have been removed by a concurrent clean() already
+            if e.errno != errno.ENOENT:
+                self.blobStore.linksSupported = False
+            return None, None, 0
+        os.replace(tempObjectFile, objectFile)
+
+        blobSize = blob.objectOffset + blob.objectSize
+        self.blobStore.registerObject(blobSize, created)
+        return blob, digest, blobSize if created else 0
+
+    def _setEntryDirectory(self, key, artifacts):
         cacheEntryDir = self.cacheEntryDir(key)
         # Write new files to a temporary directory
         tempEntryDir = cacheEntryDir + '.new'
@@ -393,7 +278,7 @@ class CompilerArtifactsSection:
             size = os.path.getsize(dstFilePath)
         setCachedCompilerConsoleOutput(os.path.join(tempEntryDir, CompilerArtifactsSection.STDOUT_FILE),
                                        artifacts.stdout)
-        if artifacts.stderr != '':
+        if artifacts.stderr:
             setCachedCompilerConsoleOutput(os.path.join(tempEntryDir, CompilerArtifactsSection.STDERR_FILE),
                                            artifacts.stderr)
         # Replace the full cache entry atomically
@@ -401,79 +286,225 @@ class CompilerArtifactsSection:
         return size
 
     def getEntry(self, key):
-        assert self.hasEntry(key)
+        """Returns the CompilerArtifacts of the entry for key. Raises
+        FileNotFoundError if there is no such entry, e.g. because it was
+        evicted concurrently; so does restoring the object file of an entry
+        evicted after this returned."""
+        cacheEntryFile = self.cacheEntryFile(key)
+        try:
+            inFile = open(cacheEntryFile, 'rb')
+        except FileNotFoundError:
+            return self._getEntryDirectory(key)
+        with inFile:
+            artifacts = readCacheEntry(inFile, cacheEntryFile, key)
+        if artifacts.objectFilePath is None:
+            artifacts = artifacts._replace(objectFilePath=self.cacheEntryObjectFile(key))
+        self._registerHit(key)
+        return artifacts
+
+    def _getEntryDirectory(self, key):
         cacheEntryDir = self.cacheEntryDir(key)
-        return CompilerArtifacts(
+        # Unlike stderr, stdout is always written, so its absence means there
+        # is no entry (anymore)
+        with open(os.path.join(cacheEntryDir, CompilerArtifactsSection.STDOUT_FILE), 'rb') as f:
+            stdout = f.read()
+        artifacts = CompilerArtifacts(
             os.path.join(cacheEntryDir, CompilerArtifactsSection.OBJECT_FILE),
-            getCachedCompilerConsoleOutput(os.path.join(cacheEntryDir, CompilerArtifactsSection.STDOUT_FILE)),
+            stdout,
             getCachedCompilerConsoleOutput(os.path.join(cacheEntryDir, CompilerArtifactsSection.STDERR_FILE))
             )
+        self._registerHit(key)
+        return artifacts
+
+    def _registerHit(self, key):
+        if self.index is not None:
+            self.index.recordHit(CacheIndex.OBJECT, key)
 
 
 class CompilerArtifactsRepository:
-    def __init__(self, compilerArtifactsRootDir):
+    def __init__(self, compilerArtifactsRootDir, compressionPolicy=None, blobStore=None, index=None):
         self._compilerArtifactsRootDir = compilerArtifactsRootDir
+        self.compressionPolicy = compressionPolicy or CompressionPolicy()
+        self.blobStore = blobStore
+        self.index = index
 
     def section(self, key):
-        return CompilerArtifactsSection(os.path.join(self._compilerArtifactsRootDir, key[:2]))
+        return CompilerArtifactsSection(os.path.join(self._compilerArtifactsRootDir, key[:2]),
+                                        self.compressionPolicy, self.blobStore, self.index)
 
     def sections(self):
-        return (CompilerArtifactsSection(path) for path in childDirectories(self._compilerArtifactsRootDir))
+        return (CompilerArtifactsSection(path, self.compressionPolicy, self.blobStore, self.index)
+                for path in childDirectories(self._compilerArtifactsRootDir))
 
     def removeEntry(self, keyToBeRemoved):
-        compilerArtifactsDir = self.section(keyToBeRemoved).cacheEntryDir(keyToBeRemoved)
-        rmtree(compilerArtifactsDir, ignore_errors=True)
-
-    def clean(self, maxCompilerArtifactsSize):
+        if self.section(keyToBeRemoved).removeEntry(keyToBeRemoved) and self.index is not None:
+            self.index.removeEntries(CacheIndex.OBJECT, [keyToBeRemoved])
+
+    def indexEntries(self):
+        """Yields the entries of the cache index for all blobs and cache
+        entries, as expected by CacheIndex.rebuild()"""
+        blobDigests = {}
+        if self.blobStore is not None:
+            for digest, stat in self.blobStore.blobs():
+                blobDigests[(stat.st_dev, stat.st_ino)] = digest
+                yield CacheIndex.BLOB, digest, stat.st_size, stat.st_atime, None
+        for section in self.sections():
+            for cachekey in section.cacheEntries():
+                try:
+                    stat = section.entryStat(cachekey)
+                except OSError:
+                    continue
+                try:
+                    blobStat = os.stat(section.cacheEntryObjectFile(cachekey))
+                    blobDigest = blobDigests.get((blobStat.st_dev, blobStat.st_ino))
+                except FileNotFoundError:
+                    blobDigest = None
+                yield CacheIndex.OBJECT, cachekey, stat.st_size, stat.st_atime, blobDigest
+
+    def _indexedEntryInfos(self, evictionPolicy):
+        self.index.applyHits()
+        blobReferences = self.index.blobReferences()
+        blobs = {digest: [blobReferences.get(digest, 0), size]
+                 for digest, size, _ in self.index.entries(CacheIndex.BLOB)}
+        return self.index.entries(CacheIndex.OBJECT, evictionPolicy=evictionPolicy), blobs
+
+    def _scannedEntryInfos(self):
         objectInfos = []
+        # Number of entries referencing each blob and its size, by file ID
+        blobs = {}
         for section in self.sections():
+            for cachekey in section.orphanedObjectFiles():
+                self.removeEntry(cachekey)
+            for tombstone in section.tombstones():
+                rmtree(tombstone, ignore_errors=True)
             for cachekey in section.cacheEntries():
                 try:
-                    objectStat = os.stat(section.cachedObjectName(cachekey))
-                    objectInfos.append((objectStat, cachekey))
+                    objectStat = section.entryStat(cachekey)
                 except OSError:
+                    continue
+                blobId = None
+                try:
+                    blobStat = os.stat(section.cacheEntryObjectFile(cachekey))
+                    blobId = (blobStat.st_dev, blobStat.st_ino)
+                    blobs.setdefault(blobId, [0, blobStat.st_size])[0] += 1
+                except FileNotFoundError:
                     pass
+                objectInfos.append((objectStat, blobId, cachekey))
 
         objectInfos.sort(key=lambda t: t[0].st_atime)
+        return [(cachekey, stat.st_size, blobId) for stat, blobId, cachekey in objectInfos], blobs
+
+    def clean(self, maxCompilerArtifactsSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        """Removes entries in the order of the eviction policy until they fit
+        into maxCompilerArtifactsSize, locking the section of one entry at a
+        time. Without a complete index, entries are removed least recently
+        used first."""
+        indexed = self.index is not None and self.index.isComplete()
+        if indexed:
+            objectInfos, blobs = self._indexedEntryInfos(evictionPolicy)
+        else:
+            objectInfos, blobs = self._scannedEntryInfos()
 
-        # compute real current size to fix up the stored cacheSize
-        currentSizeObjects = sum(x[0].st_size for x in objectInfos)
+        # Blobs no entry refers to anymore are removed right away
+        unusedBlobs = [blobId for blobId, (references, _) in blobs.items() if references == 0]
+        for blobId in unusedBlobs:
+            del blobs[blobId]
 
-        removedItems = 0
-        for stat, cachekey in objectInfos:
-            self.removeEntry(cachekey)
-            removedItems += 1
-            currentSizeObjects -= stat.st_size
+        # compute real current size to fix up the stored cacheSize
+        currentSizeObjects = sum(size for _, size, _ in objectInfos) + sum(size for _, size in blobs.values())
+
+        removedKeys = []
+        for cachekey, size, blobId in objectInfos:
+            section = self.section(cachekey)
+            with section.lock:
+                if not section.removeEntry(cachekey):
+                    continue
+            removedKeys.append(cachekey)
+            currentSizeObjects -= size
+            if blobId in blobs:
+                blobs[blobId][0] -= 1
+                if blobs[blobId][0] == 0:
+                    currentSizeObjects -= blobs[blobId][1]
+                    unusedBlobs.append(blobId)
             if currentSizeObjects < maxCompilerArtifactsSize:
                 break
 
-        return len(objectInfos)-removedItems, currentSizeObjects
+        if self.index is not None:
+            self.index.removeEntries(CacheIndex.OBJECT, removedKeys)
+        if self.blobStore is not None:
+            if indexed:
+                self.index.removeEntries(CacheIndex.BLOB,
+                                         [digest for digest in unusedBlobs if self.blobStore.removeBlob(digest)])
+            else:
+                self.blobStore.clean()
+
+        return len(objectInfos) - len(removedKeys), currentSizeObjects
+
+    def evict(self, maxCompilerArtifactsSize, batchSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        """Removes up to batchSize of the entries recorded in the index, in the
+        order of the eviction policy, while they exceed maxCompilerArtifactsSize,
+        locking only the sections of those entries. Returns the number of
+        removed entries."""
+        self.index.applyHits()
+        currentSize = self.index.totalSize(CacheIndex.OBJECT, CacheIndex.BLOB)
+        blobReferences = self.index.blobReferences()
+        removedKeys = []
+        unusedBlobs = []
+        for cachekey, size, blob in self.index.entries(CacheIndex.OBJECT, limit=batchSize,
+                                                       evictionPolicy=evictionPolicy):
+            if currentSize < maxCompilerArtifactsSize:
+                break
+            removedKeys.append(cachekey)
+            currentSize -= size
+            if blob in blobReferences:
+                blobReferences[blob] -= 1
+                if blobReferences[blob] == 0:
+                    unusedBlobs.append(blob)
+                    currentSize -= self.index.entrySize(CacheIndex.BLOB, blob)
+
+        # Readers take no lock; this only keeps writers of the same entries out
+        keptKeys = set()
+        for _, sectionKeys in itertools.groupby(sorted(removedKeys), key=lambda cachekey: cachekey[:2]):
+            sectionKeys = list(sectionKeys)
+            section = self.section(sectionKeys[0])
+            with section.lock:
+                keptKeys.update(cachekey for cachekey in sectionKeys if not section.removeEntry(cachekey))
+        removedKeys = [cachekey for cachekey in removedKeys if cachekey not in keptKeys]
+        self.index.removeEntries(CacheIndex.OBJECT, removedKeys)
+
+        if self.blobStore is not None:
+            self.index.removeEntries(CacheIndex.BLOB,
+                                     [digest for digest in unusedBlobs if self.blobStore.removeBlob(digest)])
+        return len(removedKeys)
 
     @staticmethod
     def computeKeyDirect(manifestHash, includesContentHash):
         # We must take into account manifestHash to avoid
         # collisions when different source files use the same
         # set of includes.
-        return getStringHash(manifestHash + includesContentHash)
+        return getStringHash(hashAlgorithmName() + manifestHash + includesContentHash)
 
     @staticmethod
     def computeKeyNodirect(compilerBinary, commandLine, environment):
         ppcmd = ["/EP"] + [arg for arg in commandLine if arg not in ("-c", "/c")]
 
-        returnCode, preprocessedSourceCode, ppStderrBinary = \
-            invokeRealCompiler(compilerBinary, ppcmd, captureOutput=True, outputAsString=False, environment=environment)
-
-        if returnCode != 0:
-            errMsg = ppStderrBinary.decode(CL_DEFAULT_CODEC) + "\nclcache: preprocessor failed"
-            raise CompilerFailedException(returnCode, errMsg)
-
         compilerHash = getCompilerHash(compilerBinary)
         normalizedCmdLine = CompilerArtifactsRepository._normalizedCommandLine(commandLine)
 
-        h = HashAlgorithm()
+        h = createHasher()
+        h.update(hashAlgorithmName().encode("UTF-8"))
         h.update(compilerHash.encode("UTF-8"))
         h.update(' '.join(normalizedCmdLine).encode("UTF-8"))
-        h.update(preprocessedSourceCode)
+
+        # The preprocessed source code is hashed while reading it back from
+        # disk, it can be much larger than we'd like to keep in memory.
+        returnCode, _, ppStderrBinary = invokeRealCompiler(
+            compilerBinary, ppcmd, captureOutput=True, outputAsString=False, environment=environment, stdoutHasher=h)
+
+        if returnCode != 0:
+            errMsg = ppStderrBinary.decode(CL_DEFAULT_CODEC) + "\nclcache: preprocessor failed"
+            raise CompilerFailedException(returnCode, errMsg)
+
         return h.hexdigest()
 
     @staticmethod
@@ -498,7 +529,9 @@ class CompilerArtifactsRepository:
         return [arg for arg in cmdline
                 if not (arg[0] in "/-" and arg[1:].startswith(argsToStrip))]
 
-class CacheFileStrategy:
+
+# Holds the repositories and all other parts of a cache directory
+class CacheFileStrategy: # pylint: disable=too-many-instance-attributes
     def __init__(self, cacheDirectory=None):
         self.dir = cacheDirectory
         if not self.dir:
@@ -507,32 +540,46 @@ class CacheFileStrategy:
             except KeyError:
                 self.dir = os.path.join(os.path.expanduser("~"), "clcache")
 
+        self.index = CacheIndex(os.path.join(self.dir, "index.sqlite"))
+        # Held by the process evicting entries; others don't wait for it
+        self.evictionLock = CacheLock.forPath(os.path.join(self.dir, "eviction"), 0)
+        # Touched whenever a process evicting entries is started
+        self.evictionMarker = os.path.join(self.dir, "eviction.started")
+        # Held shared while storing cache entries, and exclusively while
+        # replacing the index by a walk of the whole cache
+        self.maintenanceLock = SharedCacheLock.forPath(os.path.join(self.dir, "maintenance"))
+
         manifestsRootDir = os.path.join(self.dir, "manifests")
         ensureDirectoryExists(manifestsRootDir)
-        self.manifestRepository = ManifestRepository(manifestsRootDir)
+        self.manifestRepository = ManifestRepository(manifestsRootDir, self.index)
 
+        self.compressionPolicy = CompressionPolicy()
+        self.blobStore = BlobStore(os.path.join(self.dir, "blobs"))
         compilerArtifactsRootDir = os.path.join(self.dir, "objects")
         ensureDirectoryExists(compilerArtifactsRootDir)
-        self.compilerArtifactsRepository = CompilerArtifactsRepository(compilerArtifactsRootDir)
+        self.compilerArtifactsRepository = CompilerArtifactsRepository(compilerArtifactsRootDir,
+                                                                       self.compressionPolicy, self.blobStore,
+                                                                       self.index)
 
+        self.fileHashCache = FileHashCache(os.path.join(self.dir, "hashes"))
+        self.objectFileRestorer = ObjectFileRestorer(os.path.join(self.dir, "unsupportedrestoremethods.txt"))
         self.configuration = Configuration(os.path.join(self.dir, "config.txt"))
         self.statistics = Statistics(os.path.join(self.dir, "stats.txt"))
 
     def __str__(self):
         return "Disk cache at {}".format(self.dir)
 
-    @property # type: ignore
-    @contextlib.contextmanager
-    def lock(self):
-        with allSectionsLocked(self.manifestRepository), \
-             allSectionsLocked(self.compilerArtifactsRepository), \
-             self.statistics.lock:
-            yield
-
     def lockFor(self, key):
         assert isinstance(self.compilerArtifactsRepository.section(key).lock, CacheLock)
         return self.compilerArtifactsRepository.section(key).lock
 
+    @staticmethod
+    def readLockFor(_):
+        # Entries are published and removed atomically (see
+        # CompilerArtifactsSection and PackedCompilerArtifactsSection), and
+        # hits are only logged, so reading them needs no lock
+        return CacheDummyLock()
+
     def manifestLockFor(self, key):
         return self.manifestRepository.section(key).lock
 
@@ -561,31 +608,158 @@ class CacheFileStrategy:
     def setManifest(self, manifestHash, manifest):
         self.manifestRepository.section(manifestHash).setManifest(manifestHash, manifest)
 
+    def touchManifest(self, manifestHash, manifest, objectHash, statFingerprint=None):
+        self.manifestRepository.section(manifestHash).touchManifest(manifestHash, manifest, objectHash,
+                                                                    statFingerprint)
+
     def getManifest(self, manifestHash):
         return self.manifestRepository.section(manifestHash).getManifest(manifestHash)
 
-    def clean(self, stats, maximumSize):
-        currentSize = stats.currentCacheSize()
+    def migrateLegacyManifest(self, legacyManifestHash, manifestHash, hashForInclude):
+        return self.manifestRepository.migrateLegacyManifest(legacyManifestHash, manifestHash, hashForInclude)
+
+    @staticmethod
+    def _sizeLimits(maximumSize):
+        """Returns the sizes manifests and compiler artifacts are reduced to
+        when cleaning a cache of the given maximum size"""
+        effectiveMaximumSizeOverall = maximumSize * CLEAN_LOW_WATERMARK
+        effectiveMaximumSizeManifests = effectiveMaximumSizeOverall * MANIFESTS_SIZE_RATIO
+        return effectiveMaximumSizeManifests, effectiveMaximumSizeOverall - effectiveMaximumSizeManifests
+
+    def clean(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        """Removes entries until the cache fits into maximumSize. Takes no
+        cache-wide lock: the repositories lock one section at a time, and the
+        statistics are locked only to read and to update the cache size."""
+        with self.statistics.lock, self.statistics as stats:
+            currentSize = stats.currentCacheSize()
         if currentSize < maximumSize:
             return
 
-        # Free at least 10% to avoid cleaning up too often which
-        # is a big performance hit with large caches.
-        effectiveMaximumSizeOverall = maximumSize * 0.9
+        effectiveMaximumSizeManifests, effectiveMaximumSizeObjects = self._sizeLimits(maximumSize)
 
-        # Split limit in manifests (10 %) and objects (90 %)
-        effectiveMaximumSizeManifests = effectiveMaximumSizeOverall * 0.1
-        effectiveMaximumSizeObjects = effectiveMaximumSizeOverall - effectiveMaximumSizeManifests
+        # Without a complete index, the cache directory is walked once to
+        # rebuild it; all later cleanups are queries on the index.
+        if not self.index.isComplete():
+            self.rebuildIndex()
 
         # Clean manifests
         currentSizeManifests = self.manifestRepository.clean(effectiveMaximumSizeManifests)
 
         # Clean artifacts
         currentCompilerArtifactsCount, currentCompilerArtifactsSize = self.compilerArtifactsRepository.clean(
-            effectiveMaximumSizeObjects)
+            effectiveMaximumSizeObjects, evictionPolicy)
+
+        with self.statistics.lock, self.statistics as stats:
+            stats.setCacheSize(currentCompilerArtifactsSize + currentSizeManifests)
+            stats.setNumCacheEntries(currentCompilerArtifactsCount)
+            CacheLock.flushStatistics(stats)
+
+        # Don't let the hash cache accumulate records of headers which are long gone
+        self.fileHashCache.trim()
+
+    def rebuildIndex(self):
+        # Compilations carry on while the cache is walked; the entries they
+        # store meanwhile are recorded in the index already and kept. Only
+        # replacing the index waits for entries being stored right now.
+        walkStart = time.time()
+        entries = list(itertools.chain(self.manifestRepository.indexEntries(),
+                                       self.compilerArtifactsRepository.indexEntries()))
+        with self.maintenanceLock.exclusive():
+            try:
+                self.index.rebuild(entries, walkStart)
+            except sqlite3.Error as e:
+                printTraceStatement("Failed to rebuild cache index: {}".format(e))
+
+    def claimEviction(self):
+        """Returns whether a process evicting entries should be started, and
+        if so records that one is. It should not if another one was started
+        less than MIN_EVICTION_INTERVAL seconds ago, or is still running."""
+        try:
+            if time.time() - os.path.getmtime(self.evictionMarker) < MIN_EVICTION_INTERVAL:
+                return False
+        except FileNotFoundError:
+            pass
+        try:
+            self.evictionLock.acquire()
+        except CacheLockException:
+            return False
+        self.evictionLock.release()
+        with open(self.evictionMarker, 'a'):
+            pass
+        os.utime(self.evictionMarker)
+        return True
+
+    def evict(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        """Removes the least recently hit manifests and the cache entries
+        picked by the eviction policy in batches until the cache is reduced
+        like by clean(). Unlike clean(),
+        this locks only the sections modified by a batch at a time, so
+        compilations carry on meanwhile. Returns right away if another process
+        is evicting entries already."""
+        try:
+            self.evictionLock.acquire()
+        except CacheLockException:
+            return
+        try:
+            self._evict(maximumSize, evictionPolicy)
+        finally:
+            self.evictionLock.release()
+
+    def _evict(self, maximumSize, evictionPolicy):
+        if not self.index.isComplete():
+            self.rebuildIndex()
+            if not self.index.isComplete():
+                self.clean(maximumSize, evictionPolicy)
+                return
+
+        if self.index.totalSize() >= maximumSize:
+            maximumSizeManifests, maximumSizeObjects = self._sizeLimits(maximumSize)
+            while self.manifestRepository.evict(maximumSizeManifests, EVICTION_BATCH_SIZE) + \
+                  self.compilerArtifactsRepository.evict(maximumSizeObjects, EVICTION_BATCH_SIZE,
+                                                         evictionPolicy) > 0:
+                pass
+
+        with self.statistics.lock, self.statistics as stats:
+            stats.setCacheSize(self.index.totalSize())
+            stats.setNumCacheEntries(self.index.count(CacheIndex.OBJECT))
+            CacheLock.flushStatistics(stats)
+
+
+class CachePackFileStrategy(CacheFileStrategy):
+    """ Like CacheFileStrategy, but stores compiler artifacts in pack files
+    instead of a directory per cache entry. """
+    def __init__(self, cacheDirectory=None):
+        super(CachePackFileStrategy, self).__init__(cacheDirectory)
+        packsRootDir = os.path.join(self.dir, "packs")
+        ensureDirectoryExists(packsRootDir)
+        self.compilerArtifactsRepository = PackedCompilerArtifactsRepository(packsRootDir, self.compressionPolicy)
+
+    def __str__(self):
+        return "Disk cache using pack files at {}".format(self.dir)
+
+    def _evict(self, maximumSize, evictionPolicy):
+        # The cache index only holds the manifests; the pack files are read
+        # once to pick the entries to evict
+        if not self.index.isComplete():
+            self.rebuildIndex()
+            if not self.index.isComplete():
+                self.clean(maximumSize, evictionPolicy)
+                self.compilerArtifactsRepository.compact()
+                return
+
+        maximumSizeManifests, maximumSizeObjects = self._sizeLimits(maximumSize)
+        while self.manifestRepository.evict(maximumSizeManifests, EVICTION_BATCH_SIZE) > 0:
+            pass
+        compilerArtifactsCount, compilerArtifactsSize = self.compilerArtifactsRepository.evict(
+            maximumSizeObjects, EVICTION_BATCH_SIZE, evictionPolicy)
+        # Copying records out of sparse pack files is deferred until all
+        # batches are removed, such that no batch holds its locks for long
+        self.compilerArtifactsRepository.compact()
 
-        stats.setCacheSize(currentCompilerArtifactsSize + currentSizeManifests)
-        stats.setNumCacheEntries(currentCompilerArtifactsCount)
+        with self.statistics.lock, self.statistics as stats:
+            stats.setCacheSize(self.index.totalSize(CacheIndex.MANIFEST) + compilerArtifactsSize)
+            stats.setNumCacheEntries(compilerArtifactsCount)
+            CacheLock.flushStatistics(stats)
 
 
 class Cache:
@@ -594,6 +768,8 @@ class Cache:
             from .storage import CacheFileWithMemcacheFallbackStrategy
             self.strategy = CacheFileWithMemcacheFallbackStrategy(os.environ.get("CLCACHE_MEMCACHED"),
                                                                   cacheDirectory=cacheDirectory)
+        elif "CLCACHE_PACKFILES" in os.environ:
+            self.strategy = CachePackFileStrategy(cacheDirectory=cacheDirectory)
         else:
             self.strategy = CacheFileStrategy(cacheDirectory=cacheDirectory)
 
@@ -601,8 +777,8 @@ class Cache:
         return str(self.strategy)
 
     @property
-    def lock(self):
-        return self.strategy.lock
+    def maintenanceLock(self):
+        return self.strategy.maintenanceLock
 
     @contextlib.contextmanager
     def manifestLockFor(self, key):
@@ -617,14 +793,41 @@ class Cache:
     def statistics(self):
         return self.strategy.statistics
 
-    def clean(self, stats, maximumSize):
-        return self.strategy.clean(stats, maximumSize)
+    @property
+    def fileHashCache(self):
+        return self.strategy.fileHashCache
+
+    @property
+    def compressionPolicy(self):
+        return self.strategy.compressionPolicy
+
+    @property
+    def blobStore(self):
+        return self.strategy.blobStore
+
+    @property
+    def objectFileRestorer(self):
+        return self.strategy.objectFileRestorer
+
+    def clean(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        return self.strategy.clean(maximumSize, evictionPolicy)
+
+    def evict(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        return self.strategy.evict(maximumSize, evictionPolicy)
+
+    def claimEviction(self):
+        return self.strategy.claimEviction()
 
     @contextlib.contextmanager
     def lockFor(self, key):
         with self.strategy.lockFor(key):
             yield
 
+    @contextlib.contextmanager
+    def readLockFor(self, key):
+        with self.strategy.readLockFor(key):
+            yield
+
     def getEntry(self, key):
         return self.strategy.getEntry(key)
 
@@ -637,370 +840,14 @@ class Cache:
     def setManifest(self, manifestHash, manifest):
         self.strategy.setManifest(manifestHash, manifest)
 
+    def touchManifest(self, manifestHash, manifest, objectHash, statFingerprint=None):
+        self.strategy.touchManifest(manifestHash, manifest, objectHash, statFingerprint)
+
     def getManifest(self, manifestHash):
         return self.strategy.getManifest(manifestHash)
 
-
-class PersistentJSONDict:
-    def __init__(self, fileName):
-        self._dirty = False
-        self._dict = {}
-        self._fileName = fileName
-        try:
-            with open(self._fileName, 'r') as f:
-                self._dict = json.load(f)
-        except IOError:
-            pass
-        except ValueError:
-            printErrStr("clcache: persistent json file %s was broken" % fileName)
-
-    def save(self):
-        if self._dirty:
-            with atomic_write(self._fileName, overwrite=True) as f:
-                json.dump(self._dict, f, sort_keys=True, indent=4)
-
-    def __setitem__(self, key, value):
-        self._dict[key] = value
-        self._dirty = True
-
-    def __getitem__(self, key):
-        return self._dict[key]
-
-    def __contains__(self, key):
-        return key in self._dict
-
-    def __eq__(self, other):
-        return type(self) is type(other) and self.__dict__ == other.__dict__
-
-
-class Configuration:
-    _defaultValues = {"MaximumCacheSize": 1073741824} # 1 GiB
-
-    def __init__(self, configurationFile):
-        self._configurationFile = configurationFile
-        self._cfg = None
-
-    def __enter__(self):
-        self._cfg = PersistentJSONDict(self._configurationFile)
-        for setting, defaultValue in self._defaultValues.items():
-            if setting not in self._cfg:
-                self._cfg[setting] = defaultValue
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        # Does not write to disc when unchanged
-        self._cfg.save()
-
-    def maximumCacheSize(self):
-        return self._cfg["MaximumCacheSize"]
-
-    def setMaximumCacheSize(self, size):
-        self._cfg["MaximumCacheSize"] = size
-
-
-class Statistics:
-    CALLS_WITH_INVALID_ARGUMENT = "CallsWithInvalidArgument"
-    CALLS_WITHOUT_SOURCE_FILE = "CallsWithoutSourceFile"
-    CALLS_WITH_MULTIPLE_SOURCE_FILES = "CallsWithMultipleSourceFiles"
-    CALLS_WITH_PCH = "CallsWithPch"
-    CALLS_FOR_LINKING = "CallsForLinking"
-    CALLS_FOR_EXTERNAL_DEBUG_INFO = "CallsForExternalDebugInfo"
-    CALLS_FOR_PREPROCESSING = "CallsForPreprocessing"
-    CACHE_HITS = "CacheHits"
-    CACHE_MISSES = "CacheMisses"
-    EVICTED_MISSES = "EvictedMisses"
-    HEADER_CHANGED_MISSES = "HeaderChangedMisses"
-    SOURCE_CHANGED_MISSES = "SourceChangedMisses"
-    CACHE_ENTRIES = "CacheEntries"
-    CACHE_SIZE = "CacheSize"
-
-    RESETTABLE_KEYS = {
-        CALLS_WITH_INVALID_ARGUMENT,
-        CALLS_WITHOUT_SOURCE_FILE,
-        CALLS_WITH_MULTIPLE_SOURCE_FILES,
-        CALLS_WITH_PCH,
-        CALLS_FOR_LINKING,
-        CALLS_FOR_EXTERNAL_DEBUG_INFO,
-        CALLS_FOR_PREPROCESSING,
-        CACHE_HITS,
-        CACHE_MISSES,
-        EVICTED_MISSES,
-        HEADER_CHANGED_MISSES,
-        SOURCE_CHANGED_MISSES,
-    }
-    NON_RESETTABLE_KEYS = {
-        CACHE_ENTRIES,
-        CACHE_SIZE,
-    }
-
-    def __init__(self, statsFile):
-        self._statsFile = statsFile
-        self._stats = None
-        self.lock = CacheLock.forPath(self._statsFile)
-
-    def __enter__(self):
-        self._stats = PersistentJSONDict(self._statsFile)
-        for k in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
-            if k not in self._stats:
-                self._stats[k] = 0
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        # Does not write to disc when unchanged
-        self._stats.save()
-
-    def __eq__(self, other):
-        return type(self) is type(other) and self.__dict__ == other.__dict__
-
-    def numCallsWithInvalidArgument(self):
-        return self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT]
-
-    def registerCallWithInvalidArgument(self):
-        self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT] += 1
-
-    def numCallsWithoutSourceFile(self):
-        return self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE]
-
-    def registerCallWithoutSourceFile(self):
-        self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE] += 1
-
-    def numCallsWithMultipleSourceFiles(self):
-        return self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES]
-
-    def registerCallWithMultipleSourceFiles(self):
-        self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES] += 1
-
-    def numCallsWithPch(self):
-        return self._stats[Statistics.CALLS_WITH_PCH]
-
-    def registerCallWithPch(self):
-        self._stats[Statistics.CALLS_WITH_PCH] += 1
-
-    def numCallsForLinking(self):
-        return self._stats[Statistics.CALLS_FOR_LINKING]
-
-    def registerCallForLinking(self):
-        self._stats[Statistics.CALLS_FOR_LINKING] += 1
-
-    def numCallsForExternalDebugInfo(self):
-        return self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO]
-
-    def registerCallForExternalDebugInfo(self):
-        self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO] += 1
-
-    def numEvictedMisses(self):
-        return self._stats[Statistics.EVICTED_MISSES]
-
-    def registerEvictedMiss(self):
-        self.registerCacheMiss()
-        self._stats[Statistics.EVICTED_MISSES] += 1
-
-    def numHeaderChangedMisses(self):
-        return self._stats[Statistics.HEADER_CHANGED_MISSES]
-
-    def registerHeaderChangedMiss(self):
-        self.registerCacheMiss()
-        self._stats[Statistics.HEADER_CHANGED_MISSES] += 1
-
-    def numSourceChangedMisses(self):
-        return self._stats[Statistics.SOURCE_CHANGED_MISSES]
-
-    def registerSourceChangedMiss(self):
-        self.registerCacheMiss()
-        self._stats[Statistics.SOURCE_CHANGED_MISSES] += 1
-
-    def numCacheEntries(self):
-        return self._stats[Statistics.CACHE_ENTRIES]
-
-    def setNumCacheEntries(self, number):
-        self._stats[Statistics.CACHE_ENTRIES] = number
-
-    def registerCacheEntry(self, size):
-        self._stats[Statistics.CACHE_ENTRIES] += 1
-        self._stats[Statistics.CACHE_SIZE] += size
-
-    def unregisterCacheEntry(self, size):
-        self._stats[Statistics.CACHE_ENTRIES] -= 1
-        self._stats[Statistics.CACHE_SIZE] -= size
-
-    def currentCacheSize(self):
-        return self._stats[Statistics.CACHE_SIZE]
-
-    def setCacheSize(self, size):
-        self._stats[Statistics.CACHE_SIZE] = size
-
-    def numCacheHits(self):
-        return self._stats[Statistics.CACHE_HITS]
-
-    def registerCacheHit(self):
-        self._stats[Statistics.CACHE_HITS] += 1
-
-    def numCacheMisses(self):
-        return self._stats[Statistics.CACHE_MISSES]
-
-    def registerCacheMiss(self):
-        self._stats[Statistics.CACHE_MISSES] += 1
-
-    def numCallsForPreprocessing(self):
-        return self._stats[Statistics.CALLS_FOR_PREPROCESSING]
-
-    def registerCallForPreprocessing(self):
-        self._stats[Statistics.CALLS_FOR_PREPROCESSING] += 1
-
-    def resetCounters(self):
-        for k in Statistics.RESETTABLE_KEYS:
-            self._stats[k] = 0
-
-
-class AnalysisError(Exception):
-    pass
-
-
-class NoSourceFileError(AnalysisError):
-    pass
-
-
-class MultipleSourceFilesComplexError(AnalysisError):
-    pass
-
-
-class CalledForLinkError(AnalysisError):
-    pass
-
-
-class CalledWithPchError(AnalysisError):
-    pass
-
-
-class ExternalDebugInfoError(AnalysisError):
-    pass
-
-
-class CalledForPreprocessingError(AnalysisError):
-    pass
-
-
-class InvalidArgumentError(AnalysisError):
-    pass
-
-
-def getCompilerHash(compilerBinary):
-    stat = os.stat(compilerBinary)
-    data = '|'.join([
-        str(stat.st_mtime),
-        str(stat.st_size),
-        VERSION,
-        ])
-    hasher = HashAlgorithm()
-    hasher.update(data.encode("UTF-8"))
-    return hasher.hexdigest()
-
-
-def getFileHashes(filePaths):
-    if 'CLCACHE_SERVER' in os.environ:
-        pipeName = r'\\.\pipe\clcache_srv'
-        while True:
-            try:
-                with open(pipeName, 'w+b') as f:
-                    f.write('\n'.join(filePaths).encode('utf-8'))
-                    f.write(b'\x00')
-                    response = f.read()
-                    if response.startswith(b'!'):
-                        raise pickle.loads(response[1:-1])
-                    return response[:-1].decode('utf-8').splitlines()
-            except OSError as e:
-                if e.errno == errno.EINVAL and windll.kernel32.GetLastError() == ERROR_PIPE_BUSY:
-                    windll.kernel32.WaitNamedPipeW(pipeName, NMPWAIT_WAIT_FOREVER)
-                else:
-                    raise
-    else:
-        return [getFileHash(filePath) for filePath in filePaths]
-
-
-def getFileHash(filePath, additionalData=None):
-    hasher = HashAlgorithm()
-    with open(filePath, 'rb') as inFile:
-        hasher.update(inFile.read())
-    if additionalData is not None:
-        # Encoding of this additional data does not really matter
-        # as long as we keep it fixed, otherwise hashes change.
-        # The string should fit into ASCII, so UTF8 should not change anything
-        hasher.update(additionalData.encode("UTF-8"))
-    return hasher.hexdigest()
-
-
-def getStringHash(dataString):
-    hasher = HashAlgorithm()
-    hasher.update(dataString.encode("UTF-8"))
-    return hasher.hexdigest()
-
-
-def expandBasedirPlaceholder(path):
-    baseDir = normalizeBaseDir(os.environ.get('CLCACHE_BASEDIR'))
-    if path.startswith(BASEDIR_REPLACEMENT):
-        if not baseDir:
-            raise LogicException('No CLCACHE_BASEDIR set, but found relative path ' + path)
-        return path.replace(BASEDIR_REPLACEMENT, baseDir, 1)
-    else:
-        return path
-
-
-def collapseBasedirToPlaceholder(path):
-    baseDir = normalizeBaseDir(os.environ.get('CLCACHE_BASEDIR'))
-    if baseDir is None:
-        return path
-    else:
-        assert path == os.path.normcase(path)
-        assert baseDir == os.path.normcase(baseDir)
-        if path.startswith(baseDir):
-            return path.replace(baseDir, BASEDIR_REPLACEMENT, 1)
-        else:
-            return path
-
-
-def ensureDirectoryExists(path):
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
-
-
-def copyOrLink(srcFilePath, dstFilePath, writeCache=False):
-    ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
-
-    if "CLCACHE_HARDLINK" in os.environ:
-        ret = windll.kernel32.CreateHardLinkW(str(dstFilePath), str(srcFilePath), None)
-        if ret != 0:
-            # Touch the time stamp of the new link so that the build system
-            # doesn't confused by a potentially old time on the file. The
-            # hard link gets the same timestamp as the cached file.
-            # Note that touching the time stamp of the link also touches
-            # the time stamp on the cache (and hence on all over hard
-            # links). This shouldn't be a problem though.
-            os.utime(dstFilePath, None)
-            return
-
-    # If hardlinking fails for some reason (or it's not enabled), just
-    # fall back to moving bytes around. Always to a temporary path first to
-    # lower the chances of corrupting it.
-    tempDst = dstFilePath + '.tmp'
-
-    if "CLCACHE_COMPRESS" in os.environ:
-        if "CLCACHE_COMPRESSLEVEL" in os.environ:
-            compress = int(os.environ["CLCACHE_COMPRESSLEVEL"])
-        else:
-            compress = 6
-
-        if writeCache is True:
-            with open(srcFilePath, 'rb') as fileIn, gzip.open(tempDst, 'wb', compress) as fileOut:
-                copyfileobj(fileIn, fileOut)
-        else:
-            with gzip.open(srcFilePath, 'rb', compress) as fileIn, open(tempDst, 'wb') as fileOut:
-                copyfileobj(fileIn, fileOut)
-    else:
-        copyfile(srcFilePath, tempDst)
-    os.replace(tempDst, dstFilePath)
+    def migrateLegacyManifest(self, legacyManifestHash, manifestHash, hashForInclude):
+        return self.strategy.migrateLegacyManifest(legacyManifestHash, manifestHash, hashForInclude)
 
 
 def myExecutablePath():
@@ -1030,311 +877,10 @@ def findCompilerBinary():
     return None
 
 
-def printTraceStatement(msg: str) -> None:
-    if "CLCACHE_LOG" in os.environ:
-        scriptDir = os.path.realpath(os.path.dirname(sys.argv[0]))
-        with OUTPUT_LOCK:
-            print(os.path.join(scriptDir, "clcache.py") + " " + msg)
-
-
-class CommandLineTokenizer:
-    def __init__(self, content):
-        self.argv = []
-        self._content = content
-        self._pos = 0
-        self._token = ''
-        self._parser = self._initialState
-
-        while self._pos < len(self._content):
-            self._parser = self._parser(self._content[self._pos])
-            self._pos += 1
-
-        if self._token:
-            self.argv.append(self._token)
-
-    def _initialState(self, currentChar):
-        if currentChar.isspace():
-            return self._initialState
-
-        if currentChar == '"':
-            return self._quotedState
-
-        if currentChar == '\\':
-            self._parseBackslash()
-            return self._unquotedState
-
-        self._token += currentChar
-        return self._unquotedState
-
-    def _unquotedState(self, currentChar):
-        if currentChar.isspace():
-            self.argv.append(self._token)
-            self._token = ''
-            return self._initialState
-
-        if currentChar == '"':
-            return self._quotedState
-
-        if currentChar == '\\':
-            self._parseBackslash()
-            return self._unquotedState
-
-        self._token += currentChar
-        return self._unquotedState
-
-    def _quotedState(self, currentChar):
-        if currentChar == '"':
-            return self._unquotedState
-
-        if currentChar == '\\':
-            self._parseBackslash()
-            return self._quotedState
-
-        self._token += currentChar
-        return self._quotedState
-
-    def _parseBackslash(self):
-        numBackslashes = 0
-        while self._pos < len(self._content) and self._content[self._pos] == '\\':
-            self._pos += 1
-            numBackslashes += 1
-
-        followedByDoubleQuote = self._pos < len(self._content) and self._content[self._pos] == '"'
-        if followedByDoubleQuote:
-            self._token += '\\' * (numBackslashes // 2)
-            if numBackslashes % 2 == 0:
-                self._pos -= 1
-            else:
-                self._token += '"'
-        else:
-            self._token += '\\' * numBackslashes
-            self._pos -= 1
-
-
-def splitCommandsFile(content):
-    return CommandLineTokenizer(content).argv
-
-
-def expandCommandLine(cmdline):
-    ret = []
-
-    for arg in cmdline:
-        if arg[0] == '@':
-            includeFile = arg[1:]
-            with open(includeFile, 'rb') as f:
-                rawBytes = f.read()
-
-            encoding = None
-
-            bomToEncoding = {
-                codecs.BOM_UTF32_BE: 'utf-32-be',
-                codecs.BOM_UTF32_LE: 'utf-32-le',
-                codecs.BOM_UTF16_BE: 'utf-16-be',
-                codecs.BOM_UTF16_LE: 'utf-16-le',
-            }
-
-            for bom, enc in bomToEncoding.items():
-                if rawBytes.startswith(bom):
-                    encoding = enc
-                    rawBytes = rawBytes[len(bom):]
-                    break
-
-            if encoding:
-                includeFileContents = rawBytes.decode(encoding)
-            else:
-                includeFileContents = rawBytes.decode("UTF-8")
-
-            ret.extend(expandCommandLine(splitCommandsFile(includeFileContents.strip())))
-        else:
-            ret.append(arg)
-
-    return ret
-
-
-def extendCommandLineFromEnvironment(cmdLine, environment):
-    remainingEnvironment = environment.copy()
-
-    prependCmdLineString = remainingEnvironment.pop('CL', None)
-    if prependCmdLineString is not None:
-        cmdLine = splitCommandsFile(prependCmdLineString.strip()) + cmdLine
-
-    appendCmdLineString = remainingEnvironment.pop('_CL_', None)
-    if appendCmdLineString is not None:
-        cmdLine = cmdLine + splitCommandsFile(appendCmdLineString.strip())
-
-    return cmdLine, remainingEnvironment
-
-
-class Argument:
-    def __init__(self, name):
-        self.name = name
-
-    def __len__(self):
-        return len(self.name)
-
-    def __str__(self):
-        return "/" + self.name
-
-    def __eq__(self, other):
-        return type(self) == type(other) and self.name == other.name
-
-    def __hash__(self):
-        key = (type(self), self.name)
-        return hash(key)
-
-
-# /NAMEparameter (no space, required parameter).
-class ArgumentT1(Argument):
-    pass
-
-
-# /NAME[parameter] (no space, optional parameter)
-class ArgumentT2(Argument):
-    pass
-
-
-# /NAME[ ]parameter (optional space)
-class ArgumentT3(Argument):
-    pass
-
-
-# /NAME parameter (required space)
-class ArgumentT4(Argument):
-    pass
-
-
-class CommandLineAnalyzer:
-    argumentsWithParameter = {
-        # /NAMEparameter
-        ArgumentT1('Ob'), ArgumentT1('Yl'), ArgumentT1('Zm'),
-        # /NAME[parameter]
-        ArgumentT2('doc'), ArgumentT2('FA'), ArgumentT2('FR'), ArgumentT2('Fr'),
-        ArgumentT2('Gs'), ArgumentT2('MP'), ArgumentT2('Yc'), ArgumentT2('Yu'),
-        ArgumentT2('Zp'), ArgumentT2('Fa'), ArgumentT2('Fd'), ArgumentT2('Fe'),
-        ArgumentT2('Fi'), ArgumentT2('Fm'), ArgumentT2('Fo'), ArgumentT2('Fp'),
-        ArgumentT2('Wv'),
-        # /NAME[ ]parameter
-        ArgumentT3('AI'), ArgumentT3('D'), ArgumentT3('Tc'), ArgumentT3('Tp'),
-        ArgumentT3('FI'), ArgumentT3('U'), ArgumentT3('I'), ArgumentT3('F'),
-        ArgumentT3('FU'), ArgumentT3('w1'), ArgumentT3('w2'), ArgumentT3('w3'),
-        ArgumentT3('w4'), ArgumentT3('wd'), ArgumentT3('we'), ArgumentT3('wo'),
-        ArgumentT3('V'),
-        ArgumentT3('imsvc'),
-        # /NAME parameter
-        ArgumentT4("Xclang"),
-    }
-    argumentsWithParameterSorted = sorted(argumentsWithParameter, key=len, reverse=True)
-
-    @staticmethod
-    def _getParameterizedArgumentType(cmdLineArgument):
-        # Sort by length to handle prefixes
-        for arg in CommandLineAnalyzer.argumentsWithParameterSorted:
-            if cmdLineArgument.startswith(arg.name, 1):
-                return arg
-        return None
-
-    @staticmethod
-    def parseArgumentsAndInputFiles(cmdline):
-        arguments = defaultdict(list)
-        inputFiles = []
-        i = 0
-        while i < len(cmdline):
-            cmdLineArgument = cmdline[i]
-
-            # Plain arguments starting with / or -
-            if cmdLineArgument.startswith('/') or cmdLineArgument.startswith('-'):
-                arg = CommandLineAnalyzer._getParameterizedArgumentType(cmdLineArgument)
-                if arg is not None:
-                    if isinstance(arg, ArgumentT1):
-                        value = cmdLineArgument[len(arg) + 1:]
-                        if not value:
-                            raise InvalidArgumentError("Parameter for {} must not be empty".format(arg))
-                    elif isinstance(arg, ArgumentT2):
-                        value = cmdLineArgument[len(arg) + 1:]
-                    elif isinstance(arg, ArgumentT3):
-                        value = cmdLineArgument[len(arg) + 1:]
-                        if not value:
-                            value = cmdline[i + 1]
-                            i += 1
-                    elif isinstance(arg, ArgumentT4):
-                        value = cmdline[i + 1]
-                        i += 1
-                    else:
-                        raise AssertionError("Unsupported argument type.")
-
-                    arguments[arg.name].append(value)
-                else:
-                    argumentName = cmdLineArgument[1:] # name not followed by parameter in this case
-                    arguments[argumentName].append('')
-
-            # Response file
-            elif cmdLineArgument[0] == '@':
-                raise AssertionError("No response file arguments (starting with @) must be left here.")
-
-            # Source file arguments
-            else:
-                inputFiles.append(cmdLineArgument)
-
-            i += 1
-
-        return dict(arguments), inputFiles
-
-    @staticmethod
-    def analyze(cmdline: List[str]) -> Tuple[List[Tuple[str, str]], List[str]]:
-        options, inputFiles = CommandLineAnalyzer.parseArgumentsAndInputFiles(cmdline)
-        # Use an override pattern to shadow input files that have
-        # already been specified in the function above
-        inputFiles = {inputFile: '' for inputFile in inputFiles}
-        compl = False
-        if 'Tp' in options:
-            inputFiles.update({inputFile: '/Tp' for inputFile in options['Tp']})
-            compl = True
-        if 'Tc' in options:
-            inputFiles.update({inputFile: '/Tc' for inputFile in options['Tc']})
-            compl = True
-
-        # Now collect the inputFiles into the return format
-        inputFiles = list(inputFiles.items())
-        if not inputFiles:
-            raise NoSourceFileError()
-
-        for opt in ['E', 'EP', 'P']:
-            if opt in options:
-                raise CalledForPreprocessingError()
-
-        # Technically, it would be possible to support /Zi: we'd just need to
-        # copy the generated .pdb files into/out of the cache.
-        if 'Zi' in options:
-            raise ExternalDebugInfoError()
-
-        if 'Yc' in options or 'Yu' in options:
-            raise CalledWithPchError()
-
-        if 'link' in options or 'c' not in options:
-            raise CalledForLinkError()
-
-        if len(inputFiles) > 1 and compl:
-            raise MultipleSourceFilesComplexError()
-
-        objectFiles = None
-        prefix = ''
-        if 'Fo' in options and options['Fo'][0]:
-            # Handle user input
-            tmp = os.path.normpath(options['Fo'][0])
-            if os.path.isdir(tmp):
-                prefix = tmp
-            elif len(inputFiles) == 1:
-                objectFiles = [tmp]
-        if objectFiles is None:
-            # Generate from .c/.cpp filenames
-            objectFiles = [os.path.join(prefix, basenameWithoutExtension(f)) + '.obj' for f, _ in inputFiles]
-
-        printTraceStatement("Compiler source files: {}".format(inputFiles))
-        printTraceStatement("Compiler object file: {}".format(objectFiles))
-        return inputFiles, objectFiles
-
-
-def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsString=True, environment=None):
+def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsString=True, environment=None,
+                       stdoutHasher=None):
+    # If stdoutHasher is given, the captured stdout is fed into it chunk by
+    # chunk instead of being returned.
     realCmdline = [compilerBinary] + cmdLine
     printTraceStatement("Invoking real compiler as {}".format(realCmdline))
 
@@ -1355,7 +901,10 @@ def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsStr
             compilerProcess = subprocess.Popen(realCmdline, stdout=stdoutFile, stderr=stderrFile, env=environment)
             returnCode = compilerProcess.wait()
             stdoutFile.seek(0)
-            stdout = stdoutFile.read()
+            if stdoutHasher is not None:
+                updateHasherFromFile(stdoutHasher, stdoutFile)
+            else:
+                stdout = stdoutFile.read()
             stderrFile.seek(0)
             stderr = stderrFile.read()
     else:
@@ -1370,6 +919,7 @@ def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsStr
 
     return returnCode, stdout, stderr
 
+
 # Returns the amount of jobs which should be run in parallel when
 # invoked in batch mode as determined by the /MP argument
 def jobCount(cmdLine):
@@ -1391,12 +941,14 @@ def jobCount(cmdLine):
         # not expected to happen
         return 2
 
+
 def printStatistics(cache):
     template = """
 clcache statistics:
   current cache dir         : {}
   cache size                : {:,} bytes
   maximum cache size        : {:,} bytes
+  eviction policy           : {}
   cache entries             : {}
   cache hits                : {}
   cache misses
@@ -1411,13 +963,23 @@ clcache statistics:
     called for external debug  : {}
     called w/o source          : {}
     called w/ multiple sources : {}
-    called w/ PCH              : {}""".strip()
+    called w/ PCH              : {}
+  header hash cache
+    hits                       : {}
+    misses                     : {}
+  compression
+    ratio                      : {}
+    CPU time                   : {:.2f} seconds
+  deduplication
+    ratio                      : {}
+  locks waited for longest""".strip()
 
     with cache.statistics.lock, cache.statistics as stats, cache.configuration as cfg:
         print(template.format(
             str(cache),
             stats.currentCacheSize(),
             cfg.maximumCacheSize(),
+            cfg.evictionPolicy(),
             stats.numCacheEntries(),
             stats.numCacheHits(),
             stats.numCacheMisses(),
@@ -1431,7 +993,18 @@ clcache statistics:
             stats.numCallsWithoutSourceFile(),
             stats.numCallsWithMultipleSourceFiles(),
             stats.numCallsWithPch(),
+            stats.numHashCacheHits(),
+            stats.numHashCacheMisses(),
+            "-" if stats.compressionRatio() is None else "{:.1%}".format(stats.compressionRatio()),
+            stats.compressionCpuTime(),
+            "-" if stats.deduplicationRatio() is None else "{:.2f}".format(stats.deduplicationRatio()),
         ))
+        slowestLocks = stats.slowestLocks(NUM_REPORTED_SLOWEST_LOCKS)
+        for path, count, totalWait, maxWait in slowestLocks:
+            print("    {:<27}: {:.2f} seconds in {} acquisitions, longest {:.3f} seconds".format(
+                path, totalWait, count, maxWait))
+        if not slowestLocks:
+            print("    -")
 
 
 def resetStatistics(cache):
@@ -1440,13 +1013,41 @@ def resetStatistics(cache):
 
 
 def cleanCache(cache):
-    with cache.lock, cache.statistics as stats, cache.configuration as cfg:
-        cache.clean(stats, cfg.maximumCacheSize())
+    with cache.configuration as cfg:
+        maximumSize = cfg.maximumCacheSize()
+        evictionPolicy = cfg.evictionPolicy()
+    cache.clean(maximumSize, evictionPolicy)
 
 
 def clearCache(cache):
-    with cache.lock, cache.statistics as stats:
-        cache.clean(stats, 0)
+    cache.clean(0)
+
+
+def evictEntries(cache):
+    with cache.configuration as cfg:
+        maximumSize = cfg.maximumCacheSize()
+        evictionPolicy = cfg.evictionPolicy()
+    cache.evict(maximumSize, evictionPolicy)
+
+
+def triggerEviction(cache):
+    """Starts a clcache process evicting entries from the cache in the
+    background, which the build doesn't wait for. Nothing is started while
+    another such process runs or was started recently."""
+    if not cache.claimEviction():
+        printTraceStatement("Eviction of cache entries was started already")
+        return
+    if hasattr(sys, "frozen"):
+        cmdLine = [sys.executable, "--evict"]
+    else:
+        cmdLine = [sys.executable, "-m", "clcache", "--evict"]
+    printTraceStatement("Starting eviction of cache entries: {}".format(cmdLine))
+    if os.name == 'nt':
+        detachOptions = {'creationflags': DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP}
+    else:
+        detachOptions = {'start_new_session': True}
+    subprocess.Popen(cmdLine, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     close_fds=True, **detachOptions)
 
 
 # Returns pair:
@@ -1489,44 +1090,60 @@ def parseIncludesSet(compilerOutput, sourceFile, strip):
 
 
 def addObjectToCache(stats, cache, cachekey, artifacts):
-    # This function asserts that the caller locked 'section' and 'stats'
-    # already and also saves them
+    # This function asserts that the caller locked 'section' already and
+    # records the new entry in 'stats', which may be a StatisticsDelta
     printTraceStatement("Adding file {} to cache using key {}".format(artifacts.objectFilePath, cachekey))
 
+    with cache.configuration as cfg:
+        maximumCacheSize = cfg.maximumCacheSize()
+
+    cache.compressionPolicy.setCacheUsage(stats.currentCacheSize(), maximumCacheSize)
     size = cache.setEntry(cachekey, artifacts)
     if size is None:
         size = os.path.getsize(artifacts.objectFilePath)
     stats.registerCacheEntry(size)
+    cache.compressionPolicy.flushStatistics(stats)
+    cache.blobStore.flushStatistics(stats)
 
-    with cache.configuration as cfg:
-        return stats.currentCacheSize() >= cfg.maximumCacheSize()
+    return stats.currentCacheSize() >= maximumCacheSize
 
 
 def processCacheHit(cache, objectFile, cachekey):
+    """Restores the cached artifacts for cachekey. Returns None if the entry
+    was evicted while reading it."""
     printTraceStatement("Reusing cached object for key {} for object file {}".format(cachekey, objectFile))
 
-    with cache.lockFor(cachekey):
-        with cache.statistics.lock, cache.statistics as stats:
-            stats.registerCacheHit()
-
+    with cache.readLockFor(cachekey):
         if os.path.exists(objectFile):
             os.remove(objectFile)
 
-        cachedArtifacts = cache.getEntry(cachekey)
-        copyOrLink(cachedArtifacts.objectFilePath, objectFile)
-        printTraceStatement("Finished. Exit code 0")
-        return 0, cachedArtifacts.stdout, cachedArtifacts.stderr, False
+        try:
+            cachedArtifacts = cache.getEntry(cachekey)
+            cache.objectFileRestorer.restore(cachedArtifacts, objectFile)
+        except OSError as e:
+            printTraceStatement("Cached object for key {} was evicted concurrently: {}".format(cachekey, e))
+            return None
+
+    with cache.statistics.delta() as stats:
+        stats.registerCacheHit()
+        cache.fileHashCache.flushStatistics(stats)
+        CacheLock.flushStatistics(stats)
+    printTraceStatement("Finished. Exit code 0")
+    return 0, clConsoleOutput(cachedArtifacts.stdout), clConsoleOutput(cachedArtifacts.stderr), False
 
 
-def createManifestEntry(manifestHash, includePaths):
-    sortedIncludePaths = sorted(set(includePaths))
-    includeHashes = getFileHashes(sortedIncludePaths)
+def createManifestEntry(manifestHash, includePaths, hashCache=None):
+    # Sort by the paths as stored in the manifest, that's the order in which
+    # the decision tree of the manifest tests them.
+    sortedIncludePaths = sorted(set(includePaths), key=collapseBasedirToPlaceholder)
+    includeHashes = getFileHashes(sortedIncludePaths, hashCache)
 
     safeIncludes = [collapseBasedirToPlaceholder(path) for path in sortedIncludePaths]
     includesContentHash = ManifestRepository.getIncludesContentHashForHashes(includeHashes)
     cachekey = CompilerArtifactsRepository.computeKeyDirect(manifestHash, includesContentHash)
+    statFingerprint = IncludeHashes().statFingerprint(safeIncludes)
 
-    return ManifestEntry(safeIncludes, includesContentHash, cachekey)
+    return ManifestEntry(safeIncludes, includesContentHash, cachekey, includeHashes, statFingerprint)
 
 
 def main():
@@ -1560,12 +1177,22 @@ def main():
                              action="store_true", help="clean cache")
     groupParser.add_argument("-C", "--clear", dest="clear_cache",
                              action="store_true", help="clear cache")
+    groupParser.add_argument("--evict", dest="evict_entries",
+                             action="store_true",
+                             help="evict entries in small batches "
+                                  "until the cache is below its maximum size")
     groupParser.add_argument("-z", "--reset", dest="reset_stats",
                              action="store_true",
                              help="reset cache statistics")
     groupParser.add_argument("-M", "--set-size", dest="cache_size", type=int,
                              default=None,
                              help="set maximum cache size (in bytes)")
+    groupParser.add_argument("--set-eviction-policy", dest="eviction_policy",
+                             choices=EVICTION_POLICIES, default=None,
+                             help="set the policy picking the cache entries to remove when cleaning "
+                                  "the cache: least recently used, least frequently used, or by compile "
+                                  "time saved per byte and hit frequency (default: {})".format(
+                                      DEFAULT_EVICTION_POLICY))
 
     # This argument need to be optional, or it will be required for the status commands above
     parser.add_argument("compiler", default=None, action=CommandCheckAction,
@@ -1595,6 +1222,10 @@ def main():
         print('Cache cleared')
         return 0
 
+    if options.evict_entries:
+        evictEntries(cache)
+        return 0
+
     if options.reset_stats:
         resetStatistics(cache)
         print('Statistics reset')
@@ -1606,10 +1237,15 @@ def main():
             print("Max size argument must be greater than 0.", file=sys.stderr)
             return 1
 
-        with cache.lock, cache.configuration as cfg:
+        with cache.configuration.lock, cache.configuration as cfg:
             cfg.setMaximumCacheSize(maxSizeValue)
         return 0
 
+    if options.eviction_policy is not None:
+        with cache.configuration.lock, cache.configuration as cfg:
+            cfg.setEvictionPolicy(options.eviction_policy)
+        return 0
+
 
     compiler = options.compiler or findCompilerBinary()
     if not (compiler and os.access(compiler, os.F_OK)):
@@ -1629,16 +1265,17 @@ def main():
 
 
 def updateCacheStatistics(cache, method):
-    with cache.statistics.lock, cache.statistics as stats:
+    with cache.statistics.delta() as stats:
         method(stats)
+        CacheLock.flushStatistics(stats)
+
 
 def printOutAndErr(out, err):
-    printBinary(sys.stdout, out.encode(CL_DEFAULT_CODEC))
-    printBinary(sys.stderr, err.encode(CL_DEFAULT_CODEC))
+    if out:
+        printBinary(sys.stdout, out)
+    if err:
+        printBinary(sys.stderr, err)
 
-def printErrStr(message):
-    with OUTPUT_LOCK:
-        print(message, file=sys.stderr)
 
 def processCompileRequest(cache, compiler, args):
     printTraceStatement("Parsing given commandline '{0!s}'".format(args))
@@ -1674,10 +1311,11 @@ def processCompileRequest(cache, compiler, args):
         printTraceStatement("Cannot cache invocation as {}: called for preprocessing".format(cmdLine))
         updateCacheStatistics(cache, Statistics.registerCallForPreprocessing)
 
-    exitCode, out, err = invokeRealCompiler(compiler, args)
+    exitCode, out, err = invokeRealCompiler(compiler, args, outputAsString=False)
     printOutAndErr(out, err)
     return exitCode
 
+
 def filterSourceFiles(cmdLine: List[str], sourceFiles: List[Tuple[str, str]]) -> Iterator[str]:
     setOfSources = set(sourceFile for sourceFile, _ in sourceFiles)
     skippedArgs = ('/Tc', '/Tp', '-Tp', '-Tc')
@@ -1686,6 +1324,7 @@ def filterSourceFiles(cmdLine: List[str], sourceFiles: List[Tuple[str, str]]) ->
         if not (arg in setOfSources or arg.startswith(skippedArgs))
     )
 
+
 def scheduleJobs(cache: Any, compiler: str, cmdLine: List[str], environment: Any,
                  sourceFiles: List[Tuple[str, str]], objectFiles: List[str]) -> int:
     # Filter out all source files from the command line to form baseCmdLine
@@ -1693,7 +1332,9 @@ def scheduleJobs(cache: Any, compiler: str, cmdLine: List[str], environment: Any
 
     exitCode = 0
     cleanupRequired = False
-    with concurrent.futures.ThreadPoolExecutor(max_workers=jobCount(cmdLine)) as executor:
+    # The statistics updates of all jobs are journaled together once they are done
+    with cache.statistics.batch(), \
+         concurrent.futures.ThreadPoolExecutor(max_workers=jobCount(cmdLine)) as executor:
         jobs = []
         for (srcFile, srcLanguage), objFile in zip(sourceFiles, objectFiles):
             jobCmdLine = baseCmdLine + [srcLanguage + srcFile]
@@ -1710,10 +1351,11 @@ def scheduleJobs(cache: Any, compiler: str, cmdLine: List[str], environment: Any
                 break
 
     if cleanupRequired:
-        cleanCache(cache)
+        triggerEviction(cache)
 
     return exitCode
 
+
 def processSingleSource(compiler, cmdLine, sourceFile, objectFile, environment):
     try:
         assert objectFile is not None
@@ -1725,96 +1367,146 @@ def processSingleSource(compiler, cmdLine, sourceFile, objectFile, environment):
             return processDirect(cache, objectFile, compiler, cmdLine, sourceFile)
 
     except IncludeNotFoundException:
-        return invokeRealCompiler(compiler, cmdLine, environment=environment), False
+        return invokeRealCompiler(compiler, cmdLine, outputAsString=False, environment=environment) + (False,)
+    except CacheLockException as e:
+        printTraceStatement("Bypassing the cache for {}: {}".format(sourceFile, e))
+        return invokeRealCompiler(compiler, cmdLine, outputAsString=False, environment=environment) + (False,)
     except CompilerFailedException as e:
         return e.getReturnTuple()
 
+
+def lookUpManifest(cache, manifestHash, legacyManifestHash=None):
+    """Returns the cache key of the manifest entry matching the current
+    include files, or None, together with the statistics function to register
+    a miss with if no cache entry can be used. If there is no manifest,
+    legacyManifestHash() returns the hash of a JSON manifest to migrate.
+
+    Manifests are replaced atomically and hits are appended to their hit log,
+    so the manifest is only locked for migrating it."""
+    includeHashes = IncludeHashes(cache.fileHashCache)
+    manifest = cache.getManifest(manifestHash)
+    if not manifest and legacyManifestHash is not None:
+        with cache.manifestLockFor(manifestHash):
+            manifest = cache.getManifest(manifestHash) or \
+                       cache.migrateLegacyManifest(legacyManifestHash(), manifestHash, includeHashes.hashFor)
+    if not manifest:
+        return None, Statistics.registerSourceChangedMiss
+
+    # NOTE: command line options already included in hash for manifest name
+    entryIndex = manifest.findEntryByStat(includeHashes.statFingerprint)
+    statFingerprintMatched = entryIndex is not None
+    if not statFingerprintMatched:
+        entryIndex = manifest.findEntry(includeHashes.hashFor, includeHashes.prefetch)
+    printTraceStatement("Looked up manifest {}: computed {} include file hashes, reused {}".format(
+        manifestHash, includeHashes.numComputed, includeHashes.numReused))
+    if entryIndex is None:
+        return None, Statistics.registerHeaderChangedMiss
+
+    entry = manifest.entries()[entryIndex]
+    cachekey = entry.objectHash
+    assert cachekey is not None
+    statFingerprint = None
+    if not statFingerprintMatched:
+        # Include files were touched but not changed, remember their new state
+        statFingerprint = includeHashes.statFingerprint(entry.includeFiles)
+        if statFingerprint == entry.statFingerprint:
+            statFingerprint = None
+    if entryIndex > 0 or statFingerprint is not None:
+        # Move manifest entry to the top of the entries in the manifest
+        cache.touchManifest(manifestHash, manifest, cachekey, statFingerprint)
+    return cachekey, Statistics.registerHeaderChangedMiss
+
+
 def processDirect(cache, objectFile, compiler, cmdLine, sourceFile):
     manifestHash = ManifestRepository.getManifestHash(compiler, cmdLine, sourceFile)
-    manifestHit = None
-    with cache.manifestLockFor(manifestHash):
-        manifest = cache.getManifest(manifestHash)
-        if manifest:
-            for entryIndex, entry in enumerate(manifest.entries()):
-                # NOTE: command line options already included in hash for manifest name
-                try:
-                    includesContentHash = ManifestRepository.getIncludesContentHashForFiles(
-                        [expandBasedirPlaceholder(path) for path in entry.includeFiles])
-
-                    if entry.includesContentHash == includesContentHash:
-                        cachekey = entry.objectHash
-                        assert cachekey is not None
-                        if entryIndex > 0:
-                            # Move manifest entry to the top of the entries in the manifest
-                            manifest.touchEntry(cachekey)
-                            cache.setManifest(manifestHash, manifest)
-
-                        manifestHit = True
-                        with cache.lockFor(cachekey):
-                            if cache.hasEntry(cachekey):
-                                return processCacheHit(cache, objectFile, cachekey)
-
-                except IncludeNotFoundException:
-                    pass
+    cachekey, unusableManifestMissReason = lookUpManifest(
+        cache, manifestHash, lambda: ManifestRepository.getLegacyManifestHash(compiler, cmdLine, sourceFile))
+    manifestHit = cachekey is not None
 
-            unusableManifestMissReason = Statistics.registerHeaderChangedMiss
-        else:
-            unusableManifestMissReason = Statistics.registerSourceChangedMiss
+    if manifestHit and cache.hasEntry(cachekey):
+        hitResult = processCacheHit(cache, objectFile, cachekey)
+        if hitResult is not None:
+            return hitResult
+        unusableManifestMissReason = Statistics.registerEvictedMiss
 
-    if manifestHit is None:
+    if not manifestHit:
         stripIncludes = False
         if '/showIncludes' not in cmdLine:
             cmdLine = list(cmdLine)
             cmdLine.insert(0, '/showIncludes')
             stripIncludes = True
+    start = time.perf_counter()
     compilerResult = invokeRealCompiler(compiler, cmdLine, captureOutput=True)
-    if manifestHit is None:
+    compileTime = time.perf_counter() - start
+    if not manifestHit:
         includePaths, compilerOutput = parseIncludesSet(compilerResult[1], sourceFile, stripIncludes)
         compilerResult = (compilerResult[0], compilerOutput, compilerResult[2])
 
-    with cache.manifestLockFor(manifestHash):
-        if manifestHit is not None:
-            return ensureArtifactsExist(cache, cachekey, unusableManifestMissReason,
-                                        objectFile, compilerResult)
+    try:
+        with cache.manifestLockFor(manifestHash):
+            if manifestHit:
+                return ensureArtifactsExist(cache, cachekey, unusableManifestMissReason,
+                                            objectFile, compilerResult, compileTime)
 
-        entry = createManifestEntry(manifestHash, includePaths)
-        cachekey = entry.objectHash
+            entry = createManifestEntry(manifestHash, includePaths, cache.fileHashCache)
+            cachekey = entry.objectHash
 
-        def addManifest():
-            manifest = cache.getManifest(manifestHash) or Manifest()
-            manifest.addEntry(entry)
-            cache.setManifest(manifestHash, manifest)
+            def addManifest():
+                manifest = cache.getManifest(manifestHash) or Manifest()
+                manifest.addEntry(entry)
+                cache.setManifest(manifestHash, manifest)
 
-        return ensureArtifactsExist(cache, cachekey, unusableManifestMissReason,
-                                    objectFile, compilerResult, addManifest)
+            return ensureArtifactsExist(cache, cachekey, unusableManifestMissReason,
+                                        objectFile, compilerResult, compileTime, addManifest)
+    except CacheLockException as e:
+        # Don't run the compiler again just because its result can't be stored
+        printTraceStatement("Not caching the object file for {}: {}".format(sourceFile, e))
+        return jobResult(compilerResult)
 
 
 def processNoDirect(cache, objectFile, compiler, cmdLine, environment):
     cachekey = CompilerArtifactsRepository.computeKeyNodirect(compiler, cmdLine, environment)
-    with cache.lockFor(cachekey):
-        if cache.hasEntry(cachekey):
-            return processCacheHit(cache, objectFile, cachekey)
-
+    missReason = Statistics.registerCacheMiss
+    if cache.hasEntry(cachekey):
+        hitResult = processCacheHit(cache, objectFile, cachekey)
+        if hitResult is not None:
+            return hitResult
+        missReason = Statistics.registerEvictedMiss
+
+    start = time.perf_counter()
     compilerResult = invokeRealCompiler(compiler, cmdLine, captureOutput=True, environment=environment)
+    compileTime = time.perf_counter() - start
 
-    return ensureArtifactsExist(cache, cachekey, Statistics.registerCacheMiss,
-                                objectFile, compilerResult)
+    return ensureArtifactsExist(cache, cachekey, missReason, objectFile, compilerResult, compileTime)
 
 
-def ensureArtifactsExist(cache, cachekey, reason, objectFile, compilerResult, extraCallable=None):
+def ensureArtifactsExist(cache, cachekey, reason, objectFile, compilerResult, compileTime=0.0, extraCallable=None):
     cleanupRequired = False
     returnCode, compilerOutput, compilerStderr = compilerResult
     correctCompiliation = (returnCode == 0 and os.path.exists(objectFile))
-    with cache.lockFor(cachekey):
-        if not cache.hasEntry(cachekey):
-            with cache.statistics.lock, cache.statistics as stats:
-                reason(stats)
-                if correctCompiliation:
-                    artifacts = CompilerArtifacts(objectFile, compilerOutput, compilerStderr)
-                    cleanupRequired = addObjectToCache(stats, cache, cachekey, artifacts)
-            if extraCallable and correctCompiliation:
-                extraCallable()
-    return returnCode, compilerOutput, compilerStderr, cleanupRequired
+    try:
+        with cache.maintenanceLock.shared(), cache.lockFor(cachekey):
+            if not cache.hasEntry(cachekey):
+                with cache.statistics.delta() as stats:
+                    reason(stats)
+                    cache.fileHashCache.flushStatistics(stats)
+                    CacheLock.flushStatistics(stats)
+                    if correctCompiliation:
+                        artifacts = CompilerArtifacts(objectFile, storedConsoleOutput(compilerOutput),
+                                                      storedConsoleOutput(compilerStderr), compileTime=compileTime)
+                        cleanupRequired = addObjectToCache(stats, cache, cachekey, artifacts)
+                if extraCallable and correctCompiliation:
+                    extraCallable()
+    except CacheLockException as e:
+        printTraceStatement("Not caching the object file for {}: {}".format(cachekey, e))
+    return jobResult(compilerResult, cleanupRequired)
+
+
+def jobResult(compilerResult, cleanupRequired=False):
+    """Returns the result of a job processing a source file, given the
+    result of invoking the compiler for it"""
+    returnCode, compilerOutput, compilerStderr = compilerResult
+    return returnCode, compilerOutput.encode(CL_DEFAULT_CODEC), compilerStderr.encode(CL_DEFAULT_CODEC), cleanupRequired
 
 
 if __name__ == '__main__':
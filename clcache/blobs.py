@@ -0,0 +1,101 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+import os
+import threading
+
+from .utils import childDirectories, ensureDirectoryExists
+from .hashing import getFileHash
+from .entries import CompilerArtifacts, readCacheEntry, writeCacheEntry
+
+
+class BlobStore:
+    """ Stores object files by the hash of their contents, such that cache
+    entries with identical object files share a single copy.
+
+    Every blob is a file <hash>.blob holding the object file as a cache entry
+    for the key <hash> with empty output. Cache entries using a blob have a
+    hard link <key>.object to it, so the links are the reference count of a
+    blob; once clean() finds a blob with no links left, it removes the blob.
+    If the file system doesn't support hard links, cache entries hold their
+    object files themselves.
+
+    Object files are only stored as blobs if CLCACHE_DEDUP is set, since
+    hashing and linking every object file slows down storing entries while
+    most builds produce few identical object files. Blobs stored earlier are
+    used and cleaned up either way. """
+    BLOB_SUFFIX = '.blob'
+
+    def __init__(self, blobsRootDir):
+        self._blobsRootDir = blobsRootDir
+        self.linksSupported = True
+        self.objectsSize = 0
+        self.storedSize = 0
+
+    def blobPath(self, digest):
+        return os.path.join(self._blobsRootDir, digest[:2], digest + BlobStore.BLOB_SUFFIX)
+
+    def addBlob(self, objectFilePath, compressionPolicy):
+        """Returns the hash of the blob holding the given object file, the
+        CompilerArtifacts locating the object file in it and whether the blob
+        was created"""
+        digest = getFileHash(objectFilePath)
+        blobPath = self.blobPath(digest)
+        try:
+            with open(blobPath, 'rb') as f:
+                return digest, readCacheEntry(f, blobPath, digest), False
+        except (FileNotFoundError, ValueError):
+            pass
+
+        ensureDirectoryExists(os.path.dirname(blobPath))
+        tempBlobPath = '{}.{}.{}.new'.format(blobPath, os.getpid(), threading.get_ident())
+        with open(tempBlobPath, 'w+b') as f:
+            writeCacheEntry(f, digest, CompilerArtifacts(objectFilePath, b'', b''), compressionPolicy)
+            blob = readCacheEntry(f, blobPath, digest)
+        os.replace(tempBlobPath, blobPath)
+        return digest, blob, True
+
+    def registerObject(self, blobSize, created):
+        self.objectsSize += blobSize
+        if created:
+            self.storedSize += blobSize
+
+    def flushStatistics(self, stats):
+        stats.registerDeduplication(self.objectsSize, self.storedSize)
+        self.objectsSize = 0
+        self.storedSize = 0
+
+    def blobs(self):
+        """Yields the hash and os.stat() result of every blob"""
+        if not os.path.isdir(self._blobsRootDir):
+            return
+        for path in childDirectories(self._blobsRootDir):
+            for name in os.listdir(path):
+                if name.endswith(BlobStore.BLOB_SUFFIX):
+                    try:
+                        yield name[:-len(BlobStore.BLOB_SUFFIX)], os.stat(os.path.join(path, name))
+                    except OSError:
+                        pass
+
+    def removeBlob(self, digest):
+        """Removes the blob unless a cache entry still links to it. Returns
+        whether the blob is gone."""
+        blobPath = self.blobPath(digest)
+        try:
+            if os.stat(blobPath).st_nlink > 1:
+                return False
+            os.remove(blobPath)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+        return True
+
+    def clean(self):
+        """Removes the blobs no cache entry links to anymore"""
+        for digest, _ in list(self.blobs()):
+            self.removeBlob(digest)
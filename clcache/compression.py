@@ -0,0 +1,130 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from collections import namedtuple
+import os
+import time
+import zlib
+
+from .utils import LogicException
+
+
+# Codecs for compressing the object files stored in cache entries, by name.
+# The tag of the codec is stored in every entry, so a cache can hold entries
+# written with different codecs. `highLevel` is the level used once the cache
+# is almost full. The objects returned by `compressor(level)` and
+# `decompressor()` provide the interface of zlib's compressobj() and
+# decompressobj().
+CompressionCodec = namedtuple('CompressionCodec',
+                              ['tag', 'defaultLevel', 'highLevel', 'compressor', 'decompressor'])
+NO_COMPRESSION_CODEC = CompressionCodec(0, 0, 0, None, None)
+COMPRESSION_CODECS = {
+    'none': NO_COMPRESSION_CODEC,
+    'gzip': CompressionCodec(1, 6, 9, lambda level: zlib.compressobj(level, zlib.DEFLATED, 31),
+                             lambda: zlib.decompressobj(31)),
+}
+OPTIONAL_COMPRESSION_CODEC_PACKAGES = {'zstd': 'zstandard', 'lz4': 'lz4'}
+try:
+    import zstandard # pylint: disable=wrong-import-position
+    COMPRESSION_CODECS['zstd'] = CompressionCodec(2, 3, 12,
+                                                  lambda level: zstandard.ZstdCompressor(level).compressobj(),
+                                                  lambda: zstandard.ZstdDecompressor().decompressobj())
+except ImportError:
+    pass
+try:
+    import lz4.frame # pylint: disable=wrong-import-position
+
+    class Lz4Compressor:
+        def __init__(self, level):
+            self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+            self.header = self.compressor.begin()
+
+        def compress(self, data):
+            header, self.header = self.header, b''
+            return header + self.compressor.compress(data)
+
+        def flush(self):
+            header, self.header = self.header, b''
+            return header + self.compressor.flush()
+
+    class Lz4Decompressor(lz4.frame.LZ4FrameDecompressor):
+        def flush(self):
+            return b''
+
+    COMPRESSION_CODECS['lz4'] = CompressionCodec(3, 0, 9, Lz4Compressor, Lz4Decompressor)
+except ImportError:
+    pass
+COMPRESSION_CODECS_BY_TAG = {codec.tag: codec for codec in COMPRESSION_CODECS.values()}
+
+# Object files smaller than this are stored uncompressed, since compressing
+# them saves little space but still costs CPU time.
+COMPRESSION_MIN_SIZE = 4 * 1024
+# The start of every object file is compressed as a sample first. If the sample
+# doesn't shrink below this ratio, the object file is stored uncompressed.
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MAX_RATIO = 0.9
+# Once the cache is filled to this fraction of its maximum size, object files
+# are compressed using the high level of the codec.
+COMPRESSION_HIGH_LEVEL_CACHE_USAGE = 0.8
+
+
+def compressionCodec():
+    """Returns the codec and level for compressing object files selected by
+    CLCACHE_COMPRESS and CLCACHE_COMPRESSLEVEL"""
+    name = os.environ.get('CLCACHE_COMPRESS', 'none')
+    if name in OPTIONAL_COMPRESSION_CODEC_PACKAGES and name not in COMPRESSION_CODECS:
+        raise LogicException('Compression codec {} in CLCACHE_COMPRESS requires the {} package'.format(
+            name, OPTIONAL_COMPRESSION_CODEC_PACKAGES[name]))
+    # Any other value enables gzip compression like earlier versions did
+    codec = COMPRESSION_CODECS.get(name, COMPRESSION_CODECS['gzip'])
+    if "CLCACHE_COMPRESSLEVEL" in os.environ:
+        return codec, int(os.environ["CLCACHE_COMPRESSLEVEL"])
+    return codec, codec.defaultLevel
+
+
+class CompressionPolicy:
+    """ Decides for every object file put into the cache whether and at which
+    level it is compressed using the codec selected by CLCACHE_COMPRESS, and
+    accumulates the resulting sizes and CPU time until they are flushed to the
+    statistics. """
+    def __init__(self):
+        self.cacheUsage = 0.0
+        self.inputSize = 0
+        self.outputSize = 0
+        self.cpuTime = 0.0
+
+    def setCacheUsage(self, currentSize, maximumSize):
+        self.cacheUsage = currentSize / maximumSize if maximumSize > 0 else 1.0
+
+    def compressionFor(self, objectFilePath):
+        codec, level = compressionCodec()
+        if codec.compressor is None or os.path.getsize(objectFilePath) < COMPRESSION_MIN_SIZE:
+            return NO_COMPRESSION_CODEC, 0
+        if "CLCACHE_COMPRESSLEVEL" not in os.environ and self.cacheUsage >= COMPRESSION_HIGH_LEVEL_CACHE_USAGE:
+            level = codec.highLevel
+
+        with open(objectFilePath, 'rb') as f:
+            sample = f.read(COMPRESSION_SAMPLE_SIZE)
+        start = time.process_time()
+        compressor = codec.compressor(level)
+        compressedSize = len(compressor.compress(sample)) + len(compressor.flush())
+        self.cpuTime += time.process_time() - start
+        if compressedSize > len(sample) * COMPRESSION_MAX_RATIO:
+            return NO_COMPRESSION_CODEC, 0
+        return codec, level
+
+    def registerEntry(self, objectSize, storedSize, cpuTime):
+        if "CLCACHE_COMPRESS" in os.environ:
+            self.inputSize += objectSize
+            self.outputSize += storedSize
+            self.cpuTime += cpuTime
+
+    def flushStatistics(self, stats):
+        stats.registerCompression(self.inputSize, self.outputSize, self.cpuTime)
+        self.inputSize = 0
+        self.outputSize = 0
+        self.cpuTime = 0.0
@@ -0,0 +1,145 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from collections import namedtuple
+import os
+import struct
+import time
+import zlib
+
+from .utils import COPY_CHUNK_SIZE
+from .compression import COMPRESSION_CODECS_BY_TAG, NO_COMPRESSION_CODEC
+
+
+# CompilerArtifacts: the outputs of a compiler invocation
+# `objectFilePath`: path to the file holding the object file
+# `stdout`, `stderr`: console output of the compiler as bytes encoded with
+#  CACHE_COMPILER_OUTPUT_STORAGE_CODEC
+# `objectOffset`, `objectSize`: location of the object file within objectFilePath
+#  if it doesn't occupy the whole file
+# `objectCrc`: CRC32 of the object file to verify when restoring it, or None
+# `objectCodec`: tag of the codec the object file was compressed with
+# `compileTime`: seconds the real compiler took to create the artifacts, if known
+CompilerArtifacts = namedtuple('CompilerArtifacts', ['objectFilePath', 'stdout', 'stderr', 'objectOffset',
+                                                     'objectSize', 'objectCrc', 'objectCodec', 'compileTime'])
+CompilerArtifacts.__new__.__defaults__ = (0, None, None, NO_COMPRESSION_CODEC.tag, 0.0)
+
+# Cache entries are stored as a header followed by stdout, stderr and the
+# (possibly compressed) object file. The header holds the key of the entry,
+# the sizes of the three parts, the size and CRC32 of the uncompressed object
+# file, the tag of the codec used to compress it and flags:
+# magic, key digest, stdout size, stderr size, stored object file size,
+# object file size, object file CRC32, codec tag, flags
+CACHE_ENTRY_MAGIC = b'CLCE'
+CACHE_ENTRY_HEADER = struct.Struct('<4s16sIIQQIBB')
+# Flag of entries whose object file is stored in a separate file, which
+# holds it as the object file of a cache entry with empty output itself
+CACHE_ENTRY_SEPARATE_OBJECT = 0x1
+# Number of bytes read at once when reading a cache entry, such that the header
+# and the console output of most entries need a single read
+CACHE_ENTRY_READ_SIZE = 4096
+
+
+def cacheKeyDigest(key):
+    return bytes.fromhex(key)[:16]
+
+
+def packCacheEntryHeader(key, artifacts, storedSize=0, objectSize=0, objectCrc=0,
+                         codecTag=NO_COMPRESSION_CODEC.tag, flags=0):
+    return CACHE_ENTRY_HEADER.pack(CACHE_ENTRY_MAGIC, cacheKeyDigest(key), len(artifacts.stdout),
+                                   len(artifacts.stderr), storedSize, objectSize, objectCrc, codecTag, flags)
+
+
+def writeObjectFile(outFile, objectFilePath, compressionPolicy=None):
+    """Writes the object file at the current position of outFile, compressed
+    as decided by compressionPolicy. Returns the stored size, the size and
+    the CRC32 of the object file and the tag of the codec used."""
+    codec = NO_COMPRESSION_CODEC
+    if compressionPolicy is not None:
+        codec, level = compressionPolicy.compressionFor(objectFilePath)
+    compressor = codec.compressor(level) if codec.compressor is not None else None
+    storedSize = 0
+    objectSize = 0
+    objectCrc = 0
+    cpuTime = 0.0
+    with open(objectFilePath, 'rb') as objectFile:
+        for chunk in iter(lambda: objectFile.read(COPY_CHUNK_SIZE), b''):
+            objectSize += len(chunk)
+            objectCrc = zlib.crc32(chunk, objectCrc)
+            if compressor is not None:
+                start = time.process_time()
+                chunk = compressor.compress(chunk)
+                cpuTime += time.process_time() - start
+            outFile.write(chunk)
+            storedSize += len(chunk)
+    if compressor is not None:
+        chunk = compressor.flush()
+        outFile.write(chunk)
+        storedSize += len(chunk)
+    if compressionPolicy is not None:
+        compressionPolicy.registerEntry(objectSize, storedSize, cpuTime)
+    return storedSize, objectSize, objectCrc, codec.tag
+
+
+def writeCacheEntry(outFile, key, artifacts, compressionPolicy=None, separateObject=None):
+    """Writes artifacts as cache entry for key at the current position of
+    outFile, which must be seekable, and returns the size of the entry. The
+    object file is compressed as decided by compressionPolicy. If the object
+    file is stored separately already, separateObject holds the
+    CompilerArtifacts of the entry storing it and the object file isn't
+    written."""
+    entryStart = outFile.tell()
+    # The header is written again once the size of the object file is known
+    outFile.write(packCacheEntryHeader(key, artifacts))
+    outFile.write(artifacts.stdout)
+    outFile.write(artifacts.stderr)
+    if separateObject is not None:
+        header = packCacheEntryHeader(key, artifacts, separateObject.objectSize, 0, separateObject.objectCrc,
+                                      separateObject.objectCodec, CACHE_ENTRY_SEPARATE_OBJECT)
+    elif artifacts.objectFilePath is not None:
+        header = packCacheEntryHeader(key, artifacts,
+                                      *writeObjectFile(outFile, artifacts.objectFilePath, compressionPolicy))
+    else:
+        return outFile.tell() - entryStart
+    end = outFile.tell()
+    outFile.seek(entryStart)
+    outFile.write(header)
+    outFile.seek(end)
+    return end - entryStart
+
+
+def readCacheEntry(inFile, path, key, offset=0):
+    """Reads the cache entry for key at offset of inFile, which was opened
+    from path. The object file is not read but located by the returned
+    CompilerArtifacts. If it is stored separately, the `objectFilePath` of
+    the result is None and `objectOffset` its offset in the separate file.
+    Raises ValueError if there is no valid entry."""
+    inFile.seek(offset)
+    data = inFile.read(CACHE_ENTRY_READ_SIZE)
+    if len(data) < CACHE_ENTRY_HEADER.size:
+        raise ValueError("cache entry in {} is truncated".format(path))
+    magic, keyDigest, stdoutSize, stderrSize, storedSize, _, objectCrc, codecTag, flags = \
+        CACHE_ENTRY_HEADER.unpack_from(data)
+    if magic != CACHE_ENTRY_MAGIC or keyDigest != cacheKeyDigest(key):
+        raise ValueError("{} holds no cache entry for {}".format(path, key))
+    if codecTag not in COMPRESSION_CODECS_BY_TAG:
+        raise ValueError("cache entry in {} uses an unavailable compression codec".format(path))
+
+    objectOffset = CACHE_ENTRY_HEADER.size + stdoutSize + stderrSize
+    inlineSize = storedSize if not flags & CACHE_ENTRY_SEPARATE_OBJECT else 0
+    if len(data) < objectOffset:
+        data += inFile.read(objectOffset - len(data))
+    if len(data) < objectOffset or os.fstat(inFile.fileno()).st_size < offset + objectOffset + inlineSize:
+        raise ValueError("cache entry in {} is truncated".format(path))
+
+    stdoutEnd = CACHE_ENTRY_HEADER.size + stdoutSize
+    stdout = data[CACHE_ENTRY_HEADER.size:stdoutEnd]
+    stderr = data[stdoutEnd:objectOffset]
+    if flags & CACHE_ENTRY_SEPARATE_OBJECT:
+        # The separate file holds the object file as entry with empty output
+        return CompilerArtifacts(None, stdout, stderr, CACHE_ENTRY_HEADER.size, storedSize, objectCrc, codecTag)
+    return CompilerArtifacts(path, stdout, stderr, offset + objectOffset, storedSize, objectCrc, codecTag)
@@ -0,0 +1,250 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from collections import defaultdict
+import concurrent.futures
+import errno
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from . import VERSION
+from .utils import ensureDirectoryExists, ERROR_PIPE_BUSY, filesBeneath, LogicException, NMPWAIT_WAIT_FOREVER, windll
+from .locks import CacheLock
+from .statistics import PersistentJSONDict
+
+
+# Hash algorithms which can be selected via the CLCACHE_HASH environment
+# variable. The name of the selected algorithm is part of all cache keys, such
+# that caches filled using different algorithms never collide.
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=16),
+}
+try:
+    import xxhash # pylint: disable=wrong-import-position
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+except (ImportError, AttributeError):
+    pass
+DEFAULT_HASH_ALGORITHM = 'md5'
+
+# Files are hashed in chunks of this size, such that memory usage does not
+# depend on the size of source files or preprocessor output.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Default number of threads used for hashing include files, can be
+# overridden via CLCACHE_HASH_THREADS
+DEFAULT_HASH_THREADS = 4
+
+# Files modified less than this many nanoseconds ago are not identified by
+# their size and modification time since a further modification might not
+# change either of them.
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+# Cleaning the cache trims every section of the header hash cache to this many
+# records, dropping those recorded longest ago
+MAX_HASH_CACHE_SECTION_RECORDS = 4096
+
+
+def hashAlgorithmName():
+    name = os.environ.get('CLCACHE_HASH', DEFAULT_HASH_ALGORITHM)
+    if name not in HASH_ALGORITHMS:
+        raise LogicException('Unsupported hash algorithm {} in CLCACHE_HASH, available algorithms: {}'.format(
+            name, ', '.join(sorted(HASH_ALGORITHMS))))
+    return name
+
+
+def createHasher(data=b''):
+    return HASH_ALGORITHMS[hashAlgorithmName()](data)
+
+
+def getCompilerHash(compilerBinary):
+    stat = os.stat(compilerBinary)
+    data = '|'.join([
+        str(stat.st_mtime),
+        str(stat.st_size),
+        VERSION,
+        ])
+    hasher = createHasher()
+    hasher.update(data.encode("UTF-8"))
+    return hasher.hexdigest()
+
+
+def getFileHashes(filePaths, hashCache=None):
+    if 'CLCACHE_SERVER' in os.environ:
+        pipeName = r'\\.\pipe\clcache_srv'
+        while True:
+            try:
+                with open(pipeName, 'w+b') as f:
+                    f.write('\n'.join(filePaths).encode('utf-8'))
+                    f.write(b'\x00')
+                    response = f.read()
+                    if response.startswith(b'!'):
+                        raise pickle.loads(response[1:-1])
+                    return response[:-1].decode('utf-8').splitlines()
+            except OSError as e:
+                if e.errno == errno.EINVAL and windll.kernel32.GetLastError() == ERROR_PIPE_BUSY:
+                    windll.kernel32.WaitNamedPipeW(pipeName, NMPWAIT_WAIT_FOREVER)
+                else:
+                    raise
+    elif hashCache is not None:
+        try:
+            return hashInThreadPool(hashCache.getFileHash, filePaths)
+        finally:
+            hashCache.save()
+    else:
+        return hashInThreadPool(getFileHash, filePaths)
+
+
+def hashThreadCount():
+    return max(1, int(os.environ.get('CLCACHE_HASH_THREADS', DEFAULT_HASH_THREADS)))
+
+
+def hashInThreadPool(hashFunction, filePaths):
+    # Hashing headers is mostly waiting for I/O, so hash multiple files at
+    # once. Results are returned in the order of filePaths; if hashing fails
+    # for any file, the exception for the first such file is raised.
+    threadCount = hashThreadCount()
+    if threadCount == 1 or len(filePaths) <= threadCount:
+        return [hashFunction(filePath) for filePath in filePaths]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threadCount) as executor:
+        return list(executor.map(hashFunction, filePaths))
+
+
+def updateHasherFromFile(hasher, inFile):
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        bytesRead = inFile.readinto(buf)
+        if not bytesRead:
+            break
+        hasher.update(view[:bytesRead])
+
+
+def getFileHash(filePath, additionalData=None):
+    hasher = createHasher()
+    with open(filePath, 'rb', buffering=0) as inFile:
+        updateHasherFromFile(hasher, inFile)
+    if additionalData is not None:
+        # Encoding of this additional data does not really matter
+        # as long as we keep it fixed, otherwise hashes change.
+        # The string should fit into ASCII, so UTF8 should not change anything
+        hasher.update(additionalData.encode("UTF-8"))
+    return hasher.hexdigest()
+
+
+def getStringHash(dataString):
+    hasher = createHasher()
+    hasher.update(dataString.encode("UTF-8"))
+    return hasher.hexdigest()
+
+
+def modifiedRecently(stat):
+    return int(time.time() * 1000 * 1000 * 1000) - stat.st_mtime_ns <= RACY_INTERVAL_NS
+
+
+class FileHashCache: # pylint: disable=too-many-instance-attributes
+    """ Persistent cache of file hashes which is shared by all clcache
+    processes using the same cache directory. Hashes are keyed by the
+    normalized path and the size, modification time and file ID of a file, so
+    a file is only hashed again after it was modified. Files which were
+    modified recently are not recorded. Every record also holds the time it
+    was recorded, which trim() uses to keep the cache from growing
+    indefinitely. """
+
+    def __init__(self, hashCacheRootDir):
+        self._hashCacheRootDir = hashCacheRootDir
+        self._sections = {}
+        self._newRecords = defaultdict(dict)
+        # Protects the members above, getFileHash() may be called from
+        # multiple threads concurrently
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def sectionPath(self, sectionName):
+        return os.path.join(self._hashCacheRootDir, hashAlgorithmName(), sectionName + ".json")
+
+    def _section(self, sectionName):
+        records = self._sections.get(sectionName)
+        if records is None:
+            sectionPath = self.sectionPath(sectionName)
+            with CacheLock.forPath(sectionPath):
+                records = PersistentJSONDict(sectionPath)
+            self._sections[sectionName] = records
+        return records
+
+    def getFileHash(self, filePath):
+        normalizedPath = os.path.normcase(os.path.abspath(filePath))
+        stat = os.stat(filePath)
+        fingerprint = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+        sectionName = getStringHash(normalizedPath)[:2]
+        with self._lock:
+            records = self._section(sectionName)
+            if normalizedPath in records and records[normalizedPath][:3] == fingerprint:
+                self.hits += 1
+                return records[normalizedPath][3]
+            self.misses += 1
+
+        hashsum = getFileHash(filePath)
+        if not modifiedRecently(stat):
+            with self._lock:
+                records[normalizedPath] = fingerprint + [hashsum, time.time()]
+                self._newRecords[sectionName][normalizedPath] = records[normalizedPath]
+        return hashsum
+
+    def save(self):
+        if not self._newRecords:
+            return
+        for sectionName, newRecords in self._newRecords.items():
+            sectionPath = self.sectionPath(sectionName)
+            ensureDirectoryExists(os.path.dirname(sectionPath))
+            with CacheLock.forPath(sectionPath):
+                # Merge with the records other processes stored in the meantime
+                records = PersistentJSONDict(sectionPath)
+                for path, record in newRecords.items():
+                    records[path] = record
+                records.save()
+            self._sections[sectionName] = records
+        self._newRecords.clear()
+
+    @staticmethod
+    def _isStale(path, record):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return True
+        return record[:3] != [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def trim(self, maxSectionRecords=MAX_HASH_CACHE_SECTION_RECORDS):
+        """Removes the records of files which were removed or modified since,
+        and then the records recorded longest ago from every section holding
+        more than maxSectionRecords"""
+        for sectionPath in list(filesBeneath(self._hashCacheRootDir)):
+            if not sectionPath.endswith(".json"):
+                continue
+            with CacheLock.forPath(sectionPath):
+                records = PersistentJSONDict(sectionPath)
+                stalePaths = [path for path, record in records.items() if self._isStale(path, record)]
+                for path in stalePaths:
+                    del records[path]
+                # Records written before they included the time count as oldest
+                byAge = sorted(records.items(), key=lambda item: item[1][4] if len(item[1]) > 4 else 0)
+                for path, _ in byAge[:max(0, len(byAge) - maxSectionRecords)]:
+                    del records[path]
+                records.save()
+        self._sections.clear()
+
+    def flushStatistics(self, stats):
+        stats.registerHashCacheHits(self.hits)
+        stats.registerHashCacheMisses(self.misses)
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,245 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+import os
+import sqlite3
+import time
+
+from .utils import DEFAULT_EVICTION_POLICY, printTraceStatement
+
+
+class CacheIndex:
+    """ Records the size, insertion time, time of the last hit and number of
+    hits of every manifest and cache entry in an SQLite database, such that
+    cleaning the cache is a query instead of a walk over the whole cache
+    directory. Blobs holding the object files of several entries are recorded
+    as well, and entries refer to the blob they use.
+
+    Cache entries also record the time it took to compile them and their
+    GreedyDual-Size-Frequency priority: the inflation value L plus hits times
+    compile time per byte. Removing an entry raises L to its priority, so
+    entries which aren't hit anymore age relative to new and hit ones.
+
+    The database is used in WAL mode, so updating it doesn't block concurrent
+    readers. Cache hits don't write to the database at all: they are appended
+    to a log which is applied in a single transaction before entries are
+    evicted. If updating the index fails, or it doesn't exist yet, it is
+    marked incomplete and rebuilt from the cache directory by the next
+    clean(). """
+    MANIFEST = 'manifest'
+    OBJECT = 'object'
+    BLOB = 'blob'
+    # Databases of other versions are recreated, and thus rebuilt
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            inserted REAL NOT NULL,
+            lastHit REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            blob TEXT,
+            cost REAL NOT NULL DEFAULT 0,
+            priority REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS entriesByLastHit ON entries (kind, lastHit);
+        CREATE INDEX IF NOT EXISTS entriesByHits ON entries (kind, hits, lastHit);
+        CREATE INDEX IF NOT EXISTS entriesByPriority ON entries (kind, priority, lastHit);
+        CREATE INDEX IF NOT EXISTS entriesByBlob ON entries (blob) WHERE blob IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value);
+    """
+    INFLATION = "COALESCE((SELECT value FROM properties WHERE name = 'inflation'), 0)"
+    # Columns ordering entries by each eviction policy, the first to evict first
+    EVICTION_ORDER = {
+        'lru': ('lastHit', 'inserted', 'key'),
+        'lfu': ('hits', 'lastHit', 'inserted', 'key'),
+        'gdsf': ('priority', 'lastHit', 'inserted', 'key'),
+    }
+    # Size of the hit log after which recording a hit applies it
+    MAX_HIT_LOG_SIZE = 1024 * 1024
+
+    def __init__(self, indexPath, clock=time.time):
+        self._indexPath = indexPath
+        self._clock = clock
+        self._connection = None
+        self._hitLogPath = indexPath + ".hits"
+
+    def _connect(self):
+        if self._connection is None:
+            timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
+            connection = sqlite3.connect(self._indexPath, timeout=timeoutMs / 1000, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            if connection.execute('PRAGMA user_version').fetchone()[0] != CacheIndex.SCHEMA_VERSION:
+                connection.executescript('DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS properties;')
+                connection.execute('PRAGMA user_version = {}'.format(CacheIndex.SCHEMA_VERSION))
+            connection.executescript(CacheIndex.SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _update(self, statements):
+        """Executes the statements in a single transaction. If this fails,
+        the index is marked incomplete instead of failing the compilation."""
+        try:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                for sql, parameters in statements:
+                    connection.executemany(sql, parameters)
+        except sqlite3.Error as e:
+            printTraceStatement("Failed to update cache index {}: {}".format(self._indexPath, e))
+            self._setComplete(False)
+
+    def _setComplete(self, complete):
+        try:
+            self._connect().execute("INSERT OR REPLACE INTO properties VALUES ('complete', ?)", (int(complete),))
+        except sqlite3.Error:
+            pass
+
+    def isComplete(self):
+        try:
+            row = self._connect().execute("SELECT value FROM properties WHERE name = 'complete'").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] == 1
+
+    def addEntry(self, kind, key, size, blob=None, cost=0.0):
+        now = self._clock()
+        self._update([
+            ('INSERT OR IGNORE INTO entries (kind, key, size, inserted, lastHit, blob) VALUES (?, ?, ?, ?, ?, ?)',
+             [(kind, key, size, now, now, blob)]),
+            ('UPDATE entries SET size = ?, lastHit = ?, blob = ?, cost = ?, '
+             'priority = {} + (hits + 1) * ? / MAX(?, 1) WHERE kind = ? AND key = ?'.format(CacheIndex.INFLATION),
+             [(size, now, blob, cost, float(cost), size, kind, key)]),
+        ])
+
+    def setEntrySize(self, kind, key, size):
+        self._update([('UPDATE entries SET size = ? WHERE kind = ? AND key = ?', [(size, kind, key)])])
+
+    def registerHit(self, kind, key):
+        self._update([('UPDATE entries SET lastHit = ?, hits = hits + 1, '
+                       'priority = {} + (hits + 2) * cost / MAX(size, 1) '
+                       'WHERE kind = ? AND key = ?'.format(CacheIndex.INFLATION),
+                       [(self._clock(), kind, key)])])
+
+    def recordHit(self, kind, key):
+        """Like registerHit(), but only appends the hit to the hit log, such
+        that cache hits neither write to nor wait for the database. The log
+        is applied by applyHits(), or right away once it exceeds
+        MAX_HIT_LOG_SIZE."""
+        try:
+            with open(self._hitLogPath, 'a') as hitLog:
+                hitLog.write('{} {} {!r}\n'.format(kind, key, self._clock()))
+                hitLogSize = hitLog.tell()
+        except OSError as e:
+            printTraceStatement("Failed to record hit of {} in {}: {}".format(key, self._hitLogPath, e))
+            return
+        if hitLogSize > CacheIndex.MAX_HIT_LOG_SIZE:
+            self.applyHits()
+
+    def applyHits(self):
+        """Applies the hits appended to the hit log by recordHit() to the
+        index. The log is moved aside first, so hits recorded meanwhile go to
+        a new log."""
+        pendingHitLogPath = self._hitLogPath + ".pending"
+        try:
+            # A log moved aside by a process which failed to apply it is applied first
+            if not os.path.exists(pendingHitLogPath):
+                os.replace(self._hitLogPath, pendingHitLogPath)
+            with open(pendingHitLogPath, 'r') as hitLog:
+                lines = hitLog.read().split('\n')
+        except OSError:
+            return
+
+        hits = {}
+        for line in lines:
+            fields = line.split(' ')
+            try:
+                kind, key, hitTime = fields[0], fields[1], float(fields[2])
+            except (IndexError, ValueError):
+                # Not completely written
+                continue
+            count, lastHit = hits.get((kind, key), (0, hitTime))
+            hits[(kind, key)] = (count + 1, max(lastHit, hitTime))
+        self._update([('UPDATE entries SET lastHit = MAX(lastHit, ?), hits = hits + ?, '
+                       'priority = {} + (hits + ? + 1) * cost / MAX(size, 1) '
+                       'WHERE kind = ? AND key = ?'.format(CacheIndex.INFLATION),
+                       [(lastHit, count, count, kind, key) for (kind, key), (count, lastHit) in hits.items()])])
+        try:
+            os.remove(pendingHitLogPath)
+        except OSError:
+            pass
+
+    def removeEntries(self, kind, keys):
+        keys = [(kind, key) for key in keys]
+        statements = [('DELETE FROM entries WHERE kind = ? AND key = ?', keys)]
+        if kind == CacheIndex.OBJECT:
+            statements.insert(0, ("INSERT OR REPLACE INTO properties SELECT 'inflation', MAX(priority, {}) "
+                                  "FROM entries WHERE kind = ? AND key = ?".format(CacheIndex.INFLATION), keys))
+        self._update(statements)
+
+    def rebuild(self, entries, since=None):
+        """Replaces the contents of the index by the given (kind, key, size,
+        lastHit, blob) tuples and marks it complete. Entries recorded already
+        keep their hits and compile time, and logged hits are applied. Entries
+        inserted at or after the time since, i.e. while the given entries were
+        collected, are kept even if they are not among them."""
+        scanned = 'FROM scanned WHERE scanned.kind = entries.kind AND scanned.key = entries.key'
+        since = float('inf') if since is None else since
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN')
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS scanned '
+                               '(kind TEXT, key TEXT, size INTEGER, lastHit REAL, blob TEXT, PRIMARY KEY (kind, key))')
+            connection.execute('DELETE FROM scanned')
+            connection.executemany('INSERT OR REPLACE INTO scanned VALUES (?, ?, ?, ?, ?)', entries)
+            connection.execute('DELETE FROM entries WHERE inserted < ? AND NOT EXISTS (SELECT 1 {})'.format(scanned),
+                               (since,))
+            connection.execute('UPDATE entries SET size = (SELECT size {0}), blob = (SELECT blob {0}) '
+                               'WHERE EXISTS (SELECT 1 {0})'.format(scanned))
+            connection.execute('INSERT OR IGNORE INTO entries (kind, key, size, inserted, lastHit, blob, priority) '
+                               'SELECT kind, key, size, lastHit, lastHit, blob, {} FROM scanned'
+                               .format(CacheIndex.INFLATION))
+            connection.execute('DELETE FROM scanned')
+        self._setComplete(True)
+        self.applyHits()
+
+    def entries(self, kind, reverse=False, limit=-1, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        """Returns (key, size, blob) of the entries of the kind in the order
+        the eviction policy removes them, or the reverse order"""
+        order = ', '.join('{} {}'.format(column, 'DESC' if reverse else 'ASC')
+                          for column in CacheIndex.EVICTION_ORDER[evictionPolicy])
+        return self._connect().execute(
+            'SELECT key, size, blob FROM entries WHERE kind = ? ORDER BY {} LIMIT ?'.format(order),
+            (kind, limit)).fetchall()
+
+    def totalSize(self, *kinds):
+        """Returns the size of all entries of the given kinds, or of all entries"""
+        kinds = kinds or (CacheIndex.MANIFEST, CacheIndex.OBJECT, CacheIndex.BLOB)
+        return self._connect().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries WHERE kind IN ({})'.format(','.join('?' * len(kinds))),
+            kinds).fetchone()[0]
+
+    def count(self, kind):
+        return self._connect().execute('SELECT COUNT(*) FROM entries WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def entrySize(self, kind, key):
+        row = self._connect().execute('SELECT size FROM entries WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+        return row[0] if row is not None else 0
+
+    def blobReferences(self):
+        """Returns the number of entries referring to every blob"""
+        return dict(self._connect().execute(
+            'SELECT blob, COUNT(*) FROM entries WHERE kind = ? AND blob IS NOT NULL GROUP BY blob',
+            (CacheIndex.OBJECT,)).fetchall())
@@ -0,0 +1,354 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from ctypes import wintypes
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+from .utils import ensureDirectoryExists, fcntl, LogicException, windll
+
+
+class CacheLockException(Exception):
+    pass
+
+
+class NamedMutexLockBackend:
+    """ Locks a named Win32 mutex. """
+    WAIT_ABANDONED_CODE = 0x00000080
+    WAIT_TIMEOUT_CODE = 0x00000102
+
+    def __init__(self, path):
+        self.name = 'Local\\' + path.replace(':', '-').replace('\\', '-')
+        self._mutex = None
+
+    def __del__(self):
+        if self._mutex:
+            windll.kernel32.CloseHandle(self._mutex)
+
+    def acquire(self, timeoutMs):
+        if not self._mutex:
+            self._mutex = windll.kernel32.CreateMutexW(
+                None,
+                wintypes.BOOL(False),
+                self.name)
+            assert self._mutex
+        result = windll.kernel32.WaitForSingleObject(
+            self._mutex, wintypes.INT(timeoutMs))
+        if result == self.WAIT_TIMEOUT_CODE:
+            return False
+        if result not in [0, self.WAIT_ABANDONED_CODE]:
+            raise CacheLockException('Error! WaitForSingleObject returns {result}, last error {error}'.format(
+                result=result,
+                error=windll.kernel32.GetLastError()))
+        return True
+
+    def release(self):
+        windll.kernel32.ReleaseMutex(self._mutex)
+
+
+class FileLockBackend:
+    """ Locks the file <path>.lock via flock(). Like a mutex, the lock can be
+    acquired again by the thread holding it; other threads of the process
+    wait for it just like other processes. """
+    LOCK_FILE_SUFFIX = '.lock'
+    # Longest sleep between two attempts to take the lock, in seconds
+    MAX_POLL_INTERVAL = 0.05
+
+    class State:
+        def __init__(self):
+            self.threadLock = threading.RLock()
+            self.fd = None
+            self.count = 0
+
+    # Per lock file state shared by all threads of the process
+    _states = {} # type: Dict[str, Any]
+    _statesLock = threading.Lock()
+
+    def __init__(self, path):
+        self.name = path + FileLockBackend.LOCK_FILE_SUFFIX
+        with FileLockBackend._statesLock:
+            self._state = FileLockBackend._states.setdefault(self.name, FileLockBackend.State())
+
+    @staticmethod
+    def lockFile(path, operation, timeoutMs):
+        """Opens path and locks it using flock() with the given operation.
+        Returns the file descriptor, or None if the lock wasn't acquired
+        within timeoutMs."""
+        deadline = time.monotonic() + timeoutMs / 1000
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        except FileNotFoundError:
+            ensureDirectoryExists(os.path.dirname(path))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        interval = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    os.close(fd)
+                    return None
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, FileLockBackend.MAX_POLL_INTERVAL)
+
+    @staticmethod
+    def unlockFile(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def acquire(self, timeoutMs):
+        deadline = time.monotonic() + timeoutMs / 1000
+        state = self._state
+        if timeoutMs > 0:
+            threadLockAcquired = state.threadLock.acquire(timeout=timeoutMs / 1000)
+        else:
+            threadLockAcquired = state.threadLock.acquire(False)
+        if not threadLockAcquired:
+            return False
+        if state.count == 0:
+            state.fd = FileLockBackend.lockFile(self.name, fcntl.LOCK_EX,
+                                                max(0, (deadline - time.monotonic()) * 1000))
+            if state.fd is None:
+                state.threadLock.release()
+                return False
+        state.count += 1
+        return True
+
+    def release(self):
+        state = self._state
+        state.count -= 1
+        if state.count == 0:
+            FileLockBackend.unlockFile(state.fd)
+            state.fd = None
+        state.threadLock.release()
+
+
+class NamedSemaphoreSharedLockBackend:
+    """ Locks a named Win32 semaphore with SLOTS slots: holding it shared takes
+    one slot, holding it exclusively takes all of them. Exclusive holders take
+    the slots one at a time while holding a named mutex, so they never
+    deadlock each other. """
+    SLOTS = 1024
+
+    def __init__(self, path):
+        self.name = 'Local\\' + path.replace(':', '-').replace('\\', '-')
+        self._semaphore = None
+        self._exclusiveMutex = NamedMutexLockBackend(path + '-exclusive')
+
+    def __del__(self):
+        if self._semaphore:
+            windll.kernel32.CloseHandle(self._semaphore)
+
+    def _takeSlot(self, timeoutMs):
+        result = windll.kernel32.WaitForSingleObject(self._semaphore, wintypes.INT(int(timeoutMs)))
+        if result == NamedMutexLockBackend.WAIT_TIMEOUT_CODE:
+            return False
+        if result != 0:
+            raise CacheLockException('Error! WaitForSingleObject returns {result}, last error {error}'.format(
+                result=result,
+                error=windll.kernel32.GetLastError()))
+        return True
+
+    def acquire(self, timeoutMs, shared):
+        if not self._semaphore:
+            self._semaphore = windll.kernel32.CreateSemaphoreW(
+                None,
+                NamedSemaphoreSharedLockBackend.SLOTS,
+                NamedSemaphoreSharedLockBackend.SLOTS,
+                self.name)
+            assert self._semaphore
+        if shared:
+            return self._takeSlot(timeoutMs)
+
+        deadline = time.monotonic() + timeoutMs / 1000
+        if not self._exclusiveMutex.acquire(timeoutMs):
+            return False
+        for takenSlots in range(NamedSemaphoreSharedLockBackend.SLOTS):
+            if not self._takeSlot(max(0, (deadline - time.monotonic()) * 1000)):
+                if takenSlots > 0:
+                    windll.kernel32.ReleaseSemaphore(self._semaphore, takenSlots, None)
+                self._exclusiveMutex.release()
+                return False
+        return True
+
+    def release(self, shared):
+        if shared:
+            windll.kernel32.ReleaseSemaphore(self._semaphore, 1, None)
+        else:
+            windll.kernel32.ReleaseSemaphore(self._semaphore, NamedSemaphoreSharedLockBackend.SLOTS, None)
+            self._exclusiveMutex.release()
+
+
+class FileSharedLockBackend:
+    """ Locks the file <path>.lock via flock(), shared or exclusively. Every
+    acquisition uses a file descriptor of its own, so threads of a process
+    can hold the lock shared at the same time. """
+    def __init__(self, path):
+        self.name = path + FileLockBackend.LOCK_FILE_SUFFIX
+        self._threadState = threading.local()
+
+    def _fds(self):
+        """Returns the file descriptors of the acquisitions by the current
+        thread, most recent last"""
+        if not hasattr(self._threadState, 'fds'):
+            self._threadState.fds = []
+        return self._threadState.fds
+
+    def acquire(self, timeoutMs, shared):
+        fd = FileLockBackend.lockFile(self.name, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, timeoutMs)
+        if fd is None:
+            return False
+        self._fds().append(fd)
+        return True
+
+    def release(self, _):
+        FileLockBackend.unlockFile(self._fds().pop())
+
+
+class NoLockBackend:
+    """ Never waits, for caches used by a single clcache process only. Can
+    be held shared, too. """
+    def __init__(self, path):
+        self.name = path
+
+    @staticmethod
+    def acquire(*_):
+        return True
+
+    def release(self, *_):
+        pass
+
+
+class CacheLock:
+    """ Implements a lock for the object cache which
+    can be used in 'with' statements.
+
+    The lock is implemented by one of LOCK_BACKENDS, selected via the
+    CLCACHE_LOCKS environment variable. The time spent waiting for every lock
+    is recorded and added to the statistics by flushStatistics(). """
+    INFINITE = 0xFFFFFFFF
+
+    # Number of acquisitions, total and longest wait in seconds, by locked path
+    _waits = {} # type: Dict[str, List[Any]]
+    _waitsLock = threading.Lock()
+
+    def __init__(self, path, backend, timeoutMs):
+        self._path = path
+        self._backend = backend
+        self._timeoutMs = timeoutMs
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, typ, value, traceback):
+        self.release()
+
+    def acquire(self):
+        CacheLock.timeAcquisition(self._path, self._backend, self._timeoutMs)
+
+    def release(self):
+        self._backend.release()
+
+    @staticmethod
+    def timeAcquisition(path, backend, timeoutMs, *args):
+        """Acquires the lock implemented by backend and records the wait"""
+        start = time.perf_counter()
+        acquired = backend.acquire(timeoutMs, *args)
+        CacheLock.recordWait(path, time.perf_counter() - start)
+        if not acquired:
+            raise CacheLockException(
+                'Failed to acquire lock {} after {}ms; '
+                'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
+                    backend.name, timeoutMs))
+
+    @staticmethod
+    def recordWait(path, duration):
+        with CacheLock._waitsLock:
+            waits = CacheLock._waits.setdefault(path, [0, 0.0, 0.0])
+            waits[0] += 1
+            waits[1] += duration
+            waits[2] = max(waits[2], duration)
+
+    @staticmethod
+    def flushStatistics(stats):
+        with CacheLock._waitsLock:
+            waits, CacheLock._waits = CacheLock._waits, {}
+        for path, (count, totalWait, maxWait) in waits.items():
+            stats.registerLockWaits(path, count, totalWait, maxWait)
+
+    @staticmethod
+    def forPath(path, timeoutMs=None):
+        if timeoutMs is None:
+            timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
+        return CacheLock(path, LOCK_BACKENDS[lockBackendName()](path), timeoutMs)
+
+
+class SharedCacheLock:
+    """ Cache-wide lock which any number of clcache processes can hold shared
+    at the same time, or one process exclusively. Compilations hold it
+    shared while adding to the cache, maintenance holds it exclusively only
+    while it needs a stable view of the whole cache. Waits are recorded like
+    those for a CacheLock. """
+    def __init__(self, path, backend, timeoutMs):
+        self._path = path
+        self._backend = backend
+        self._timeoutMs = timeoutMs
+
+    @contextlib.contextmanager
+    def shared(self):
+        CacheLock.timeAcquisition(self._path, self._backend, self._timeoutMs, True)
+        try:
+            yield
+        finally:
+            self._backend.release(True)
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        CacheLock.timeAcquisition(self._path, self._backend, self._timeoutMs, False)
+        try:
+            yield
+        finally:
+            self._backend.release(False)
+
+    @staticmethod
+    def forPath(path, timeoutMs=None):
+        if timeoutMs is None:
+            timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
+        return SharedCacheLock(path, SHARED_LOCK_BACKENDS[lockBackendName()](path), timeoutMs)
+
+
+def lockBackendName():
+    name = os.environ.get('CLCACHE_LOCKS', DEFAULT_LOCK_BACKEND)
+    if name not in LOCK_BACKENDS:
+        raise LogicException('Unsupported lock backend {} in CLCACHE_LOCKS, available backends: {}'.format(
+            name, ', '.join(sorted(LOCK_BACKENDS))))
+    return name
+
+
+# Backends of CacheLock and SharedCacheLock by the name selected via CLCACHE_LOCKS
+LOCK_BACKENDS = {'none': NoLockBackend} # type: Dict[str, type]
+SHARED_LOCK_BACKENDS = {'none': NoLockBackend} # type: Dict[str, type]
+if windll is not None:
+    LOCK_BACKENDS['mutex'] = NamedMutexLockBackend
+    SHARED_LOCK_BACKENDS['mutex'] = NamedSemaphoreSharedLockBackend
+if fcntl is not None:
+    LOCK_BACKENDS['flock'] = FileLockBackend
+    SHARED_LOCK_BACKENDS['flock'] = FileSharedLockBackend
+DEFAULT_LOCK_BACKEND = 'mutex' if windll is not None else 'flock'
+
+
+class CacheDummyLock:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, typ, value, traceback):
+        pass
@@ -0,0 +1,913 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from collections import defaultdict, namedtuple
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+from typing import Any, Dict, List, Union
+from atomicwrites import atomic_write
+
+from . import VERSION
+from .utils import (basenameWithoutExtension, childDirectories, collapseBasedirToPlaceholder, ensureDirectoryExists,
+                    expandBasedirPlaceholder, filesBeneath, IncludeNotFoundException, printErrStr, printTraceStatement)
+from .cmdline import CommandLineAnalyzer
+from .hashing import (createHasher, getCompilerHash, getFileHash, getFileHashes, getStringHash, hashAlgorithmName,
+                      modifiedRecently, updateHasherFromFile)
+from .locks import CacheLock
+from .index import CacheIndex
+
+
+# Number of most recently used manifest entries which are checked by
+# comparing the sizes and modification times of include files before
+# falling back to hashing the contents of include files.
+MAX_STAT_FINGERPRINT_CHECKS = 8
+
+# Manifest file will have at most this number of hash lists in it. Need to avoi
+# manifests grow too large.
+MAX_MANIFEST_HASHES = 1000
+
+# Size of the hit log of a manifest after which it is merged into the manifest
+MAX_MANIFEST_HIT_LOG_SIZE = 16 * 1024
+
+# ManifestEntry: an entry in a manifest file
+# `includeFiles`: sorted list of paths to include files, which this source file uses
+# `includesContentsHash`: hash of the contents of the includeFiles
+# `objectHash`: hash of the object in cache
+# `includeHashes`: list of hashes of the individual includeFiles
+# `statFingerprint`: hash of the sizes and modification times of the includeFiles, or None
+ManifestEntry = namedtuple('ManifestEntry',
+                           ['includeFiles', 'includesContentHash', 'objectHash', 'includeHashes', 'statFingerprint'])
+
+
+class IncludePathTableResetError(ValueError):
+    pass
+
+
+class Manifest:
+    """ The entries of a manifest, most recently used first, together with a
+    decision tree which maps the hashes of include files to entries.
+
+    Every inner node of the tree tests a single include file and is stored as
+    a pair [includeFile, children], where children maps the hash of the
+    include file to the index of the next node. Entries which do not depend on
+    the include file continue with the child stored for the empty hash. A leaf
+    node is the index of the entry it resolves to. Since include files are
+    tested in sorted order, entries sharing include files share nodes and a
+    lookup needs to hash every include file at most once. """
+    DONT_CARE = ''
+
+    # Binary encoding as written by toBytes(), all integers little endian:
+    #  - header: magic, format version, digest size in bytes, generation of
+    #    the include path table, number of entries, nodes and children
+    #  - entries: includesContentHash, objectHash, whether there is a stat
+    #    fingerprint and the stat fingerprint (zeros if there is none)
+    #  - nodes: position of the include file in the include path table
+    #    (NO_INCLUDE_FILE for leaves), DONT_CARE child index (NO_CHILD if there
+    #    is none) or entry index for leaves, number of children
+    #  - children of all inner nodes in node order: include hash, node index
+    # All hashes are stored as raw digests of the same size.
+    BINARY_MAGIC = b'CLCM'
+    BINARY_FORMAT_VERSION = 2
+    BINARY_HEADER = struct.Struct('<4sHB16s3I')
+    BINARY_NODE = struct.Struct('<III')
+    NO_INCLUDE_FILE = 0xffffffff
+    NO_CHILD = 0xffffffff
+
+    def __init__(self, entries=None, tree=None):
+        if entries is None:
+            entries = []
+        self._entries = entries.copy()
+        self._tree = tree
+
+    def entries(self):
+        return self._entries
+
+    def addEntry(self, entry):
+        """Adds entry at the top of the entries, replacing an entry for the
+        same include file contents"""
+        self._entries = [e for e in self._entries if e.includesContentHash != entry.includesContentHash]
+        self._entries.insert(0, entry)
+        del self._entries[MAX_MANIFEST_HASHES:]
+        self._tree = None
+
+    def touchEntry(self, objectHash, statFingerprint=None):
+        """Moves entry with objectHash to the top of entries(), optionally
+        updating its statFingerprint"""
+        self.touchEntries([(objectHash, statFingerprint)])
+
+    def touchEntries(self, hits):
+        """Applies touchEntry() for each (objectHash, statFingerprint) pair of
+        hits in the given order. Since only the order of the entries changes,
+        the leaves of the tree are renumbered instead of rebuilding it."""
+        entryIndices = {e.objectHash: i for i, e in enumerate(self._entries)}
+        touchedIndices = []
+        statFingerprints = {}
+        for objectHash, statFingerprint in reversed(hits):
+            entryIndex = entryIndices.get(objectHash)
+            if entryIndex is None:
+                continue
+            if entryIndex not in statFingerprints:
+                touchedIndices.append(entryIndex)
+                statFingerprints[entryIndex] = statFingerprint
+            elif statFingerprints[entryIndex] is None:
+                statFingerprints[entryIndex] = statFingerprint
+        if not touchedIndices:
+            return
+
+        order = touchedIndices + [i for i in range(len(self._entries)) if i not in statFingerprints]
+        entries = []
+        for entryIndex in order:
+            entry = self._entries[entryIndex]
+            if statFingerprints.get(entryIndex) is not None:
+                entry = entry._replace(statFingerprint=statFingerprints[entryIndex])
+            entries.append(entry)
+        self._entries = entries
+
+        if self._tree is not None:
+            newIndices = {entryIndex: i for i, entryIndex in enumerate(order)}
+            self._tree = [newIndices[node] if isinstance(node, int) else node for node in self._tree]
+
+    def findEntryByStat(self, statFingerprintForIncludes):
+        """Returns the index of a recently used entry whose include files were
+        not modified since the entry was created or None.
+        statFingerprintForIncludes(includeFiles) returns the current stat
+        fingerprint of the given include files."""
+        for entryIndex, entry in enumerate(self._entries[:MAX_STAT_FINGERPRINT_CHECKS]):
+            if entry.statFingerprint is not None and \
+               entry.statFingerprint == statFingerprintForIncludes(entry.includeFiles):
+                return entryIndex
+        return None
+
+    def tree(self):
+        if self._tree is None:
+            self._tree = Manifest._buildTree(self._entries)
+        return self._tree
+
+    def findEntry(self, hashForInclude, prefetch=None):
+        """Returns the index of the entry matching the current include files
+        or None. hashForInclude(includeFile) returns the hash of the given
+        include file, or None if it doesn't exist. If several entries match,
+        the most recently used one is returned.
+
+        The tree is walked one level at a time, and only include files tested
+        by nodes which are reached are hashed; a branch ends at a node which
+        has neither a child for the hash of its include file nor a DONT_CARE
+        child. If given, prefetch(includeFiles) is called with the include
+        files tested on each level before they are hashed one by one."""
+        tree = self.tree()
+        if not tree:
+            return None
+        matchingEntry = None
+        level = [0]
+        while level:
+            nodes = [tree[nodeIndex] for nodeIndex in level]
+            if prefetch is not None:
+                prefetch([node[0] for node in nodes if not isinstance(node, int)])
+            level = []
+            for node in nodes:
+                if isinstance(node, int):
+                    if matchingEntry is None or node < matchingEntry:
+                        matchingEntry = node
+                    continue
+                includeFile, children = node
+                if Manifest.DONT_CARE in children:
+                    level.append(children[Manifest.DONT_CARE])
+                includeHash = hashForInclude(includeFile)
+                if includeHash in children:
+                    level.append(children[includeHash])
+        return matchingEntry
+
+    @staticmethod
+    def _buildTree(entries):
+        if not entries:
+            return []
+        includes = [sorted(zip(e.includeFiles, e.includeHashes)) for e in entries]
+        # Leaves are entry indices, inner nodes [includeFile, children]
+        nodes = {} # type: Dict[int, Union[int, List[Any]]]
+        numNodes = 1
+        # Each work item is a node and the entries reaching it, together
+        # with the position of the first include file not tested yet.
+        pending = [(0, [(entryIndex, 0) for entryIndex in range(len(entries))])]
+        while pending:
+            nodeIndex, members = pending.pop()
+            remaining = [(e, pos) for e, pos in members if pos < len(includes[e])]
+            if not remaining:
+                # Prefer the most recently used entry in case of duplicates
+                nodes[nodeIndex] = min(e for e, _ in members)
+                continue
+
+            includeFile = min(includes[e][pos][0] for e, pos in remaining)
+            childMembers = defaultdict(list)
+            for e, pos in members:
+                if pos < len(includes[e]) and includes[e][pos][0] == includeFile:
+                    childMembers[includes[e][pos][1]].append((e, pos + 1))
+                else:
+                    childMembers[Manifest.DONT_CARE].append((e, pos))
+
+            children = {}
+            for includeHash, childMember in childMembers.items():
+                children[includeHash] = numNodes
+                numNodes += 1
+                pending.append((children[includeHash], childMember))
+            nodes[nodeIndex] = [includeFile, children]
+        return [nodes[nodeIndex] for nodeIndex in range(numNodes)]
+
+    @staticmethod
+    def fromTree(tree, entryInfos):
+        """Reconstructs a manifest from its decision tree; entryInfos is a
+        list of (includesContentHash, objectHash, statFingerprint) tuples for
+        all entries."""
+        parents = {}
+        leaves = {}
+        for nodeIndex, node in enumerate(tree):
+            if isinstance(node, int):
+                leaves[node] = nodeIndex
+            else:
+                for includeHash, childIndex in node[1].items():
+                    parents[childIndex] = (nodeIndex, includeHash)
+
+        entries = []
+        for entryIndex, (includesContentHash, objectHash, statFingerprint) in enumerate(entryInfos):
+            if entryIndex not in leaves:
+                # Shadowed by a more recently used entry with the same include
+                # hashes, see _buildTree()
+                continue
+            includeFiles = []
+            includeHashes = []
+            nodeIndex = leaves[entryIndex]
+            while nodeIndex in parents:
+                nodeIndex, includeHash = parents[nodeIndex]
+                if includeHash != Manifest.DONT_CARE:
+                    includeFiles.append(tree[nodeIndex][0])
+                    includeHashes.append(includeHash)
+            entries.append(ManifestEntry(includeFiles[::-1], includesContentHash, objectHash, includeHashes[::-1],
+                                         statFingerprint))
+        if len(entries) != len(entryInfos) or any(entryIndex >= len(entryInfos) for entryIndex in leaves):
+            # The leaves don't match the remaining entries, build a new tree
+            return Manifest(entries)
+        return Manifest(entries, tree)
+
+    def toBytes(self, includePathTable):
+        tree = self.tree()
+        includeFiles = sorted({node[0] for node in tree if not isinstance(node, int)})
+        generation, positions = includePathTable.positionsFor(includeFiles)
+        includeFilePosition = dict(zip(includeFiles, positions))
+
+        digestSize = len(self._entries[0].objectHash) // 2 if self._entries else 0
+        def digest(hexDigest):
+            result = bytes.fromhex(hexDigest)
+            if len(result) != digestSize:
+                raise ValueError("hash {} does not have {} bytes".format(hexDigest, digestSize))
+            return result
+
+        entryRecord = struct.Struct('<{0}s{0}s?{0}s'.format(digestSize))
+        childRecord = struct.Struct('<{}sI'.format(digestSize))
+        entries = [entryRecord.pack(digest(e.includesContentHash),
+                                    digest(e.objectHash),
+                                    e.statFingerprint is not None,
+                                    digest(e.statFingerprint) if e.statFingerprint is not None else b'')
+                   for e in self._entries]
+        nodes = []
+        children = []
+        for node in tree:
+            if isinstance(node, int):
+                nodes.append(Manifest.BINARY_NODE.pack(Manifest.NO_INCLUDE_FILE, node, 0))
+                continue
+            includeFile, nodeChildren = node
+            dontCareChild = nodeChildren.get(Manifest.DONT_CARE, Manifest.NO_CHILD)
+            hashChildren = [(digest(h), childIndex) for h, childIndex in nodeChildren.items()
+                            if h != Manifest.DONT_CARE]
+            nodes.append(Manifest.BINARY_NODE.pack(includeFilePosition[includeFile], dontCareChild,
+                                                   len(hashChildren)))
+            children.extend(childRecord.pack(*child) for child in hashChildren)
+
+        header = Manifest.BINARY_HEADER.pack(Manifest.BINARY_MAGIC, Manifest.BINARY_FORMAT_VERSION, digestSize,
+                                             generation, len(entries), len(nodes), len(children))
+        return b''.join([header] + entries + nodes + children)
+
+    @staticmethod
+    def fromBytes(data, includePathTable):
+        """Reconstructs a manifest written by toBytes(). Raises ValueError if
+        data is not a valid manifest."""
+        generation, entryInfos, nodes, children = Manifest._unpackRecords(data)
+        positions = list({position for position, _, _ in nodes if position != Manifest.NO_INCLUDE_FILE})
+        includeFiles = dict(zip(positions, includePathTable.pathsAt(generation, positions)))
+        return Manifest.fromTree(Manifest._treeFromRecords(nodes, children, includeFiles), entryInfos)
+
+    @staticmethod
+    def _unpackRecords(data):
+        """Returns the include path table generation, the entries, the nodes
+        and the children stored in data"""
+        if len(data) < Manifest.BINARY_HEADER.size:
+            raise ValueError("manifest is truncated")
+        magic, version, digestSize, generation, numEntries, numNodes, numChildren = \
+            Manifest.BINARY_HEADER.unpack_from(data)
+        if magic != Manifest.BINARY_MAGIC or version != Manifest.BINARY_FORMAT_VERSION:
+            raise ValueError("unsupported manifest format")
+
+        entryRecord = struct.Struct('<{0}s{0}s?{0}s'.format(digestSize))
+        childRecord = struct.Struct('<{}sI'.format(digestSize))
+        entriesOffset = Manifest.BINARY_HEADER.size
+        nodesOffset = entriesOffset + numEntries * entryRecord.size
+        childrenOffset = nodesOffset + numNodes * Manifest.BINARY_NODE.size
+        if len(data) != childrenOffset + numChildren * childRecord.size:
+            raise ValueError("manifest is truncated")
+
+        view = memoryview(data)
+        entryInfos = [(includesContentHash.hex(), objectHash.hex(), statFingerprint.hex() if hasStat else None)
+                      for includesContentHash, objectHash, hasStat, statFingerprint
+                      in entryRecord.iter_unpack(view[entriesOffset:nodesOffset])]
+        nodes = list(Manifest.BINARY_NODE.iter_unpack(view[nodesOffset:childrenOffset]))
+        children = [(includeHash.hex(), childIndex)
+                    for includeHash, childIndex in childRecord.iter_unpack(view[childrenOffset:])]
+        return generation, entryInfos, nodes, children
+
+    @staticmethod
+    def _treeFromRecords(nodes, children, includeFiles):
+        """Returns the tree as expected by fromTree() for the unpacked nodes
+        and children, given the paths of the include file positions"""
+        tree = []
+        childPos = 0
+        for position, child, numNodeChildren in nodes:
+            if position == Manifest.NO_INCLUDE_FILE:
+                tree.append(child)
+                continue
+            nodeChildren = dict(children[childPos:childPos + numNodeChildren])
+            childPos += numNodeChildren
+            if child != Manifest.NO_CHILD:
+                nodeChildren[Manifest.DONT_CARE] = child
+            tree.append([includeFiles[position], nodeChildren])
+        return tree
+
+
+class IncludePathTable:
+    """ Cache-wide table of include file paths, such that manifests can refer
+    to an include file by its position in the table instead of repeating the
+    path.
+
+    The table file starts with a line holding the random generation of the
+    table, followed by one UTF-8 encoded path per line. Paths are only ever
+    appended while holding the lock, so positions stay valid until a new
+    generation of the table is started for compacting it. Readers don't lock;
+    they ignore a trailing line which is not completely written yet. Manifests
+    record the generation of the table they were written with, such that a
+    manifest can't resolve positions using a different generation. While
+    the table is compacted, the previous generation is kept such that
+    manifests can be read until they are rewritten using the new table.
+
+    Reading paths maps the table and only looks at the requested positions.
+    The positions of the paths in the table are parsed when appending, and
+    kept such that later appends only parse what was appended meanwhile. """
+    GENERATION_SIZE = 16
+    HEADER_SIZE = 2 * GENERATION_SIZE + 1
+    HEADER_REGEX = re.compile(rb'[0-9a-f]{32}\n')
+
+    def __init__(self, tablePath):
+        self._tablePath = tablePath
+        self._previousTablePath = tablePath + ".previous"
+        self.lock = CacheLock.forPath(tablePath)
+        self._generation = None
+        self._knownPositions = {}  # type: Dict[bytes, int]
+        self._parsedSize = IncludePathTable.HEADER_SIZE
+
+    def _resetKnownPositions(self, generation):
+        self._generation = generation
+        self._knownPositions = {}
+        self._parsedSize = IncludePathTable.HEADER_SIZE
+
+    def size(self):
+        try:
+            return os.path.getsize(self._tablePath)
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _readGeneration(tableFile):
+        header = tableFile.read(IncludePathTable.HEADER_SIZE)
+        if not IncludePathTable.HEADER_REGEX.match(header):
+            return None
+        return bytes.fromhex(header[:-1].decode('ascii'))
+
+    @staticmethod
+    def _pathsIn(tablePath, generation, positions):
+        """Returns the paths at the given positions of the table file if it is
+        of the given generation, otherwise None"""
+        try:
+            tableFile = open(tablePath, 'rb')
+        except FileNotFoundError:
+            return None
+        with tableFile:
+            if IncludePathTable._readGeneration(tableFile) != generation:
+                return None
+            if not positions:
+                return []
+            with mmap.mmap(tableFile.fileno(), 0, access=mmap.ACCESS_READ) as table:
+                paths = []
+                for position in positions:
+                    end = table.find(b'\n', position)
+                    if position < IncludePathTable.HEADER_SIZE or end < 0:
+                        raise ValueError("include path position {} is out of range".format(position))
+                    paths.append(table[position:end].decode('utf-8'))
+                return paths
+
+    def pathsAt(self, generation, positions):
+        """Returns the paths stored at the given positions of the table of the
+        given generation. Raises IncludePathTableResetError if neither the
+        table nor the previous one is of that generation."""
+        for tablePath in [self._tablePath, self._previousTablePath]:
+            paths = IncludePathTable._pathsIn(tablePath, generation, positions)
+            if paths is not None:
+                return paths
+        raise IncludePathTableResetError("include path table was reset")
+
+    def positionsFor(self, paths):
+        """Returns the generation of the table and the positions of the given
+        paths, appending paths which are not in the table yet."""
+        with self.lock:
+            ensureDirectoryExists(os.path.dirname(self._tablePath))
+            with open(self._tablePath, 'a+b') as tableFile:
+                tableFile.seek(0)
+                generation = IncludePathTable._readGeneration(tableFile)
+                appended = b''
+                if generation is None:
+                    generation = os.urandom(IncludePathTable.GENERATION_SIZE)
+                    appended = generation.hex().encode('ascii') + b'\n'
+                    self._resetKnownPositions(generation)
+                    self._parsedSize = 0
+                    tableFile.truncate(0)
+                elif generation != self._generation:
+                    self._resetKnownPositions(generation)
+
+                # Parse the paths appended since the last call
+                tableFile.seek(self._parsedSize)
+                tail = tableFile.read()
+                tail = tail[:tail.rfind(b'\n') + 1]
+                position = self._parsedSize
+                for line in tail.split(b'\n')[:-1]:
+                    self._knownPositions[line] = position
+                    position += len(line) + 1
+                # Drop whatever a process which died while appending left behind
+                tableFile.truncate(position)
+                self._parsedSize = position + len(appended)
+
+                positions = []
+                for path in paths:
+                    encodedPath = path.encode('utf-8')
+                    if encodedPath not in self._knownPositions:
+                        self._knownPositions[encodedPath] = self._parsedSize
+                        self._parsedSize += len(encodedPath) + 1
+                        appended += encodedPath + b'\n'
+                    positions.append(self._knownPositions[encodedPath])
+
+                if appended:
+                    tableFile.write(appended)
+            return generation, positions
+
+    def startNewGeneration(self):
+        """Starts over with an empty table of a new generation. The current
+        table becomes the previous one, replacing the table before it."""
+        with self.lock:
+            try:
+                os.replace(self._tablePath, self._previousTablePath)
+            except FileNotFoundError:
+                pass
+            self._resetKnownPositions(None)
+
+    def removePreviousGeneration(self):
+        """Removes the previous table once no manifest refers to it anymore.
+        Readers which still hold such a manifest fail to resolve its paths
+        like for a broken manifest."""
+        try:
+            os.remove(self._previousTablePath)
+        except FileNotFoundError:
+            pass
+
+
+class ManifestSection:
+    def __init__(self, manifestSectionDir, includePathTable, index=None):
+        self.manifestSectionDir = manifestSectionDir
+        self.includePathTable = includePathTable
+        self.index = index
+        self.lock = CacheLock.forPath(self.manifestSectionDir)
+
+    def manifestPath(self, manifestHash):
+        return os.path.join(self.manifestSectionDir, manifestHash + ".manifest")
+
+    def legacyManifestPath(self, manifestHash):
+        # Manifests used to be stored as JSON, under the hash computed by
+        # ManifestRepository.getLegacyManifestHash(). They are migrated to the
+        # binary format by ManifestRepository.migrateLegacyManifest().
+        return os.path.join(self.manifestSectionDir, manifestHash + ".json")
+
+    def hitLogPath(self, manifestHash):
+        # Hits on entries which are not the most recently used one are appended
+        # to a log instead of rewriting the manifest. The log is applied when
+        # reading the manifest and merged into it when the manifest is written
+        # the next time, or when the log exceeds MAX_MANIFEST_HIT_LOG_SIZE.
+        return os.path.join(self.manifestSectionDir, manifestHash + ".hits")
+
+    def manifestFiles(self):
+        return filesBeneath(self.manifestSectionDir)
+
+    def manifestHashes(self):
+        """Returns the hashes of the manifests stored in the binary format"""
+        return [basenameWithoutExtension(path) for path in self.manifestFiles() if path.endswith(".manifest")]
+
+    def setManifest(self, manifestHash, manifest):
+        size = self._writeManifest(manifestHash, manifest)
+        if self.index is not None:
+            self.index.addEntry(CacheIndex.MANIFEST, manifestHash, size)
+
+    def rewriteManifest(self, manifestHash):
+        """Writes the manifest again using the current include path table,
+        keeping its position in the index. Returns the new size of the
+        manifest, or None if it could not be read."""
+        manifest = self.getManifest(manifestHash)
+        if manifest is None:
+            return None
+        size = self._writeManifest(manifestHash, manifest)
+        if self.index is not None:
+            self.index.setEntrySize(CacheIndex.MANIFEST, manifestHash, size)
+        return size
+
+    def _writeManifest(self, manifestHash, manifest):
+        manifestPath = self.manifestPath(manifestHash)
+        printTraceStatement("Writing manifest with manifestHash = {} to {}".format(manifestHash, manifestPath))
+        ensureDirectoryExists(self.manifestSectionDir)
+        data = manifest.toBytes(self.includePathTable)
+        with atomic_write(manifestPath, mode='wb', overwrite=True) as outFile:
+            outFile.write(data)
+        try:
+            os.remove(self.hitLogPath(manifestHash))
+        except FileNotFoundError:
+            pass
+        return len(data)
+
+    def removeManifest(self, manifestHash):
+        for path in [self.manifestPath(manifestHash), self.hitLogPath(manifestHash),
+                     self.legacyManifestPath(manifestHash)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def touchManifest(self, manifestHash, manifest, objectHash, statFingerprint=None):
+        """Moves the entry with objectHash to the top of manifest, which was
+        read using getManifest(), and records this in the hit log. Only
+        merging the hit log into the manifest takes the lock of the section."""
+        manifest.touchEntry(objectHash, statFingerprint)
+        with open(self.hitLogPath(manifestHash), 'a') as hitLog:
+            hitLog.write(' '.join(filter(None, [objectHash, statFingerprint])) + '\n')
+            hitLogSize = hitLog.tell()
+        if hitLogSize > MAX_MANIFEST_HIT_LOG_SIZE:
+            with self.lock:
+                # Other processes may have logged hits meanwhile
+                manifest = self.getManifest(manifestHash) or manifest
+                self.setManifest(manifestHash, manifest)
+        elif self.index is not None:
+            self.index.recordHit(CacheIndex.MANIFEST, manifestHash)
+
+    def _readHitLog(self, manifestHash):
+        try:
+            with open(self.hitLogPath(manifestHash), 'r') as hitLog:
+                lines = hitLog.read().split('\n')
+        except IOError:
+            return []
+        # The last line is either empty or not completely written yet
+        hits = []
+        for line in lines[:-1]:
+            fields = line.split(' ')
+            hits.append((fields[0], fields[1] if len(fields) > 1 else None))
+        return hits
+
+    def getManifest(self, manifestHash):
+        manifest = self._readManifest(manifestHash)
+        if manifest is not None:
+            manifest.touchEntries(self._readHitLog(manifestHash))
+        return manifest
+
+    def _readManifest(self, manifestHash):
+        fileName = self.manifestPath(manifestHash)
+        try:
+            with open(fileName, 'rb') as inFile:
+                return Manifest.fromBytes(inFile.read(), self.includePathTable)
+        except IOError:
+            return None
+        except IncludePathTableResetError:
+            # The include path table was compacted since the manifest was read
+            return None
+        except (ValueError, KeyError, IndexError):
+            printErrStr("clcache: manifest file %s was broken" % fileName)
+            return None
+
+    def getLegacyManifestEntries(self, manifestHash):
+        """Returns the (includeFiles, includesContentHash, objectHash) tuples
+        of the entries of a JSON manifest, most recently used first, or None if
+        there is no such manifest"""
+        fileName = self.legacyManifestPath(manifestHash)
+        try:
+            with open(fileName, 'r') as inFile:
+                doc = json.load(inFile)
+            return [(e['includeFiles'], e['includesContentHash'], e['objectHash']) for e in doc['entries']]
+        except IOError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            printErrStr("clcache: manifest file %s was broken" % fileName)
+            return None
+
+
+class ManifestRepository:
+    # Bump this counter whenever the current manifest file format changes.
+    # E.g. changing the file format from {'oldkey': ...} to {'newkey': ...} requires
+    # invalidation, such that a manifest that was stored using the old format is not
+    # interpreted using the new format. Instead the old file will not be touched
+    # again due to a new manifest hash and is cleaned away after some time.
+    MANIFEST_FILE_FORMAT_VERSION = 8
+    # Version of the JSON manifests which can still be migrated, see
+    # migrateLegacyManifest()
+    LEGACY_MANIFEST_FILE_FORMAT_VERSION = 6
+
+    def __init__(self, manifestsRootDir, index=None):
+        self._manifestsRootDir = manifestsRootDir
+        self._includePathTable = IncludePathTable(os.path.join(manifestsRootDir, "includepaths.txt"))
+        self.index = index
+
+    def section(self, manifestHash):
+        return ManifestSection(os.path.join(self._manifestsRootDir, manifestHash[:2]), self._includePathTable,
+                               self.index)
+
+    def sections(self):
+        return (ManifestSection(path, self._includePathTable, self.index)
+                for path in childDirectories(self._manifestsRootDir))
+
+    def indexEntries(self):
+        """Yields the entries of the cache index for all manifests, as
+        expected by CacheIndex.rebuild()"""
+        for section in self.sections():
+            # Sizes and last access of the files making up each manifest
+            manifestInfos = {}
+            for filePath in section.manifestFiles():
+                try:
+                    stat = os.stat(filePath)
+                except OSError:
+                    continue
+                manifestHash = basenameWithoutExtension(filePath)
+                size, lastAccess = manifestInfos.get(manifestHash, (0, 0))
+                manifestInfos[manifestHash] = (size + stat.st_size, max(lastAccess, stat.st_atime))
+            for manifestHash, (size, lastAccess) in manifestInfos.items():
+                yield CacheIndex.MANIFEST, manifestHash, size, lastAccess, None
+
+    def clean(self, maxManifestsSize):
+        """Removes the least recently used manifests until they fit into
+        maxManifestsSize, locking the section of one manifest at a time"""
+        includePathTableSize = self._includePathTable.size()
+        if self.index is not None and self.index.isComplete():
+            self.index.applyHits()
+            manifestInfos = [(manifestHash, size) for manifestHash, size, _ in
+                             self.index.entries(CacheIndex.MANIFEST, reverse=True)]
+        else:
+            manifestInfos = sorted(self.indexEntries(), key=lambda t: t[3], reverse=True)
+            manifestInfos = [(manifestHash, size) for _, manifestHash, size, _, _ in manifestInfos]
+
+        remainingObjectsSize = includePathTableSize
+        removedManifests = []
+        for manifestHash, size in manifestInfos:
+            if remainingObjectsSize + size <= maxManifestsSize:
+                remainingObjectsSize += size
+            else:
+                section = self.section(manifestHash)
+                with section.lock:
+                    section.removeManifest(manifestHash)
+                removedManifests.append(manifestHash)
+        if self.index is not None:
+            self.index.removeEntries(CacheIndex.MANIFEST, removedManifests)
+
+        # Paths of include files no manifest refers to anymore are never
+        # removed from the include path table since that would move the other
+        # paths. Compact the table once it makes up a big part of the
+        # manifest size.
+        if includePathTableSize > maxManifestsSize / 2:
+            remainingObjectsSize = self.compactIncludePathTable()
+        return remainingObjectsSize
+
+    def compactIncludePathTable(self):
+        """Starts a new include path table and rewrites all manifests using it,
+        such that it only holds the paths the manifests still refer to.
+        Manifests which can't be read are removed. Returns the size of the
+        manifests and the new table."""
+        # Don't hold the table lock while locking sections: writers lock their
+        # section before appending to the table. A manifest written before its
+        # section is rewritten refers to either generation of the table, which
+        # pathsAt() both resolves.
+        self._includePathTable.startNewGeneration()
+        manifestsSize = 0
+        removedManifests = []
+        for section in self.sections():
+            with section.lock:
+                for manifestHash in section.manifestHashes():
+                    size = section.rewriteManifest(manifestHash)
+                    if size is None:
+                        section.removeManifest(manifestHash)
+                        removedManifests.append(manifestHash)
+                    else:
+                        manifestsSize += size
+        if self.index is not None:
+            self.index.removeEntries(CacheIndex.MANIFEST, removedManifests)
+        self._includePathTable.removePreviousGeneration()
+        return manifestsSize + self._includePathTable.size()
+
+    def migrateLegacyManifest(self, legacyManifestHash, manifestHash, hashForInclude):
+        """Converts the JSON manifest stored under legacyManifestHash to a
+        manifest stored under manifestHash, to be called with the section of
+        manifestHash locked. hashForInclude(includeFile) returns the current
+        hash of an include file or None. Returns the new manifest, or None if
+        there was no JSON manifest or none of its entries could be kept.
+
+        JSON manifests only store the combined hash of the include files of an
+        entry, so the hash of each include file is only known for entries
+        matching the current include files. The other entries are dropped."""
+        if hashAlgorithmName() != 'md5':
+            # JSON manifests were always written using MD5
+            return None
+        legacySection = self.section(legacyManifestHash)
+        legacyEntries = legacySection.getLegacyManifestEntries(legacyManifestHash)
+        if legacyEntries is None:
+            return None
+
+        manifest = Manifest()
+        for includeFiles, includesContentHash, objectHash in reversed(legacyEntries):
+            includeHashes = [hashForInclude(includeFile) for includeFile in includeFiles]
+            if None in includeHashes or \
+               ManifestRepository.getIncludesContentHashForHashes(includeHashes) != includesContentHash:
+                continue
+            manifest.addEntry(ManifestEntry(includeFiles, includesContentHash, objectHash, includeHashes, None))
+        printTraceStatement("Migrating manifest {} to {}, keeping {} of {} entries".format(
+            legacyManifestHash, manifestHash, len(manifest.entries()), len(legacyEntries)))
+
+        if manifest.entries():
+            self.section(manifestHash).setManifest(manifestHash, manifest)
+        legacySection.removeManifest(legacyManifestHash)
+        if self.index is not None:
+            self.index.removeEntries(CacheIndex.MANIFEST, [legacyManifestHash])
+        return manifest if manifest.entries() else None
+
+    def evict(self, maxManifestsSize, batchSize):
+        """Removes up to batchSize of the least recently hit manifests recorded
+        in the index while they exceed maxManifestsSize, locking only the
+        section of each manifest. Returns the number of removed manifests."""
+        self.index.applyHits()
+        currentSize = self.index.totalSize(CacheIndex.MANIFEST) + self._includePathTable.size()
+        removedManifests = []
+        for manifestHash, size, _ in self.index.entries(CacheIndex.MANIFEST, limit=batchSize):
+            if currentSize < maxManifestsSize:
+                break
+            section = self.section(manifestHash)
+            with section.lock:
+                section.removeManifest(manifestHash)
+            removedManifests.append(manifestHash)
+            currentSize -= size
+        self.index.removeEntries(CacheIndex.MANIFEST, removedManifests)
+        return len(removedManifests)
+
+    @staticmethod
+    def _normalizedCommandLine(commandLine):
+        # NOTE: We intentionally do not normalize command line to include
+        # preprocessor options.  In direct mode we do not perform preprocessing
+        # before cache lookup, so all parameters are important.  One of the few
+        # exceptions to this rule is the /MP switch, which only defines how many
+        # compiler processes are running simultaneusly.  Arguments that specify
+        # the compiler where to find the source files are parsed to replace
+        # ocurrences of CLCACHE_BASEDIR by a placeholder.
+        arguments, inputFiles = CommandLineAnalyzer.parseArgumentsAndInputFiles(commandLine)
+        collapseBasedirInCmdPath = lambda path: collapseBasedirToPlaceholder(os.path.normcase(os.path.abspath(path)))
+
+        commandLine = []
+        argumentsWithPaths = ("AI", "I", "FU")
+        for k in sorted(arguments.keys()):
+            if k in argumentsWithPaths:
+                commandLine.extend(["/" + k + collapseBasedirInCmdPath(arg) for arg in arguments[k]])
+            else:
+                commandLine.extend(["/" + k + arg for arg in arguments[k]])
+
+        commandLine.extend(collapseBasedirInCmdPath(arg) for arg in inputFiles)
+        return commandLine
+
+    @staticmethod
+    def getManifestHash(compilerBinary, commandLine, sourceFile):
+        compilerHash = getCompilerHash(compilerBinary)
+        additionalData = "{}|{}|{}-{}".format(
+            compilerHash, ManifestRepository._normalizedCommandLine(commandLine),
+            ManifestRepository.MANIFEST_FILE_FORMAT_VERSION, hashAlgorithmName())
+        return getFileHash(sourceFile, additionalData)
+
+    @staticmethod
+    def getLegacyManifestHash(compilerBinary, commandLine, sourceFile):
+        """Returns the hash a JSON manifest for the compilation was stored
+        under, which was always computed using MD5"""
+        stat = os.stat(compilerBinary)
+        compilerHash = hashlib.md5('|'.join([str(stat.st_mtime), str(stat.st_size), VERSION]).encode("UTF-8"))
+        additionalData = "{}|{}|{}".format(
+            compilerHash.hexdigest(), ManifestRepository._normalizedCommandLine(commandLine),
+            ManifestRepository.LEGACY_MANIFEST_FILE_FORMAT_VERSION)
+        hasher = hashlib.md5()
+        with open(sourceFile, 'rb', buffering=0) as inFile:
+            updateHasherFromFile(hasher, inFile)
+        hasher.update(additionalData.encode("UTF-8"))
+        return hasher.hexdigest()
+
+    @staticmethod
+    def getIncludesContentHashForFiles(includes, hashCache=None):
+        try:
+            listOfHashes = getFileHashes(includes, hashCache)
+        except FileNotFoundError:
+            raise IncludeNotFoundException
+        return ManifestRepository.getIncludesContentHashForHashes(listOfHashes)
+
+    @staticmethod
+    def getIncludesContentHashForHashes(listOfHashes):
+        return createHasher(','.join(listOfHashes).encode()).hexdigest()
+
+
+class IncludeHashes:
+    """ Computes the content hashes of include files during a single manifest
+    lookup. Every include file is hashed at most once, no matter how many
+    manifest entries refer to it. Include files are identified by the paths
+    stored in the manifest, i.e. with the base directory collapsed.
+
+    prefetch() hashes many include files at once, using a single thread pool
+    and saving the FileHashCache once, rather than once per include file. A
+    prefetched hash counts as computed once hashFor() returns it. """
+    def __init__(self, hashCache=None):
+        self._hashCache = hashCache
+        self._hashes = {}
+        self._prefetched = set()
+        self._stats = {}
+        self.numComputed = 0
+        self.numReused = 0
+
+    def hashFor(self, includeFile):
+        """Returns the hash of the given include file or None if it doesn't exist"""
+        if includeFile in self._prefetched:
+            self._prefetched.remove(includeFile)
+            self.numComputed += 1
+            return self._hashes[includeFile]
+        if includeFile in self._hashes:
+            if self._hashes[includeFile] is not None:
+                self.numReused += 1
+            return self._hashes[includeFile]
+
+        try:
+            includeHash = getFileHashes([expandBasedirPlaceholder(includeFile)], self._hashCache)[0]
+            self.numComputed += 1
+        except FileNotFoundError:
+            includeHash = None
+        self._hashes[includeFile] = includeHash
+        return includeHash
+
+    def prefetch(self, includeFiles):
+        """Hashes those of the given include files which weren't hashed yet"""
+        missing = []
+        for includeFile in dict.fromkeys(includeFiles):
+            if includeFile in self._hashes:
+                continue
+            if os.path.isfile(expandBasedirPlaceholder(includeFile)):
+                missing.append(includeFile)
+            else:
+                self._hashes[includeFile] = None
+        if len(missing) < 2:
+            # Nothing to gain from hashing in parallel
+            return
+        try:
+            hashes = getFileHashes([expandBasedirPlaceholder(includeFile) for includeFile in missing],
+                                   self._hashCache)
+        except FileNotFoundError:
+            # Removed meanwhile; hashFor() hashes the remaining files one by one
+            return
+        self._hashes.update(zip(missing, hashes))
+        self._prefetched.update(missing)
+
+    def statFingerprint(self, includeFiles):
+        """Returns a hash of the sizes and modification times of the given
+        include files, or None if any of them doesn't exist or was modified
+        too recently to be identified by its modification time"""
+        stats = []
+        for includeFile in includeFiles:
+            if includeFile not in self._stats:
+                try:
+                    stat = os.stat(expandBasedirPlaceholder(includeFile))
+                    self._stats[includeFile] = None if modifiedRecently(stat) else \
+                        '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    self._stats[includeFile] = None
+            if self._stats[includeFile] is None:
+                return None
+            stats.append(self._stats[includeFile])
+        return getStringHash(','.join(stats))
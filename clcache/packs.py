@@ -0,0 +1,403 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from collections import defaultdict
+import os
+import struct
+import time
+from atomicwrites import atomic_write
+
+from .utils import childDirectories, DEFAULT_EVICTION_POLICY, ensureDirectoryExists, LogicException
+from .compression import CompressionPolicy
+from .locks import CacheLock
+from .entries import cacheKeyDigest, readCacheEntry, writeCacheEntry
+from .restore import copyBytes
+
+
+# Size of a pack file after which records are appended to a new pack file
+PACK_FILE_SIZE = 64 * 1024 * 1024
+
+# Pack files are compacted once less than this ratio of them is still in use
+PACK_MIN_LIVE_RATIO = 0.5
+
+
+class PackedCompilerArtifactsSection:
+    """ Stores the compiler artifacts of a section as records in a few large,
+    append-only pack files instead of a directory per cache entry.
+
+    Every record is a cache entry as written by writeCacheEntry(). Records
+    are appended to the pack file with the highest number until it exceeds
+    PACK_FILE_SIZE.
+
+    The index file is a hash table with linear probing which maps keys to
+    the pack file, offset and size of their record, together with the time
+    the entry was used last. An index slot is written only after its record
+    was flushed to disk, so a crash never leaves the index pointing at an
+    incomplete record. Removing entries rewrites the whole index without
+    them; their records stay behind as dead space in their pack file until
+    it is compacted.
+
+    Reading an entry takes no lock: records are never modified, the index is
+    only replaced atomically or extended by new slots, and a hit only
+    overwrites the time the entry was used last. A reader which looked up an
+    entry before its pack file was compacted fails to open it, like for an
+    entry which was removed. """
+    INDEX_FILE = 'index'
+    INDEX_MAGIC = b'CLPI'
+    INDEX_VERSION = 1
+    # magic, version, number of slots, number of used slots
+    INDEX_HEADER = struct.Struct('<4sHII')
+    # key digest, pack number, offset, size, last used
+    INDEX_SLOT = struct.Struct('<16sIQQd')
+    # last used, the trailing field of a slot
+    INDEX_SLOT_LAST_USED = struct.Struct('<d')
+    INITIAL_INDEX_SLOTS = 64
+    MAX_INDEX_LOAD_FACTOR = 0.6
+    EMPTY_KEY = bytes(16)
+
+    def __init__(self, packSectionDir, compressionPolicy=None):
+        self.packSectionDir = packSectionDir
+        self.compressionPolicy = compressionPolicy or CompressionPolicy()
+        self.lock = CacheLock.forPath(self.packSectionDir)
+
+    def indexPath(self):
+        return os.path.join(self.packSectionDir, PackedCompilerArtifactsSection.INDEX_FILE)
+
+    def packPath(self, packNumber):
+        return os.path.join(self.packSectionDir, '{}.pack'.format(packNumber))
+
+    def packNumbers(self):
+        try:
+            fileNames = os.listdir(self.packSectionDir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(fileName[:-len('.pack')]) for fileName in fileNames
+                      if fileName.endswith('.pack') and fileName[:-len('.pack')].isdigit())
+
+    @staticmethod
+    def _findSlot(readSlot, slotCount, keyDigest):
+        """Returns the index of the slot holding keyDigest together with the
+        slot, or the index of the free slot to use for it together with None"""
+        start = int.from_bytes(keyDigest[8:], 'little') % slotCount
+        for i in range(slotCount):
+            slotIndex = (start + i) % slotCount
+            slot = readSlot(slotIndex)
+            if slot[0] == PackedCompilerArtifactsSection.EMPTY_KEY:
+                return slotIndex, None
+            if slot[0] == keyDigest:
+                return slotIndex, slot
+        raise LogicException("pack index {} is full".format(slotCount))
+
+    @staticmethod
+    def _slotOffset(slotIndex):
+        return (PackedCompilerArtifactsSection.INDEX_HEADER.size +
+                slotIndex * PackedCompilerArtifactsSection.INDEX_SLOT.size)
+
+    @staticmethod
+    def _slotReader(indexFile):
+        """Returns a function reading the slot with a given index from indexFile"""
+        def readSlot(slotIndex):
+            indexFile.seek(PackedCompilerArtifactsSection._slotOffset(slotIndex))
+            return PackedCompilerArtifactsSection.INDEX_SLOT.unpack(
+                indexFile.read(PackedCompilerArtifactsSection.INDEX_SLOT.size))
+        return readSlot
+
+    @staticmethod
+    def _readIndexHeader(indexFile):
+        data = indexFile.read(PackedCompilerArtifactsSection.INDEX_HEADER.size)
+        if len(data) != PackedCompilerArtifactsSection.INDEX_HEADER.size:
+            raise ValueError("pack index is truncated")
+        magic, version, slotCount, usedSlots = PackedCompilerArtifactsSection.INDEX_HEADER.unpack(data)
+        if magic != PackedCompilerArtifactsSection.INDEX_MAGIC or \
+           version != PackedCompilerArtifactsSection.INDEX_VERSION or slotCount == 0:
+            raise ValueError("unsupported pack index format")
+        return slotCount, usedSlots
+
+    def _lookup(self, key, touch=False):
+        """Returns the index slot of key, or None if there is no such entry.
+        If touch is True, the time the entry was used last is updated."""
+        try:
+            indexFile = open(self.indexPath(), 'r+b' if touch else 'rb')
+        except FileNotFoundError:
+            return None
+        with indexFile:
+            try:
+                slotCount, _ = self._readIndexHeader(indexFile)
+            except ValueError:
+                return None
+            readSlot = self._slotReader(indexFile)
+            slotIndex, slot = self._findSlot(readSlot, slotCount, cacheKeyDigest(key))
+            if slot is None:
+                return None
+            if touch:
+                # Only the time is written, so a slot updated concurrently
+                # keeps pointing at its record
+                lastUsedField = PackedCompilerArtifactsSection.INDEX_SLOT_LAST_USED
+                indexFile.seek(self._slotOffset(slotIndex + 1) - lastUsedField.size)
+                indexFile.write(lastUsedField.pack(time.time()))
+            return slot
+
+    def _loadSlots(self):
+        """Returns all slots of the index which hold an entry"""
+        try:
+            with open(self.indexPath(), 'rb') as indexFile:
+                slotCount, _ = self._readIndexHeader(indexFile)
+                data = indexFile.read(slotCount * PackedCompilerArtifactsSection.INDEX_SLOT.size)
+        except (FileNotFoundError, ValueError):
+            return []
+        return [slot for slot in PackedCompilerArtifactsSection.INDEX_SLOT.iter_unpack(data)
+                if slot[0] != PackedCompilerArtifactsSection.EMPTY_KEY]
+
+    def _writeIndex(self, slots):
+        """Replaces the index by one holding the given slots"""
+        slotCount = PackedCompilerArtifactsSection.INITIAL_INDEX_SLOTS
+        while len(slots) + 1 > slotCount * PackedCompilerArtifactsSection.MAX_INDEX_LOAD_FACTOR:
+            slotCount *= 2
+        table = [PackedCompilerArtifactsSection.INDEX_SLOT.pack(PackedCompilerArtifactsSection.EMPTY_KEY, 0, 0, 0, 0)
+                 for _ in range(slotCount)]
+
+        def readSlot(slotIndex):
+            return PackedCompilerArtifactsSection.INDEX_SLOT.unpack(table[slotIndex])
+
+        for slot in slots:
+            slotIndex, _ = self._findSlot(readSlot, slotCount, slot[0])
+            table[slotIndex] = PackedCompilerArtifactsSection.INDEX_SLOT.pack(*slot)
+
+        ensureDirectoryExists(self.packSectionDir)
+        with atomic_write(self.indexPath(), mode='wb', overwrite=True) as indexFile:
+            indexFile.write(PackedCompilerArtifactsSection.INDEX_HEADER.pack(
+                PackedCompilerArtifactsSection.INDEX_MAGIC, PackedCompilerArtifactsSection.INDEX_VERSION,
+                slotCount, len(slots)))
+            indexFile.write(b''.join(table))
+
+    def _storeSlot(self, slot):
+        try:
+            indexFile = open(self.indexPath(), 'r+b')
+        except FileNotFoundError:
+            self._writeIndex([slot])
+            return
+        with indexFile:
+            try:
+                slotCount, usedSlots = self._readIndexHeader(indexFile)
+            except ValueError:
+                slotCount, usedSlots = 0, 0
+            if usedSlots + 1 > slotCount * PackedCompilerArtifactsSection.MAX_INDEX_LOAD_FACTOR:
+                indexFile.close()
+                self._writeIndex([s for s in self._loadSlots() if s[0] != slot[0]] + [slot])
+                return
+
+            readSlot = self._slotReader(indexFile)
+            slotIndex, oldSlot = self._findSlot(readSlot, slotCount, slot[0])
+            indexFile.seek(self._slotOffset(slotIndex))
+            indexFile.write(PackedCompilerArtifactsSection.INDEX_SLOT.pack(*slot))
+            if oldSlot is None:
+                indexFile.seek(0)
+                indexFile.write(PackedCompilerArtifactsSection.INDEX_HEADER.pack(
+                    PackedCompilerArtifactsSection.INDEX_MAGIC, PackedCompilerArtifactsSection.INDEX_VERSION,
+                    slotCount, usedSlots + 1))
+
+    def _appendPackNumber(self, excluded=()):
+        """Returns the number of the pack file new records are appended to"""
+        packNumbers = self.packNumbers()
+        if not packNumbers:
+            return 0
+        packNumber = packNumbers[-1]
+        if packNumber in excluded or os.path.getsize(self.packPath(packNumber)) >= PACK_FILE_SIZE:
+            return packNumber + 1
+        return packNumber
+
+    def cacheEntries(self):
+        return [slot[0].hex() for slot in self._loadSlots()]
+
+    def entryInfos(self):
+        """Returns (key, pack number, size, last used) for all entries"""
+        return [(slot[0].hex(), slot[1], slot[3], slot[4]) for slot in self._loadSlots()]
+
+    def hasEntry(self, key):
+        return self._lookup(key) is not None
+
+    def setEntry(self, key, artifacts):
+        ensureDirectoryExists(self.packSectionDir)
+        packNumber = self._appendPackNumber()
+        packPath = self.packPath(packNumber)
+        with open(packPath, 'r+b' if os.path.exists(packPath) else 'w+b') as packFile:
+            offset = packFile.seek(0, os.SEEK_END)
+            size = writeCacheEntry(packFile, key, artifacts, self.compressionPolicy)
+            packFile.flush()
+            os.fsync(packFile.fileno())
+
+        self._storeSlot((cacheKeyDigest(key), packNumber, offset, size, time.time()))
+        return size
+
+    def getEntry(self, key):
+        slot = self._lookup(key, touch=True)
+        if slot is None:
+            raise FileNotFoundError("no cache entry {} in {}".format(key, self.packSectionDir))
+        _, packNumber, offset, _, _ = slot
+        packPath = self.packPath(packNumber)
+        with open(packPath, 'rb') as packFile:
+            return readCacheEntry(packFile, packPath, key, offset)
+
+    def removeEntries(self, keys):
+        keyDigests = {cacheKeyDigest(key) for key in keys}
+        self._writeIndex([slot for slot in self._loadSlots() if slot[0] not in keyDigests])
+
+    def sparsePackNumbers(self, minLiveRatio=PACK_MIN_LIVE_RATIO):
+        """Returns the numbers of the pack files of which less than
+        minLiveRatio is taken by records which are still used"""
+        liveSizes = defaultdict(int)
+        for _, packNumber, _, size, _ in self._loadSlots():
+            liveSizes[packNumber] += size
+        return [packNumber for packNumber in self.packNumbers()
+                if liveSizes[packNumber] < os.path.getsize(self.packPath(packNumber)) * minLiveRatio]
+
+    def compact(self, packNumbers):
+        """Moves the records which are still used out of the given pack files
+        and removes them"""
+        packNumbers = set(packNumbers)
+        if not packNumbers:
+            return
+        slots = self._loadSlots()
+        moving = sorted((slot for slot in slots if slot[1] in packNumbers), key=lambda slot: (slot[1], slot[2]))
+        moved = {}
+        targetNumber = self._appendPackNumber(packNumbers)
+        targetFile = None
+        try:
+            for keyDigest, packNumber, offset, size, lastUsed in moving:
+                if targetFile is None or targetFile.tell() >= PACK_FILE_SIZE:
+                    if targetFile is not None:
+                        targetFile.flush()
+                        os.fsync(targetFile.fileno())
+                        targetFile.close()
+                        targetNumber += 1
+                    targetFile = open(self.packPath(targetNumber), 'ab')
+                newOffset = targetFile.tell()
+                with open(self.packPath(packNumber), 'rb') as packFile:
+                    packFile.seek(offset)
+                    copyBytes(packFile, targetFile, size)
+                moved[keyDigest] = (keyDigest, targetNumber, newOffset, size, lastUsed)
+            if targetFile is not None:
+                targetFile.flush()
+                os.fsync(targetFile.fileno())
+        finally:
+            if targetFile is not None:
+                targetFile.close()
+
+        self._writeIndex([moved.get(slot[0], slot) for slot in slots])
+        for packNumber in packNumbers:
+            try:
+                os.remove(self.packPath(packNumber))
+            except OSError:
+                # Still opened by a reader; it holds no used records anymore,
+                # so the next compaction removes it
+                pass
+
+
+class PackedCompilerArtifactsRepository:
+    def __init__(self, packsRootDir, compressionPolicy=None):
+        self._packsRootDir = packsRootDir
+        self.compressionPolicy = compressionPolicy or CompressionPolicy()
+
+    def section(self, key):
+        return PackedCompilerArtifactsSection(os.path.join(self._packsRootDir, key[:2]), self.compressionPolicy)
+
+    def sections(self):
+        return (PackedCompilerArtifactsSection(path, self.compressionPolicy)
+                for path in childDirectories(self._packsRootDir))
+
+    def removeEntry(self, keyToBeRemoved):
+        self.section(keyToBeRemoved).removeEntries([keyToBeRemoved])
+
+    @staticmethod
+    def indexEntries():
+        # Pack files have an index of their own
+        return iter(())
+
+    def _usage(self):
+        """Returns the sections, (last used, section index, key, pack number,
+        size) of all entries least recently used first, and [size on disk,
+        size in use] by (section index, pack number)"""
+        sections = list(self.sections())
+        entryInfos = []
+        packSizes = {}
+        for sectionIndex, section in enumerate(sections):
+            for packNumber in section.packNumbers():
+                packSizes[(sectionIndex, packNumber)] = [os.path.getsize(section.packPath(packNumber)), 0]
+            for key, packNumber, size, lastUsed in section.entryInfos():
+                entryInfos.append((lastUsed, sectionIndex, key, packNumber, size))
+                packSizes.setdefault((sectionIndex, packNumber), [0, 0])[1] += size
+        entryInfos.sort()
+        return sections, entryInfos, packSizes
+
+    @staticmethod
+    def _pickEntries(entryInfos, packSizes, maxCompilerArtifactsSize):
+        """Returns the (section index, key) of the entries to remove such that
+        the pack files fit into maxCompilerArtifactsSize, and their size
+        afterwards. Updates the sizes in use in packSizes accordingly."""
+        # Space of removed entries is reclaimed only by compacting their pack
+        # file, which happens once less than PACK_MIN_LIVE_RATIO of it is in
+        # use. Compacting copies the remaining records, so it is left to the
+        # eviction in the background (see compact()); only pack files without
+        # any record in use are removed right away.
+        def effectiveSize(packSize):
+            diskSize, liveSize = packSize
+            return liveSize if liveSize < diskSize * PACK_MIN_LIVE_RATIO else diskSize
+
+        currentSize = sum(effectiveSize(packSize) for packSize in packSizes.values())
+        removedEntries = []
+        for _, sectionIndex, key, packNumber, size in entryInfos:
+            if currentSize < maxCompilerArtifactsSize:
+                break
+            packSize = packSizes[(sectionIndex, packNumber)]
+            currentSize -= effectiveSize(packSize)
+            packSize[1] -= size
+            currentSize += effectiveSize(packSize)
+            removedEntries.append((sectionIndex, key))
+        return removedEntries, currentSize
+
+    # Pack files hold no hit counts or compile times, so entries are always
+    # removed least recently used first
+    def clean(self, maxCompilerArtifactsSize, evictionPolicy=DEFAULT_EVICTION_POLICY): # pylint: disable=unused-argument
+        sections, entryInfos, packSizes = self._usage()
+        removedEntries, currentSize = self._pickEntries(entryInfos, packSizes, maxCompilerArtifactsSize)
+        removedKeys = defaultdict(list)
+        for sectionIndex, key in removedEntries:
+            removedKeys[sectionIndex].append(key)
+
+        # Both reread the index, so entries added since it was read above are kept
+        for sectionIndex, section in enumerate(sections):
+            with section.lock:
+                if removedKeys[sectionIndex]:
+                    section.removeEntries(removedKeys[sectionIndex])
+                section.compact([packNumber for (i, packNumber), packSize in packSizes.items()
+                                 if i == sectionIndex and packSize[1] == 0])
+
+        return len(entryInfos) - len(removedEntries), currentSize
+
+    def evict(self, maxCompilerArtifactsSize, batchSize,
+              evictionPolicy=DEFAULT_EVICTION_POLICY): # pylint: disable=unused-argument
+        """Removes the entries clean() removes in batches of batchSize,
+        locking only the sections modified by a batch at a time. The pack
+        files are read once, since they have no index across sections.
+        Returns the number and size of the remaining entries like clean()."""
+        sections, entryInfos, packSizes = self._usage()
+        removedEntries, currentSize = self._pickEntries(entryInfos, packSizes, maxCompilerArtifactsSize)
+        for batchStart in range(0, len(removedEntries), batchSize):
+            removedKeys = defaultdict(list)
+            for sectionIndex, key in removedEntries[batchStart:batchStart + batchSize]:
+                removedKeys[sectionIndex].append(key)
+            for sectionIndex, keys in removedKeys.items():
+                with sections[sectionIndex].lock:
+                    sections[sectionIndex].removeEntries(keys)
+        return len(entryInfos) - len(removedEntries), currentSize
+
+    def compact(self):
+        """Compacts the pack files of which less than PACK_MIN_LIVE_RATIO is
+        still in use, locking one section at a time"""
+        for section in self.sections():
+            with section.lock:
+                section.compact(section.sparsePackNumbers())
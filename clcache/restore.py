@@ -0,0 +1,273 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+from shutil import copyfile, copyfileobj
+import errno
+import gzip
+import os
+import struct
+import sys
+import zlib
+from atomicwrites import atomic_write
+
+from .utils import COPY_CHUNK_SIZE, ensureDirectoryExists, fcntl, printTraceStatement
+from .compression import COMPRESSION_CODECS_BY_TAG, NO_COMPRESSION_CODEC
+
+
+def isGzipFile(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def copyOrLink(srcFilePath, dstFilePath, writeCache=False):
+    ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
+
+    if "CLCACHE_HARDLINK" in os.environ:
+        try:
+            os.link(srcFilePath, dstFilePath)
+        except OSError:
+            pass
+        else:
+            # Touch the time stamp of the new link so that the build system
+            # doesn't confused by a potentially old time on the file. The
+            # hard link gets the same timestamp as the cached file.
+            # Note that touching the time stamp of the link also touches
+            # the time stamp on the cache (and hence on all over hard
+            # links). This shouldn't be a problem though.
+            os.utime(dstFilePath, None)
+            return
+
+    # If hardlinking fails for some reason (or it's not enabled), just
+    # fall back to moving bytes around. Always to a temporary path first to
+    # lower the chances of corrupting it.
+    tempDst = dstFilePath + '.tmp'
+
+    if writeCache is True and "CLCACHE_COMPRESS" in os.environ:
+        if "CLCACHE_COMPRESSLEVEL" in os.environ:
+            compress = int(os.environ["CLCACHE_COMPRESSLEVEL"])
+        else:
+            compress = 6
+
+        with open(srcFilePath, 'rb') as fileIn, gzip.open(tempDst, 'wb', compress) as fileOut:
+            copyfileobj(fileIn, fileOut)
+    elif writeCache is False and isGzipFile(srcFilePath):
+        # Object files never start with the gzip magic number, so compressed
+        # files are restored regardless of the current setting
+        with gzip.open(srcFilePath, 'rb') as fileIn, open(tempDst, 'wb') as fileOut:
+            copyfileobj(fileIn, fileOut)
+    else:
+        copyfile(srcFilePath, tempDst)
+    os.replace(tempDst, dstFilePath)
+
+
+def copyBytes(fileIn, fileOut, size, decompressor=None):
+    """Copies size bytes from fileIn to fileOut, decompressing them using
+    decompressor if given, and returns the CRC32 of the bytes written"""
+    crc = 0
+    remaining = size
+    while remaining > 0:
+        chunk = fileIn.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise IOError("unexpected end of file {}".format(fileIn.name))
+        remaining -= len(chunk)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+            if remaining == 0:
+                chunk += decompressor.flush()
+        fileOut.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def copyFileRange(srcFilePath, offset, size, dstFilePath, crc=None, codecTag=NO_COMPRESSION_CODEC.tag):
+    ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
+    codec = COMPRESSION_CODECS_BY_TAG[codecTag]
+    tempDst = dstFilePath + '.tmp'
+    with open(srcFilePath, 'rb') as fileIn, open(tempDst, 'wb') as fileOut:
+        fileIn.seek(offset)
+        try:
+            actualCrc = copyBytes(fileIn, fileOut, size, codec.decompressor() if codec.decompressor else None)
+        except Exception:
+            fileOut.close()
+            os.remove(tempDst)
+            raise
+    if crc is not None and actualCrc != crc:
+        os.remove(tempDst)
+        raise IOError("cached object file in {} is corrupt".format(srcFilePath))
+    os.replace(tempDst, dstFilePath)
+
+
+class ObjectFileRestorer:
+    """ Restores object files from cache entries to their final location.
+
+    Uncompressed object files are restored using the first of RESTORE_METHODS
+    which works: a copy-on-write clone of the cached data, a copy performed by
+    the kernel via copy_file_range() or sendfile(), a hard link (only for
+    entries stored as directory and if CLCACHE_HARDLINK is set) or a copy
+    through a buffer. Methods which turn out to be unsupported are recorded in
+    statePath and not tried again; methods which fail only for the files given
+    fall back to the next method for this object file. Only the buffered copy verifies the CRC32
+    of the object file, since the other methods never see its contents. """
+    RESTORE_METHODS = ['reflink', 'copy_file_range', 'sendfile', 'link', 'copy']
+    # Error codes meaning that a method is not supported at all
+    UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS}
+    # Error codes meaning that a method doesn't work for the files given, e.g.
+    # since they are on different file systems or one of them is read-only
+    FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EPERM}
+    # ioctl requests for cloning a file or a range of a file on Linux
+    FICLONE = 0x40049409
+    FICLONERANGE = 0x4020940D
+    # Cloned ranges must start at a multiple of the file system block size
+    CLONE_ALIGNMENT = 4096
+
+    def __init__(self, statePath=None, methods=None):
+        self._statePath = statePath
+        self._methods = methods or ObjectFileRestorer.RESTORE_METHODS
+        self._restoreFunctions = {
+            'reflink': self._restoreViaReflink,
+            'copy_file_range': self._restoreViaCopyFileRange,
+            'sendfile': self._restoreViaSendfile,
+            'link': self._restoreViaLink,
+            'copy': self._restoreViaCopy,
+        }
+        self._unsupported = None
+        self.numSyscalls = 0
+        self.numBytesCopied = 0
+        self.lastMethod = None
+
+    def unsupportedMethods(self):
+        if self._unsupported is None:
+            self._unsupported = set()
+            if self._statePath is not None:
+                try:
+                    with open(self._statePath, 'r') as f:
+                        self._unsupported = set(f.read().split())
+                except FileNotFoundError:
+                    pass
+        return self._unsupported
+
+    def _markUnsupported(self, method):
+        printTraceStatement("Restoring object files via {} is not supported".format(method))
+        self.unsupportedMethods().add(method)
+        if self._statePath is not None:
+            with atomic_write(self._statePath, overwrite=True) as f:
+                f.write('\n'.join(sorted(self._unsupported)) + '\n')
+
+    def restore(self, artifacts, dstFilePath):
+        ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
+        srcFilePath = artifacts.objectFilePath
+        if artifacts.objectSize is None:
+            # Object file of an entry stored as directory
+            if isGzipFile(srcFilePath):
+                copyOrLink(srcFilePath, dstFilePath)
+                self.lastMethod = 'decompress'
+                return
+            offset, size, crc = 0, os.path.getsize(srcFilePath), None
+        elif artifacts.objectCodec != NO_COMPRESSION_CODEC.tag:
+            copyFileRange(srcFilePath, artifacts.objectOffset, artifacts.objectSize, dstFilePath,
+                          artifacts.objectCrc, artifacts.objectCodec)
+            self.numBytesCopied += artifacts.objectSize
+            self.lastMethod = 'decompress'
+            return
+        else:
+            offset, size, crc = artifacts.objectOffset, artifacts.objectSize, artifacts.objectCrc
+
+        tempDst = dstFilePath + '.tmp'
+        # Never write into a left-over temporary file, it may be a hard link
+        # to a cached object file. That's the case if it was linked to the
+        # same file as dstFilePath, since os.replace() leaves it alone then.
+        try:
+            os.remove(tempDst)
+        except FileNotFoundError:
+            pass
+        restoredVia = None
+        for method in self._methods:
+            if method in self.unsupportedMethods():
+                continue
+            try:
+                if self._restoreFunctions[method](srcFilePath, offset, size, tempDst, crc):
+                    restoredVia = method
+                    break
+            except OSError as e:
+                if method == 'copy':
+                    raise
+                if e.errno in ObjectFileRestorer.UNSUPPORTED_ERRNOS:
+                    self._markUnsupported(method)
+                elif e.errno not in ObjectFileRestorer.FALLBACK_ERRNOS:
+                    raise
+        assert restoredVia is not None
+        self.lastMethod = restoredVia
+        os.replace(tempDst, dstFilePath)
+        if restoredVia == 'link':
+            # See copyOrLink()
+            os.utime(dstFilePath, None)
+
+    # The _restoreVia*() functions return False if the method doesn't apply to
+    # the given object file, and raise OSError if it is not supported.
+
+    def _restoreViaReflink(self, srcFilePath, offset, size, dstFilePath, _):
+        if fcntl is None:
+            raise OSError(errno.ENOSYS, "cloning files is not supported on this platform")
+        with open(srcFilePath, 'rb') as fileIn:
+            # A cloned range must be aligned, unless it extends to the end of the file
+            srcSize = os.fstat(fileIn.fileno()).st_size
+            if offset % ObjectFileRestorer.CLONE_ALIGNMENT != 0 or offset + size != srcSize:
+                return False
+            with open(dstFilePath, 'wb') as fileOut:
+                self.numSyscalls += 1
+                if offset == 0:
+                    fcntl.ioctl(fileOut.fileno(), ObjectFileRestorer.FICLONE, fileIn.fileno())
+                else:
+                    # struct file_clone_range
+                    cloneRange = struct.pack('=qQQQ', fileIn.fileno(), offset, size, 0)
+                    fcntl.ioctl(fileOut.fileno(), ObjectFileRestorer.FICLONERANGE, cloneRange)
+        return True
+
+    def _restoreViaKernelCopy(self, copyFunction, srcFilePath, offset, size, dstFilePath):
+        with open(srcFilePath, 'rb') as fileIn, open(dstFilePath, 'wb') as fileOut:
+            copied = 0
+            while copied < size:
+                self.numSyscalls += 1
+                count = copyFunction(fileIn.fileno(), fileOut.fileno(), offset + copied, size - copied)
+                if count == 0:
+                    raise IOError("unexpected end of file {}".format(srcFilePath))
+                copied += count
+        return True
+
+    def _restoreViaCopyFileRange(self, srcFilePath, offset, size, dstFilePath, _):
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, "copy_file_range() is not supported on this platform")
+        return self._restoreViaKernelCopy(
+            lambda fdIn, fdOut, offset, count: os.copy_file_range(fdIn, fdOut, count, offset),
+            srcFilePath, offset, size, dstFilePath)
+
+    def _restoreViaSendfile(self, srcFilePath, offset, size, dstFilePath, _):
+        # Only Linux supports sendfile() to regular files
+        if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "sendfile() is not supported on this platform")
+        return self._restoreViaKernelCopy(
+            lambda fdIn, fdOut, offset, count: os.sendfile(fdOut, fdIn, offset, count),
+            srcFilePath, offset, size, dstFilePath)
+
+    def _restoreViaLink(self, srcFilePath, offset, size, dstFilePath, _):
+        if "CLCACHE_HARDLINK" not in os.environ or offset != 0 or size != os.path.getsize(srcFilePath):
+            return False
+        self.numSyscalls += 1
+        os.link(srcFilePath, dstFilePath)
+        return True
+
+    def _restoreViaCopy(self, srcFilePath, offset, size, dstFilePath, crc):
+        with open(srcFilePath, 'rb') as fileIn, open(dstFilePath, 'wb') as fileOut:
+            fileIn.seek(offset)
+            actualCrc = copyBytes(fileIn, fileOut, size)
+        # One read and one write per chunk, plus the read hitting the end of the file
+        self.numSyscalls += 2 * -(-size // COPY_CHUNK_SIZE) + 1
+        self.numBytesCopied += size
+        if crc is not None and actualCrc != crc:
+            os.remove(dstFilePath)
+            raise IOError("cached object file in {} is corrupt".format(srcFilePath))
+        return True
@@ -1,5 +1,6 @@
 # We often don't use all members of all the pyuv callbacks
 # pylint: disable=unused-argument
+import functools
 import hashlib
 import logging
 import os
@@ -10,13 +11,27 @@ import re
 
 import pyuv
 
+# Needs to match the hash algorithms supported by clcache (CLCACHE_HASH)
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=16),
+}
+try:
+    import xxhash # pylint: disable=wrong-import-position
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+except (ImportError, AttributeError):
+    pass
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
 class HashCache:
-    def __init__(self, loop, excludePatterns, disableWatching):
+    def __init__(self, loop, excludePatterns, disableWatching, hashAlgorithm='md5'):
         self._loop = loop
         self._watchedDirectories = {}
         self._handlers = []
         self._excludePatterns = excludePatterns or []
         self._disableWatching = disableWatching
+        self._hashAlgorithm = HASH_ALGORITHMS[hashAlgorithm]
 
     def getFileHash(self, path):
         logging.debug("getting hash for %s", path)
@@ -28,8 +43,11 @@ class HashCache:
             logging.debug("using cached hashsum %s", hashsum)
             return hashsum
 
+        hasher = self._hashAlgorithm()
         with open(path, 'rb') as f:
-            hashsum = hashlib.md5(f.read()).hexdigest()
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        hashsum = hasher.hexdigest()
 
         watchedDirectory[basename] = hashsum
         if dirname not in self._watchedDirectories and not self.isExcluded(dirname) and not self._disableWatching:
@@ -134,6 +152,9 @@ def main():
                               multiple times. Example: --exclude \\\\build\\\\')
     parser.add_argument('--disable_watching', action='store_true', help='Disable watching of directories which \
                          we have in the cache.')
+    parser.add_argument('--hash', choices=sorted(HASH_ALGORITHMS), default=os.environ.get('CLCACHE_HASH', 'md5'),
+                        help='Hash algorithm to use, needs to match the CLCACHE_HASH setting of clcache. \
+                              Defaults to the value of CLCACHE_HASH, or md5.')
     args = parser.parse_args()
 
     for pattern in args.exclude or []:
@@ -144,7 +165,9 @@ def main():
 
     eventLoop = pyuv.Loop.default_loop()
 
-    cache = HashCache(eventLoop, vars(args)['exclude'], args.disable_watching)
+    logging.info("Using hash algorithm %s", args.hash)
+
+    cache = HashCache(eventLoop, vars(args)['exclude'], args.disable_watching, args.hash)
 
     server = PipeServer(eventLoop, r'\\.\pipe\clcache_srv', cache)
     server.listen()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+"""Replays an access trace on a simulated cache to compare the hit rates and
+compile time saved by the eviction policies.
+
+A trace is a CSV file with one line key,size,compileTime per compilation, in
+the order of the compilations: the cache key, the size of the cache entry in
+bytes and the time the real compiler took in seconds."""
+from collections import namedtuple
+import argparse
+import bisect
+import csv
+import itertools
+import random
+import sys
+
+from .__main__ import CLEAN_LOW_WATERMARK
+from .index import CacheIndex
+from .utils import EVICTION_POLICIES
+
+SimulationResult = namedtuple('SimulationResult', ['hits', 'misses', 'timeSaved', 'timeSpent'])
+
+
+def simulate(trace, maximumSize, evictionPolicy):
+    """Replays the (key, size, compileTime) accesses of the trace on a cache of
+    maximumSize bytes. Once the cache exceeds it, entries are removed in the
+    order of the eviction policy like by clean(). Returns the number of hits
+    and misses and the compile time saved by hits and spent on misses."""
+    clock = itertools.count()
+    index = CacheIndex(':memory:', clock=lambda: next(clock))
+    cachedKeys = set()
+    currentSize = 0
+    hits, misses, timeSaved, timeSpent = 0, 0, 0.0, 0.0
+    try:
+        for key, size, compileTime in trace:
+            if key in cachedKeys:
+                hits += 1
+                timeSaved += compileTime
+                index.registerHit(CacheIndex.OBJECT, key)
+                continue
+
+            misses += 1
+            timeSpent += compileTime
+            index.addEntry(CacheIndex.OBJECT, key, size, cost=compileTime)
+            cachedKeys.add(key)
+            currentSize += size
+            if currentSize < maximumSize:
+                continue
+
+            removedKeys = []
+            for removedKey, removedSize, _ in index.entries(CacheIndex.OBJECT, evictionPolicy=evictionPolicy):
+                removedKeys.append(removedKey)
+                currentSize -= removedSize
+                if currentSize < maximumSize * CLEAN_LOW_WATERMARK:
+                    break
+            index.removeEntries(CacheIndex.OBJECT, removedKeys)
+            cachedKeys.difference_update(removedKeys)
+    finally:
+        index.close()
+    return SimulationResult(hits, misses, timeSaved, timeSpent)
+
+
+def readTrace(traceFile):
+    with open(traceFile, newline='') as f:
+        return [(key, int(size), float(compileTime)) for key, size, compileTime in csv.reader(f)]
+
+
+def syntheticTrace(numAccesses, numKeys, seed=0):
+    """Returns a trace of numAccesses compilations of numKeys cache entries.
+    Entries are compiled with Zipf-like frequencies, and their sizes and
+    compile times vary independently, like headers-only code which takes long
+    to compile into small object files."""
+    rng = random.Random(seed)
+    entries = [('{:08x}'.format(i), int(rng.lognormvariate(11, 1)), rng.lognormvariate(0, 1.5))
+               for i in range(numKeys)]
+    cumulativeWeights = list(itertools.accumulate(1 / (rank + 1) for rank in range(numKeys)))
+    return [entries[bisect.bisect(cumulativeWeights, rng.random() * cumulativeWeights[-1])]
+            for _ in range(numAccesses)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the eviction policies of clcache on an access trace")
+    parser.add_argument("trace", nargs="?", default=None,
+                        help="CSV file with lines key,size,compileTime; a synthetic trace is used if omitted")
+    parser.add_argument("-M", "--size", dest="maximum_size", type=int, default=64 * 1024 * 1024,
+                        help="maximum cache size (in bytes)")
+    options = parser.parse_args()
+
+    trace = readTrace(options.trace) if options.trace else syntheticTrace(100000, 10000)
+    print("policy  hit rate  time saved  time spent")
+    for evictionPolicy in EVICTION_POLICIES:
+        result = simulate(trace, options.maximum_size, evictionPolicy)
+        print("{:6}  {:8.1%}  {:9.0f}s  {:9.0f}s".format(
+            evictionPolicy, result.hits / max(len(trace), 1), result.timeSaved, result.timeSpent))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
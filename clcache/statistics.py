@@ -0,0 +1,515 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List
+from atomicwrites import atomic_write
+
+from .utils import DEFAULT_EVICTION_POLICY, ensureDirectoryExists, printErrStr
+from .locks import CacheLock, CacheLockException
+
+
+# Number of locks with the longest total wait time listed in the statistics
+NUM_REPORTED_SLOWEST_LOCKS = 5
+# Statistics updates are journaled as records of their own, which are folded
+# into the statistics file when it is read, or once it is older than this many
+# seconds.
+STATISTICS_COMPACTION_INTERVAL = 60
+# Statistics updates of the source files compiled by a single invocation are
+# journaled together, at least every this many seconds
+STATISTICS_BATCH_INTERVAL = 10
+
+
+class PersistentJSONDict:
+    def __init__(self, fileName):
+        self._dirty = False
+        self._dict = {}
+        self._fileName = fileName
+        try:
+            with open(self._fileName, 'r') as f:
+                self._dict = json.load(f)
+        except IOError:
+            pass
+        except ValueError:
+            printErrStr("clcache: persistent json file %s was broken" % fileName)
+
+    def save(self):
+        if self._dirty:
+            with atomic_write(self._fileName, overwrite=True) as f:
+                json.dump(self._dict, f, sort_keys=True, indent=4)
+
+    def __setitem__(self, key, value):
+        self._dict[key] = value
+        self._dirty = True
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __delitem__(self, key):
+        del self._dict[key]
+        self._dirty = True
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def items(self):
+        return self._dict.items()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+
+class Configuration:
+    _defaultValues = {"MaximumCacheSize": 1073741824, # 1 GiB
+                      "EvictionPolicy": DEFAULT_EVICTION_POLICY}
+
+    def __init__(self, configurationFile):
+        self._configurationFile = configurationFile
+        self._cfg = None
+        self.lock = CacheLock.forPath(self._configurationFile)
+
+    def __enter__(self):
+        self._cfg = PersistentJSONDict(self._configurationFile)
+        for setting, defaultValue in self._defaultValues.items():
+            if setting not in self._cfg:
+                self._cfg[setting] = defaultValue
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        # Does not write to disc when unchanged
+        self._cfg.save()
+
+    def maximumCacheSize(self):
+        return self._cfg["MaximumCacheSize"]
+
+    def setMaximumCacheSize(self, size):
+        self._cfg["MaximumCacheSize"] = size
+
+    def evictionPolicy(self):
+        return self._cfg["EvictionPolicy"]
+
+    def setEvictionPolicy(self, policy):
+        self._cfg["EvictionPolicy"] = policy
+
+
+class Statistics:
+    CALLS_WITH_INVALID_ARGUMENT = "CallsWithInvalidArgument"
+    CALLS_WITHOUT_SOURCE_FILE = "CallsWithoutSourceFile"
+    CALLS_WITH_MULTIPLE_SOURCE_FILES = "CallsWithMultipleSourceFiles"
+    CALLS_WITH_PCH = "CallsWithPch"
+    CALLS_FOR_LINKING = "CallsForLinking"
+    CALLS_FOR_EXTERNAL_DEBUG_INFO = "CallsForExternalDebugInfo"
+    CALLS_FOR_PREPROCESSING = "CallsForPreprocessing"
+    CACHE_HITS = "CacheHits"
+    CACHE_MISSES = "CacheMisses"
+    EVICTED_MISSES = "EvictedMisses"
+    HEADER_CHANGED_MISSES = "HeaderChangedMisses"
+    SOURCE_CHANGED_MISSES = "SourceChangedMisses"
+    CACHE_ENTRIES = "CacheEntries"
+    CACHE_SIZE = "CacheSize"
+    HASH_CACHE_HITS = "HashCacheHits"
+    HASH_CACHE_MISSES = "HashCacheMisses"
+    COMPRESSION_INPUT_SIZE = "CompressionInputSize"
+    COMPRESSION_OUTPUT_SIZE = "CompressionOutputSize"
+    COMPRESSION_CPU_TIME = "CompressionCpuTime"
+    DEDUPLICATION_INPUT_SIZE = "DeduplicationInputSize"
+    DEDUPLICATION_STORED_SIZE = "DeduplicationStoredSize"
+    # Number of acquisitions, total and longest wait in seconds, by locked path
+    LOCK_WAITS = "LockWaits"
+    # Names of the journal records folded into the statistics file already,
+    # which may not have been removed yet
+    FOLDED_JOURNAL_RECORDS = "FoldedJournalRecords"
+    JOURNAL_RECORD_SUFFIX = '.delta'
+
+    RESETTABLE_KEYS = {
+        CALLS_WITH_INVALID_ARGUMENT,
+        CALLS_WITHOUT_SOURCE_FILE,
+        CALLS_WITH_MULTIPLE_SOURCE_FILES,
+        CALLS_WITH_PCH,
+        CALLS_FOR_LINKING,
+        CALLS_FOR_EXTERNAL_DEBUG_INFO,
+        CALLS_FOR_PREPROCESSING,
+        CACHE_HITS,
+        CACHE_MISSES,
+        EVICTED_MISSES,
+        HEADER_CHANGED_MISSES,
+        SOURCE_CHANGED_MISSES,
+        HASH_CACHE_HITS,
+        HASH_CACHE_MISSES,
+        COMPRESSION_INPUT_SIZE,
+        COMPRESSION_OUTPUT_SIZE,
+        COMPRESSION_CPU_TIME,
+        DEDUPLICATION_INPUT_SIZE,
+        DEDUPLICATION_STORED_SIZE,
+    }
+    NON_RESETTABLE_KEYS = {
+        CACHE_ENTRIES,
+        CACHE_SIZE,
+    }
+
+    def __init__(self, statsFile):
+        self._statsFile = statsFile
+        self._journalDir = os.path.splitext(statsFile)[0] + '.journal'
+        self._stats = None
+        self._foldedRecords = [] # type: List[str]
+        self.lock = CacheLock.forPath(self._statsFile)
+
+    def __enter__(self):
+        self._stats = PersistentJSONDict(self._statsFile)
+        self._setDefaults()
+        self._foldJournal()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        # Does not write to disc when unchanged
+        self._stats.save()
+        # Records are removed only once the statistics file includes them
+        self._removeJournalRecords(self._foldedRecords)
+        self._foldedRecords = []
+
+    def _setDefaults(self):
+        for k in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
+            if k not in self._stats:
+                self._stats[k] = 0
+        if Statistics.LOCK_WAITS not in self._stats:
+            self._stats[Statistics.LOCK_WAITS] = {}
+
+    def delta(self):
+        """Returns a StatisticsDelta for recording updates of these statistics
+        without locking them"""
+        return StatisticsDelta(self._statsFile)
+
+    def batch(self):
+        """Returns a StatisticsBatch collecting all deltas of these statistics
+        recorded by this process meanwhile"""
+        return StatisticsBatch(self._statsFile)
+
+    def _journalRecords(self):
+        try:
+            names = os.listdir(self._journalDir)
+        except FileNotFoundError:
+            return []
+        return [name for name in names if name.endswith(Statistics.JOURNAL_RECORD_SUFFIX)]
+
+    def _removeJournalRecords(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self._journalDir, name))
+            except OSError:
+                pass
+
+    def _foldJournal(self):
+        """Adds the changes recorded in the journal. A crash after saving the
+        statistics but before removing the folded records is recovered from by
+        remembering their names in the statistics file."""
+        previouslyFolded = set()
+        if Statistics.FOLDED_JOURNAL_RECORDS in self._stats:
+            previouslyFolded = set(self._stats[Statistics.FOLDED_JOURNAL_RECORDS])
+        self._removeJournalRecords(previouslyFolded)
+
+        folded = []
+        for name in self._journalRecords():
+            if name in previouslyFolded:
+                continue
+            try:
+                with open(os.path.join(self._journalDir, name), 'r') as f:
+                    record = json.load(f)
+            except (IOError, ValueError):
+                continue
+            self._addChanges(record)
+            folded.append(name)
+
+        if folded or previouslyFolded:
+            self._stats[Statistics.FOLDED_JOURNAL_RECORDS] = folded
+        self._foldedRecords = folded
+
+    def _addChanges(self, changes):
+        for key, value in changes.items():
+            if key == Statistics.LOCK_WAITS:
+                for path, waits in value.items():
+                    self._addLockWaits(path, *waits)
+            elif key in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
+                self._stats[key] += value
+
+    def compactIfStale(self):
+        """Folds the journal into the statistics file if that wasn't updated
+        for STATISTICS_COMPACTION_INTERVAL, unless another process is at it
+        already"""
+        try:
+            if time.time() - os.path.getmtime(self._statsFile) < STATISTICS_COMPACTION_INTERVAL:
+                return
+        except OSError:
+            pass
+        try:
+            with CacheLock.forPath(self._statsFile, 0), Statistics(self._statsFile):
+                pass
+        except CacheLockException:
+            pass
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def numCallsWithInvalidArgument(self):
+        return self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT]
+
+    def registerCallWithInvalidArgument(self):
+        self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT] += 1
+
+    def numCallsWithoutSourceFile(self):
+        return self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE]
+
+    def registerCallWithoutSourceFile(self):
+        self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE] += 1
+
+    def numCallsWithMultipleSourceFiles(self):
+        return self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES]
+
+    def registerCallWithMultipleSourceFiles(self):
+        self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES] += 1
+
+    def numCallsWithPch(self):
+        return self._stats[Statistics.CALLS_WITH_PCH]
+
+    def registerCallWithPch(self):
+        self._stats[Statistics.CALLS_WITH_PCH] += 1
+
+    def numCallsForLinking(self):
+        return self._stats[Statistics.CALLS_FOR_LINKING]
+
+    def registerCallForLinking(self):
+        self._stats[Statistics.CALLS_FOR_LINKING] += 1
+
+    def numCallsForExternalDebugInfo(self):
+        return self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO]
+
+    def registerCallForExternalDebugInfo(self):
+        self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO] += 1
+
+    def numEvictedMisses(self):
+        return self._stats[Statistics.EVICTED_MISSES]
+
+    def registerEvictedMiss(self):
+        self.registerCacheMiss()
+        self._stats[Statistics.EVICTED_MISSES] += 1
+
+    def numHeaderChangedMisses(self):
+        return self._stats[Statistics.HEADER_CHANGED_MISSES]
+
+    def registerHeaderChangedMiss(self):
+        self.registerCacheMiss()
+        self._stats[Statistics.HEADER_CHANGED_MISSES] += 1
+
+    def numSourceChangedMisses(self):
+        return self._stats[Statistics.SOURCE_CHANGED_MISSES]
+
+    def registerSourceChangedMiss(self):
+        self.registerCacheMiss()
+        self._stats[Statistics.SOURCE_CHANGED_MISSES] += 1
+
+    def numCacheEntries(self):
+        return self._stats[Statistics.CACHE_ENTRIES]
+
+    def setNumCacheEntries(self, number):
+        self._stats[Statistics.CACHE_ENTRIES] = number
+
+    def registerCacheEntry(self, size):
+        self._stats[Statistics.CACHE_ENTRIES] += 1
+        self._stats[Statistics.CACHE_SIZE] += size
+
+    def unregisterCacheEntry(self, size):
+        self._stats[Statistics.CACHE_ENTRIES] -= 1
+        self._stats[Statistics.CACHE_SIZE] -= size
+
+    def currentCacheSize(self):
+        return self._stats[Statistics.CACHE_SIZE]
+
+    def setCacheSize(self, size):
+        self._stats[Statistics.CACHE_SIZE] = size
+
+    def numCacheHits(self):
+        return self._stats[Statistics.CACHE_HITS]
+
+    def registerCacheHit(self):
+        self._stats[Statistics.CACHE_HITS] += 1
+
+    def numCacheMisses(self):
+        return self._stats[Statistics.CACHE_MISSES]
+
+    def registerCacheMiss(self):
+        self._stats[Statistics.CACHE_MISSES] += 1
+
+    def numCallsForPreprocessing(self):
+        return self._stats[Statistics.CALLS_FOR_PREPROCESSING]
+
+    def registerCallForPreprocessing(self):
+        self._stats[Statistics.CALLS_FOR_PREPROCESSING] += 1
+
+    def numHashCacheHits(self):
+        return self._stats[Statistics.HASH_CACHE_HITS]
+
+    def registerHashCacheHits(self, count):
+        self._stats[Statistics.HASH_CACHE_HITS] += count
+
+    def numHashCacheMisses(self):
+        return self._stats[Statistics.HASH_CACHE_MISSES]
+
+    def registerHashCacheMisses(self, count):
+        self._stats[Statistics.HASH_CACHE_MISSES] += count
+
+    def compressionRatio(self):
+        inputSize = self._stats[Statistics.COMPRESSION_INPUT_SIZE]
+        if inputSize == 0:
+            return None
+        return self._stats[Statistics.COMPRESSION_OUTPUT_SIZE] / inputSize
+
+    def compressionCpuTime(self):
+        return self._stats[Statistics.COMPRESSION_CPU_TIME]
+
+    def registerCompression(self, inputSize, outputSize, cpuTime):
+        self._stats[Statistics.COMPRESSION_INPUT_SIZE] += inputSize
+        self._stats[Statistics.COMPRESSION_OUTPUT_SIZE] += outputSize
+        self._stats[Statistics.COMPRESSION_CPU_TIME] += cpuTime
+
+    def deduplicationRatio(self):
+        storedSize = self._stats[Statistics.DEDUPLICATION_STORED_SIZE]
+        if storedSize == 0:
+            return None
+        return self._stats[Statistics.DEDUPLICATION_INPUT_SIZE] / storedSize
+
+    def registerDeduplication(self, inputSize, storedSize):
+        self._stats[Statistics.DEDUPLICATION_INPUT_SIZE] += inputSize
+        self._stats[Statistics.DEDUPLICATION_STORED_SIZE] += storedSize
+
+    def slowestLocks(self, count):
+        """Returns (path, acquisitions, total wait, longest wait) for the count
+        locks waited for longest in total"""
+        waits = [(path,) + tuple(values) for path, values in self._stats[Statistics.LOCK_WAITS].items()]
+        return sorted(waits, key=lambda t: t[2], reverse=True)[:count]
+
+    def registerLockWaits(self, path, count, totalWait, maxWait):
+        # Locks are named relative to the cache directory
+        cacheDir = os.path.dirname(self._statsFile)
+        if path.startswith(cacheDir + os.sep):
+            path = path[len(cacheDir) + 1:]
+        self._addLockWaits(path, count, totalWait, maxWait)
+
+    def _addLockWaits(self, path, count, totalWait, maxWait):
+        lockWaits = dict(self._stats[Statistics.LOCK_WAITS])
+        previousCount, previousTotalWait, previousMaxWait = lockWaits.get(path, (0, 0.0, 0.0))
+        lockWaits[path] = [previousCount + count, previousTotalWait + totalWait, max(previousMaxWait, maxWait)]
+        self._stats[Statistics.LOCK_WAITS] = lockWaits
+
+    def resetCounters(self):
+        for k in Statistics.RESETTABLE_KEYS:
+            self._stats[k] = 0
+        self._stats[Statistics.LOCK_WAITS] = {}
+
+
+class StatisticsDelta(Statistics):
+    """ Records updates of the statistics in memory and, on exit, appends them
+    to the journal of the statistics file as a record of its own, so updating
+    the statistics takes no lock. While a StatisticsBatch for the statistics
+    file is in progress, the updates are added to the batch instead. The
+    counters of a delta are the changes only, except for currentCacheSize(),
+    which includes the size last folded into the statistics file and the size
+    added by the batch. """
+    def __enter__(self):
+        self._stats = {}
+        self._setDefaults()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        batch = StatisticsBatch.forStatisticsFile(self._statsFile)
+        if batch is not None:
+            batch.add(self)
+        else:
+            self.commit()
+
+    def commit(self):
+        if self.writeRecord():
+            self.compactIfStale()
+
+    def add(self, other):
+        """Adds the changes recorded by another delta"""
+        self._addChanges(other._stats) # pylint: disable=protected-access
+
+    def writeRecord(self):
+        """Appends the recorded changes to the journal, if there are any, and
+        starts over. Returns whether a record was written."""
+        record = {key: value for key, value in self._stats.items() if value}
+        if not record:
+            return False
+        ensureDirectoryExists(self._journalDir)
+        recordPath = os.path.join(self._journalDir, uuid.uuid4().hex + Statistics.JOURNAL_RECORD_SUFFIX)
+        # Records are renamed into place so that they are never read incomplete
+        with open(recordPath + '.new', 'w') as f:
+            json.dump(record, f)
+        os.replace(recordPath + '.new', recordPath)
+        self._stats = {}
+        self._setDefaults()
+        return True
+
+    def currentCacheSize(self):
+        snapshot = PersistentJSONDict(self._statsFile)
+        foldedSize = snapshot[Statistics.CACHE_SIZE] if Statistics.CACHE_SIZE in snapshot else 0
+        batch = StatisticsBatch.forStatisticsFile(self._statsFile)
+        batchSize = batch.addedCacheSize() if batch is not None else 0
+        return foldedSize + batchSize + self.addedCacheSize()
+
+    def addedCacheSize(self):
+        return self._stats[Statistics.CACHE_SIZE]
+
+
+class StatisticsBatch:
+    """ Collects the StatisticsDeltas recorded by all threads of this process
+    for a statistics file while it is in progress, and journals them as a
+    single record on exit, or every STATISTICS_BATCH_INTERVAL seconds.
+    Compiling many source files at once thus writes one journal record
+    instead of one per source file. """
+    # Batches in progress by statistics file
+    _batches = {} # type: Dict[str, StatisticsBatch]
+    _batchesLock = threading.Lock()
+
+    def __init__(self, statsFile):
+        self._statsFile = statsFile
+        self._delta = StatisticsDelta(statsFile)
+        self._lock = threading.Lock()
+        self._lastWrite = None
+
+    def __enter__(self):
+        self._delta.__enter__()
+        self._lastWrite = time.monotonic()
+        with StatisticsBatch._batchesLock:
+            assert self._statsFile not in StatisticsBatch._batches
+            StatisticsBatch._batches[self._statsFile] = self
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        with StatisticsBatch._batchesLock:
+            del StatisticsBatch._batches[self._statsFile]
+        with self._lock:
+            self._delta.commit()
+
+    @staticmethod
+    def forStatisticsFile(statsFile):
+        with StatisticsBatch._batchesLock:
+            return StatisticsBatch._batches.get(statsFile)
+
+    def add(self, delta):
+        with self._lock:
+            self._delta.add(delta)
+            if time.monotonic() - self._lastWrite >= STATISTICS_BATCH_INTERVAL:
+                self._delta.commit()
+                self._lastWrite = time.monotonic()
+
+    def addedCacheSize(self):
+        with self._lock:
+            return self._delta.addedCacheSize()
@@ -1,19 +1,12 @@
-import contextlib
-
 from pymemcache.client.base import Client
 from pymemcache.serde import (python_memcache_serializer,
                               python_memcache_deserializer)
 
-from .__main__ import CacheFileStrategy, getStringHash, printTraceStatement, CompilerArtifacts, \
-    CACHE_COMPILER_OUTPUT_STORAGE_CODEC
-
-
-class CacheDummyLock:
-    def __enter__(self):
-        pass
-
-    def __exit__(self, typ, value, traceback):
-        pass
+from .__main__ import CacheFileStrategy
+from .entries import CompilerArtifacts
+from .hashing import getStringHash
+from .locks import CacheDummyLock
+from .utils import DEFAULT_EVICTION_POLICY, printTraceStatement
 
 
 class CacheMemcacheStrategy:
@@ -21,7 +14,6 @@ class CacheMemcacheStrategy:
         self.fileStrategy = CacheFileStrategy(cacheDirectory=cacheDirectory)
         # XX Memcache Strategy should be independent
 
-        self.lock = CacheDummyLock()
         self.localCache = {}
         self.localManifest = {}
         self.objectPrefix = objectPrefix
@@ -78,6 +70,22 @@ class CacheMemcacheStrategy:
     def statistics(self):
         return self.fileStrategy.statistics
 
+    @property
+    def fileHashCache(self):
+        return self.fileStrategy.fileHashCache
+
+    @property
+    def compressionPolicy(self):
+        return self.fileStrategy.compressionPolicy
+
+    @property
+    def blobStore(self):
+        return self.fileStrategy.blobStore
+
+    @property
+    def objectFileRestorer(self):
+        return self.fileStrategy.objectFileRestorer
+
     @property
     def configuration(self):
         return self.fileStrategy.configuration
@@ -86,6 +94,10 @@ class CacheMemcacheStrategy:
     def lockFor(_):
         return CacheDummyLock()
 
+    @staticmethod
+    def readLockFor(_):
+        return CacheDummyLock()
+
     @staticmethod
     def manifestLockFor(_):
         return CacheDummyLock()
@@ -120,23 +132,22 @@ class CacheMemcacheStrategy:
         with self.fileStrategy.lockFor(key):
             objectFilePath = self.fileStrategy.deserializeCacheEntry(key, data[0])
 
-        return CompilerArtifacts(objectFilePath,
-                                 data[1].decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
-                                 data[2].decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
-                                )
+        return CompilerArtifacts(objectFilePath, data[1], data[2])
 
     def setEntry(self, key, artifacts):
         assert artifacts.objectFilePath
         with open(artifacts.objectFilePath, 'rb') as objectFile:
             self._setIgnoreExc(self.objectPrefix + key,
-                               [objectFile.read(),
-                                artifacts.stdout.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
-                                artifacts.stderr.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)],
+                               [objectFile.read(), artifacts.stdout, artifacts.stderr],
                               )
 
     def setManifest(self, manifestHash, manifest):
         self._setIgnoreExc(self.manifestPrefix + manifestHash, manifest)
 
+    def touchManifest(self, manifestHash, manifest, objectHash, statFingerprint=None):
+        manifest.touchEntry(objectHash, statFingerprint)
+        self.setManifest(manifestHash, manifest)
+
     def _setIgnoreExc(self, key, value):
         try:
             self.client.set(key.encode("UTF-8"), value)
@@ -151,9 +162,19 @@ class CacheMemcacheStrategy:
     def getManifest(self, manifestHash):
         return self.client.get((self.manifestPrefix + manifestHash).encode("UTF-8"))
 
-    def clean(self, stats, maximumSize):
-        self.fileStrategy.clean(stats,
-                                maximumSize)
+    @property
+    def maintenanceLock(self):
+        return self.fileStrategy.maintenanceLock
+
+    def clean(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        self.fileStrategy.clean(maximumSize,
+                                evictionPolicy)
+
+    def evict(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        self.fileStrategy.evict(maximumSize, evictionPolicy)
+
+    def claimEviction(self):
+        return self.fileStrategy.claimEviction()
 
 
 class CacheFileWithMemcacheFallbackStrategy:
@@ -189,6 +210,10 @@ class CacheFileWithMemcacheFallbackStrategy:
             self.localCache.setManifest(manifestHash, manifest)
         self.remoteCache.setManifest(manifestHash, manifest)
 
+    def touchManifest(self, manifestHash, manifest, objectHash, statFingerprint=None):
+        self.localCache.touchManifest(manifestHash, manifest, objectHash, statFingerprint)
+        self.remoteCache.setManifest(manifestHash, manifest)
+
     def getManifest(self, manifestHash):
         local = self.localCache.getManifest(manifestHash)
         if local:
@@ -202,10 +227,33 @@ class CacheFileWithMemcacheFallbackStrategy:
             return remote
         return None
 
+    def migrateLegacyManifest(self, legacyManifestHash, manifestHash, hashForInclude):
+        with self.localCache.manifestLockFor(manifestHash):
+            manifest = self.localCache.migrateLegacyManifest(legacyManifestHash, manifestHash, hashForInclude)
+        if manifest is not None:
+            self.remoteCache.setManifest(manifestHash, manifest)
+        return manifest
+
     @property
     def statistics(self):
         return self.localCache.statistics
 
+    @property
+    def fileHashCache(self):
+        return self.localCache.fileHashCache
+
+    @property
+    def compressionPolicy(self):
+        return self.localCache.compressionPolicy
+
+    @property
+    def blobStore(self):
+        return self.localCache.blobStore
+
+    @property
+    def objectFileRestorer(self):
+        return self.localCache.objectFileRestorer
+
     @property
     def configuration(self):
         return self.localCache.configuration
@@ -214,16 +262,24 @@ class CacheFileWithMemcacheFallbackStrategy:
     def lockFor(_):
         return CacheDummyLock()
 
+    @staticmethod
+    def readLockFor(_):
+        return CacheDummyLock()
+
     @staticmethod
     def manifestLockFor(_):
         return CacheDummyLock()
 
-    @property # type: ignore
-    @contextlib.contextmanager
-    def lock(self):
-        with self.remoteCache.lock, self.localCache.lock:
-            yield
+    @property
+    def maintenanceLock(self):
+        return self.localCache.maintenanceLock
+
+    def clean(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        self.localCache.clean(maximumSize,
+                              evictionPolicy)
+
+    def evict(self, maximumSize, evictionPolicy=DEFAULT_EVICTION_POLICY):
+        self.localCache.evict(maximumSize, evictionPolicy)
 
-    def clean(self, stats, maximumSize):
-        self.localCache.clean(stats,
-                              maximumSize)
+    def claimEviction(self):
+        return self.localCache.claimEviction()
@@ -0,0 +1,147 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+import errno
+import os
+import sys
+import threading
+from ctypes import wintypes
+
+# windll and fcntl are None where unavailable; they are used by other modules
+try:
+    from ctypes import windll # pylint: disable=unused-import
+except ImportError:
+    windll = None
+
+try:
+    import fcntl # pylint: disable=unused-import
+except ImportError:
+    fcntl = None # type: ignore
+
+OUTPUT_LOCK = threading.Lock()
+
+# try to use os.scandir or scandir.scandir
+# fall back to os.listdir if not found
+# same for scandir.walk
+try:
+    import scandir # pylint: disable=wrong-import-position
+    WALK = scandir.walk
+    LIST = scandir.scandir
+except ImportError:
+    WALK = os.walk
+    try:
+        LIST = os.scandir # type: ignore # pylint: disable=no-name-in-module
+    except AttributeError:
+        LIST = os.listdir
+
+# Number of bytes copied at once when moving data between files
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Policies picking the cache entries to remove first: least recently used,
+# least frequently used, or GreedyDual-Size-Frequency, which weighs the compile
+# time an entry saves and how often it is hit against its size
+EVICTION_POLICIES = ('lru', 'lfu', 'gdsf')
+DEFAULT_EVICTION_POLICY = 'lru'
+
+# String, by which BASE_DIR will be replaced in paths, stored in manifests.
+# ? is invalid character for file name, so it seems ok
+# to use it as mark for relative path.
+BASEDIR_REPLACEMENT = '?'
+
+# Define some Win32 API constants here to avoid dependency on win32pipe
+NMPWAIT_WAIT_FOREVER = wintypes.DWORD(0xFFFFFFFF)
+ERROR_PIPE_BUSY = 231
+
+
+def basenameWithoutExtension(path):
+    basename = os.path.basename(path)
+    return os.path.splitext(basename)[0]
+
+
+def filesBeneath(baseDir):
+    for path, _, filenames in WALK(baseDir):
+        for filename in filenames:
+            yield os.path.join(path, filename)
+
+
+def childDirectories(path, absolute=True):
+    supportsScandir = (LIST != os.listdir) # pylint: disable=comparison-with-callable
+    for entry in LIST(path):
+        if supportsScandir:
+            if entry.is_dir():
+                yield entry.path if absolute else entry.name
+        else:
+            absPath = os.path.join(path, entry)
+            if os.path.isdir(absPath):
+                yield absPath if absolute else entry
+
+
+def normalizeBaseDir(baseDir):
+    if baseDir:
+        baseDir = os.path.normcase(baseDir)
+        if baseDir.endswith(os.path.sep):
+            baseDir = baseDir[0:-1]
+        return baseDir
+    else:
+        # Converts empty string to None
+        return None
+
+
+class IncludeNotFoundException(Exception):
+    pass
+
+
+class LogicException(Exception):
+    def __init__(self, message):
+        super(LogicException, self).__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+
+def expandBasedirPlaceholder(path):
+    baseDir = normalizeBaseDir(os.environ.get('CLCACHE_BASEDIR'))
+    if path.startswith(BASEDIR_REPLACEMENT):
+        if not baseDir:
+            raise LogicException('No CLCACHE_BASEDIR set, but found relative path ' + path)
+        return path.replace(BASEDIR_REPLACEMENT, baseDir, 1)
+    else:
+        return path
+
+
+def collapseBasedirToPlaceholder(path):
+    baseDir = normalizeBaseDir(os.environ.get('CLCACHE_BASEDIR'))
+    if baseDir is None:
+        return path
+    else:
+        assert path == os.path.normcase(path)
+        assert baseDir == os.path.normcase(baseDir)
+        if path.startswith(baseDir):
+            return path.replace(baseDir, BASEDIR_REPLACEMENT, 1)
+        else:
+            return path
+
+
+def ensureDirectoryExists(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def printTraceStatement(msg: str) -> None:
+    if "CLCACHE_LOG" in os.environ:
+        scriptDir = os.path.realpath(os.path.dirname(sys.argv[0]))
+        with OUTPUT_LOCK:
+            print(os.path.join(scriptDir, "clcache.py") + " " + msg)
+
+
+def printErrStr(message):
+    with OUTPUT_LOCK:
+        print(message, file=sys.stderr)
@@ -10,15 +10,41 @@
 # pylint: disable=no-self-use
 #
 from multiprocessing import cpu_count
+import json
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
 import timeit
+import tracemalloc
 import unittest
 
 from clcache import __main__ as clcache
+from clcache.utils import filesBeneath
+from clcache.compression import COMPRESSION_CODECS
+from clcache.hashing import (
+    FileHashCache,
+    getFileHash,
+    getFileHashes,
+    getStringHash,
+    HASH_ALGORITHMS,
+    HASH_CHUNK_SIZE,
+)
+from clcache.entries import (
+    CompilerArtifacts,
+    readCacheEntry,
+    writeCacheEntry,
+)
+from clcache.restore import ObjectFileRestorer
+from clcache.blobs import BlobStore
+from clcache.manifest import (
+    IncludePathTable,
+    Manifest,
+    ManifestEntry,
+)
+from clcache.packs import PackedCompilerArtifactsRepository
 
 PYTHON_BINARY = sys.executable
 CLCACHE_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "clcache", "clcache.py")
@@ -95,6 +121,367 @@ class TestConcurrency(unittest.TestCase):
                   .format(len(TestConcurrency.sources), cpu_count(), hotCacheConcurrent))
 
 
+class TestHashCache(unittest.TestCase):
+    NUM_HEADERS = 1000
+    HEADER_SIZE = 16 * 1024
+
+    def testHashingCostPerTranslationUnit(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headers = []
+            for i in range(TestHashCache.NUM_HEADERS):
+                path = os.path.join(tempDir, 'header{:04d}.h'.format(i))
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(TestHashCache.HEADER_SIZE))
+                # The hash cache ignores files modified within the last seconds
+                mtime = os.stat(path).st_mtime - 60
+                os.utime(path, (mtime, mtime))
+                headers.append(path)
+
+            hashCacheDir = os.path.join(tempDir, 'hashes')
+            expectedHashes = getFileHashes(headers)
+
+            uncached = takeTime(lambda: getFileHashes(headers))
+            coldCache = takeTime(lambda: getFileHashes(headers, FileHashCache(hashCacheDir)))
+
+            # Each clcache process starts with a fresh FileHashCache object
+            hashCache = FileHashCache(hashCacheDir)
+            warmCache = takeTime(lambda: getFileHashes(headers, hashCache))
+            self.assertEqual(hashCache.hits, len(headers))
+            self.assertEqual(getFileHashes(headers, FileHashCache(hashCacheDir)), expectedHashes)
+
+            print("Hashing {} headers per translation unit without hash cache: {} seconds"
+                  .format(len(headers), uncached))
+            print("Hashing {} headers per translation unit, cold hash cache: {} seconds"
+                  .format(len(headers), coldCache))
+            print("Hashing {} headers per translation unit, warm hash cache: {} seconds"
+                  .format(len(headers), warmCache))
+
+
+class TestParallelHashing(unittest.TestCase):
+    HEADER_COUNTS = [100, 500, 1500]
+    THREAD_COUNTS = [1, 2, 4, 8, 16]
+    HEADER_SIZE = 16 * 1024
+
+    def tearDown(self):
+        os.environ.pop('CLCACHE_HASH_THREADS', None)
+
+    def testHashingThroughput(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headers = []
+            for i in range(max(TestParallelHashing.HEADER_COUNTS)):
+                path = os.path.join(tempDir, 'header{:04d}.h'.format(i))
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(TestParallelHashing.HEADER_SIZE))
+                headers.append(path)
+
+            for headerCount in TestParallelHashing.HEADER_COUNTS:
+                for threadCount in TestParallelHashing.THREAD_COUNTS:
+                    os.environ['CLCACHE_HASH_THREADS'] = str(threadCount)
+                    duration = takeTime(lambda: getFileHashes(headers[:headerCount])) # pylint: disable=cell-var-from-loop
+                    print("Hashing {} headers using {} threads: {} seconds".format(
+                        headerCount, threadCount, duration))
+
+
+class TestHashAlgorithms(unittest.TestCase):
+    PREPROCESSED_OUTPUT_SIZE = 64 * 1024 * 1024
+    NUM_HEADERS = 1000
+    HEADER_SIZE = 16 * 1024
+
+    def tearDown(self):
+        os.environ.pop('CLCACHE_HASH', None)
+
+    def testThroughput(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            preprocessedOutput = os.path.join(tempDir, 'preprocessed.i')
+            with open(preprocessedOutput, 'wb') as f:
+                f.write(os.urandom(TestHashAlgorithms.PREPROCESSED_OUTPUT_SIZE))
+
+            headers = []
+            for i in range(TestHashAlgorithms.NUM_HEADERS):
+                path = os.path.join(tempDir, 'header{:04d}.h'.format(i))
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(TestHashAlgorithms.HEADER_SIZE))
+                headers.append(path)
+
+            for algorithm in sorted(HASH_ALGORITHMS):
+                os.environ['CLCACHE_HASH'] = algorithm
+                largeFile = takeTime(lambda: getFileHash(preprocessedOutput))
+                headerSet = takeTime(lambda: getFileHashes(headers))
+
+                print("{}: hashing {} MiB preprocessed output: {} seconds ({:.0f} MiB/s)".format(
+                    algorithm, TestHashAlgorithms.PREPROCESSED_OUTPUT_SIZE // (1024 * 1024), largeFile,
+                    TestHashAlgorithms.PREPROCESSED_OUTPUT_SIZE / (1024 * 1024) / largeFile))
+                print("{}: hashing {} headers: {} seconds".format(algorithm, len(headers), headerSet))
+
+
+class TestHashingMemory(unittest.TestCase):
+    FILE_SIZES = [1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+
+    def testPeakMemoryIndependentOfSize(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            peaks = []
+            for size in TestHashingMemory.FILE_SIZES:
+                path = os.path.join(tempDir, 'generated.cpp')
+                with open(path, 'wb') as f:
+                    for _ in range(size // (1024 * 1024)):
+                        f.write(os.urandom(1024 * 1024))
+
+                tracemalloc.start()
+                try:
+                    duration = takeTime(lambda: getFileHash(path)) # pylint: disable=cell-var-from-loop
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                peaks.append(peak)
+
+                print("Hashing {} MiB file: {} seconds, peak memory allocated: {} KiB".format(
+                    size // (1024 * 1024), duration, peak // 1024))
+
+            self.assertLess(max(peaks), 2 * HASH_CHUNK_SIZE)
+
+
+
+class TestManifestFormat(unittest.TestCase):
+    NUM_ENTRIES = 100
+    NUM_INCLUDES = 400
+
+    def _manifest(self):
+        includeFiles = [r'c:\program files (x86)\microsoft visual studio 14.0\vc\include\header{:04d}.h'.format(i)
+                        for i in range(TestManifestFormat.NUM_INCLUDES)]
+        manifest = Manifest()
+        for i in range(TestManifestFormat.NUM_ENTRIES):
+            # Every entry differs from the previous one in a single header
+            includeHashes = [getStringHash(str(i if j == i % len(includeFiles) else 0))
+                             for j in range(len(includeFiles))]
+            manifest.addEntry(ManifestEntry(includeFiles,
+                                                    getStringHash("includes" + str(i)),
+                                                    getStringHash("object" + str(i)),
+                                                    includeHashes,
+                                                    getStringHash("stat" + str(i))))
+        return manifest
+
+    def testSizeAndParseTime(self):
+        manifest = self._manifest()
+        jsonData = json.dumps({'entries': [{'includesContentHash': e.includesContentHash,
+                                            'objectHash': e.objectHash,
+                                            'statFingerprint': e.statFingerprint}
+                                           for e in manifest.entries()],
+                               'tree': manifest.tree()},
+                              sort_keys=True, indent=2)
+
+        def parseJson():
+            doc = json.loads(jsonData)
+            Manifest.fromTree(doc['tree'], [(e['includesContentHash'], e['objectHash'], e['statFingerprint'])
+                                                    for e in doc['entries']])
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            tablePath = os.path.join(tempDir, 'includepaths.txt')
+            binaryData = manifest.toBytes(IncludePathTable(tablePath))
+            includePathTableSize = IncludePathTable(tablePath).size()
+
+            jsonTime = takeTime(parseJson)
+            # Use a new table such that the time for loading it is included
+            binaryTime = takeTime(lambda: Manifest.fromBytes(binaryData, IncludePathTable(tablePath)))
+
+        print("Manifest with {} entries of {} include files as JSON: {} KiB, parsed in {} seconds".format(
+            TestManifestFormat.NUM_ENTRIES, TestManifestFormat.NUM_INCLUDES, len(jsonData) // 1024, jsonTime))
+        print("Manifest with {} entries of {} include files as binary: {} KiB (plus {} KiB shared include path "
+              "table), parsed in {} seconds".format(TestManifestFormat.NUM_ENTRIES, TestManifestFormat.NUM_INCLUDES,
+                                                    len(binaryData) // 1024, includePathTableSize // 1024,
+                                                    binaryTime))
+        self.assertLess(len(binaryData) + includePathTableSize, len(jsonData))
+
+
+class TestPackFiles(unittest.TestCase):
+    NUM_ENTRIES = 2000
+    OBJECT_SIZE = 16 * 1024
+
+    def _measure(self, repository, tempDir):
+        objectFile = os.path.join(tempDir, 'input.obj')
+        with open(objectFile, 'wb') as f:
+            f.write(os.urandom(TestPackFiles.OBJECT_SIZE))
+        restoredFile = os.path.join(tempDir, 'restored.obj')
+        keys = [getStringHash(str(i)) for i in range(TestPackFiles.NUM_ENTRIES)]
+
+        def insert():
+            for key in keys:
+                repository.section(key).setEntry(key, CompilerArtifacts(objectFile, b'', b''))
+
+        def hit():
+            for key in keys:
+                ObjectFileRestorer().restore(repository.section(key).getEntry(key), restoredFile)
+
+        return (takeTime(insert), takeTime(hit),
+                takeTime(lambda: repository.clean(TestPackFiles.NUM_ENTRIES * TestPackFiles.OBJECT_SIZE // 2)))
+
+    def testThroughput(self):
+        for name, repositoryClass in [('directories', clcache.CompilerArtifactsRepository),
+                                      ('pack files', PackedCompilerArtifactsRepository)]:
+            with tempfile.TemporaryDirectory() as tempDir:
+                rootDir = os.path.join(tempDir, 'objects')
+                os.makedirs(rootDir)
+                insertTime, hitTime, cleanTime = self._measure(repositoryClass(rootDir), tempDir)
+                print("{}: {} entries: insert {:.0f}/s, hit {:.0f}/s, clean half of them in {} seconds".format(
+                    name, TestPackFiles.NUM_ENTRIES, TestPackFiles.NUM_ENTRIES / insertTime,
+                    TestPackFiles.NUM_ENTRIES / hitTime, cleanTime))
+
+
+class TestDeduplication(unittest.TestCase):
+    NUM_ENTRIES = 1000
+    OBJECT_SIZE = 64 * 1024
+
+    def _measure(self, tempDir, identicalObjects):
+        repository = clcache.CompilerArtifactsRepository(os.path.join(tempDir, 'objects'),
+                                                         blobStore=BlobStore(os.path.join(tempDir, 'blobs')))
+        objectFiles = []
+        for i in range(TestDeduplication.NUM_ENTRIES):
+            objectFile = os.path.join(tempDir, '{}.obj'.format(i))
+            with open(objectFile, 'wb') as f:
+                f.write(bytes(TestDeduplication.OBJECT_SIZE) if identicalObjects else
+                        os.urandom(TestDeduplication.OBJECT_SIZE))
+            objectFiles.append(objectFile)
+        keys = [getStringHash(str(i)) for i in range(TestDeduplication.NUM_ENTRIES)]
+
+        def insert():
+            for key, objectFile in zip(keys, objectFiles):
+                repository.section(key).setEntry(key, CompilerArtifacts(objectFile, b'', b''))
+
+        insertTime = takeTime(insert)
+        # Hard links to a blob don't take additional space
+        storedFiles = {}
+        for root in ['objects', 'blobs']:
+            for path in filesBeneath(os.path.join(tempDir, root)):
+                stat = os.stat(path)
+                storedFiles[(stat.st_dev, stat.st_ino)] = stat.st_size
+        return insertTime, sum(storedFiles.values())
+
+    def testInsertCost(self):
+        for identicalObjects in [False, True]:
+            for dedup in [False, True]:
+                if dedup:
+                    os.environ['CLCACHE_DEDUP'] = '1'
+                try:
+                    with tempfile.TemporaryDirectory() as tempDir:
+                        insertTime, storedSize = self._measure(tempDir, identicalObjects)
+                finally:
+                    os.environ.pop('CLCACHE_DEDUP', None)
+                print("{} {} object files {}: insert {:.0f}/s, stored {} KiB".format(
+                    TestDeduplication.NUM_ENTRIES, 'identical' if identicalObjects else 'distinct',
+                    'deduplicated' if dedup else 'as is', TestDeduplication.NUM_ENTRIES / insertTime,
+                    storedSize // 1024))
+
+
+class TestCompressionCodecs(unittest.TestCase):
+    NUM_RESTORES = 50
+
+    def _compileObjectFiles(self, tempDir):
+        # Build real object files, with and without debug information
+        objectFiles = []
+        for name, flags in [('release', ['/O2']), ('debug', ['/Z7', '/Od'])]:
+            objectFile = os.path.join(tempDir, name + '.obj')
+            cmd = CLCACHE_CMD + ['/nologo', '/EHsc', '/c', '/Fo' + objectFile] + flags + \
+                [os.path.join(ASSETS_DIR, 'concurrency', 'file01.cpp')]
+            subprocess.check_call(cmd, env=dict(os.environ, CLCACHE_DISABLE='1'))
+            objectFiles.append(objectFile)
+        return objectFiles
+
+    def testRestoreLatencyAndSize(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            restoredFile = os.path.join(tempDir, 'restored.obj')
+            for objectFile in self._compileObjectFiles(tempDir):
+                objectSize = os.path.getsize(objectFile)
+                for codecName in sorted(COMPRESSION_CODECS):
+                    os.environ['CLCACHE_COMPRESS'] = codecName
+                    repository = clcache.CompilerArtifactsRepository(os.path.join(tempDir, codecName))
+                    key = getStringHash(objectFile + codecName)
+                    section = repository.section(key)
+                    artifacts = CompilerArtifacts(objectFile, b'', b'')
+                    storeTime = takeTime(lambda: section.setEntry(key, artifacts)) # pylint: disable=cell-var-from-loop
+                    storedSize = os.path.getsize(section.cacheEntryFile(key))
+
+                    restorer = ObjectFileRestorer()
+
+                    def restore():
+                        for _ in range(TestCompressionCodecs.NUM_RESTORES):
+                            restorer.restore(section.getEntry(key), restoredFile) # pylint: disable=cell-var-from-loop
+
+                    restoreTime = takeTime(restore) / TestCompressionCodecs.NUM_RESTORES
+                    print("{} ({} KiB) using {}: stored {} KiB ({:.0%}) in {:.2f} ms, restored in {:.2f} ms".format(
+                        os.path.basename(objectFile), objectSize // 1024, codecName, storedSize // 1024,
+                        storedSize / objectSize, storeTime * 1000, restoreTime * 1000))
+            os.environ.pop('CLCACHE_COMPRESS', None)
+
+
+class TestRestoreMethods(unittest.TestCase):
+    NUM_HITS = 200
+    OBJECT_SIZE = 1024 * 1024
+
+    def testRestoreCost(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, 'input.obj')
+            with open(objectFile, 'wb') as f:
+                f.write(os.urandom(TestRestoreMethods.OBJECT_SIZE))
+            key = getStringHash('restore')
+            entryFile = os.path.join(tempDir, 'entry')
+            with open(entryFile, 'wb') as f:
+                writeCacheEntry(f, key, CompilerArtifacts(objectFile, b'', b''))
+            with open(entryFile, 'rb') as f:
+                entryArtifacts = readCacheEntry(f, entryFile, key)
+            entries = [('entry file', entryArtifacts),
+                       ('directory', CompilerArtifacts(objectFile, b'', b''))]
+            restoredFile = os.path.join(tempDir, 'restored.obj')
+
+            os.environ['CLCACHE_HARDLINK'] = '1'
+            try:
+                for entryName, artifacts in entries:
+                    for method in ObjectFileRestorer.RESTORE_METHODS:
+                        restorer = ObjectFileRestorer(methods=[method, 'copy'])
+
+                        def restore():
+                            for _ in range(TestRestoreMethods.NUM_HITS):
+                                restorer.restore(artifacts, restoredFile) # pylint: disable=cell-var-from-loop
+
+                        duration = takeTime(restore)
+                        print("Restoring {} KiB from {} trying {} (used {}): {:.3f} ms, {:.1f} syscalls, {} KiB "
+                              "copied per hit".format(TestRestoreMethods.OBJECT_SIZE // 1024, entryName, method,
+                                                      restorer.lastMethod,
+                                                      duration * 1000 / TestRestoreMethods.NUM_HITS,
+                                                      restorer.numSyscalls / TestRestoreMethods.NUM_HITS,
+                                                      restorer.numBytesCopied // TestRestoreMethods.NUM_HITS // 1024))
+            finally:
+                del os.environ['CLCACHE_HARDLINK']
+
+
+def hitRepeatedly(cacheDir, key, restoredFile, count):
+    cache = clcache.Cache(cacheDir)
+    return takeTime(lambda: [clcache.processCacheHit(cache, restoredFile, key) for _ in range(count)])
+
+
+class TestConcurrentHits(unittest.TestCase):
+    NUM_HITS = 200
+    PROCESS_COUNTS = [1, 2, 4, 8, 16]
+
+    def testScaling(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = os.path.join(tempDir, 'cache')
+            cache = clcache.Cache(cacheDir)
+            objectFile = os.path.join(tempDir, 'input.obj')
+            with open(objectFile, 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+            # All entries are in the same section
+            keys = ['fd{:030x}'.format(i) for i in range(max(TestConcurrentHits.PROCESS_COUNTS))]
+            for key in keys:
+                cache.setEntry(key, CompilerArtifacts(objectFile, b'', b''))
+
+            for processCount in TestConcurrentHits.PROCESS_COUNTS:
+                jobs = [(cacheDir, keys[i], os.path.join(tempDir, '{}.obj'.format(i)), TestConcurrentHits.NUM_HITS)
+                        for i in range(processCount)]
+                with multiprocessing.Pool(processCount) as pool:
+                    duration = max(pool.starmap(hitRepeatedly, jobs))
+                print("{} processes hitting one cache section: {:.0f} hits/s".format(
+                    processCount, processCount * TestConcurrentHits.NUM_HITS / duration))
+
+
 if __name__ == '__main__':
     unittest.TestCase.longMessage = True
     unittest.main()
@@ -0,0 +1,1247 @@
+#!/usr/bin/env python
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# In Python unittests are always members, not functions. Silence lint in this file.
+# pylint: disable=no-self-use
+#
+import concurrent.futures
+import errno
+import gzip
+import os
+import unittest
+import tempfile
+import shutil
+
+from clcache import __main__ as clcache
+from clcache import simulation
+
+from clcache.__main__ import CompilerArtifactsRepository
+from clcache.utils import (
+    childDirectories,
+    EVICTION_POLICIES,
+    LogicException,
+    WALK,
+)
+from clcache.compression import (
+    COMPRESSION_CODECS,
+    CompressionPolicy,
+    NO_COMPRESSION_CODEC,
+)
+from clcache.locks import (
+    CacheLock,
+    CacheLockException,
+    LOCK_BACKENDS,
+    SHARED_LOCK_BACKENDS,
+    SharedCacheLock,
+)
+from clcache.statistics import Statistics
+from clcache.index import CacheIndex
+from clcache.entries import (
+    CompilerArtifacts,
+    readCacheEntry,
+    writeCacheEntry,
+)
+from clcache.restore import ObjectFileRestorer
+from clcache.blobs import BlobStore
+from clcache.manifest import (
+    IncludeHashes,
+    IncludePathTable,
+    Manifest,
+    ManifestEntry,
+    ManifestRepository,
+    MAX_MANIFEST_HIT_LOG_SIZE,
+)
+from clcache.packs import PackedCompilerArtifactsRepository
+
+ASSETS_DIR = os.path.join(os.path.dirname(__file__), "unittests")
+
+
+def temporaryFileName():
+    with tempfile.NamedTemporaryFile() as f:
+        return f.name
+
+
+class TestCacheLock(unittest.TestCase):
+    def tearDown(self):
+        os.environ.pop("CLCACHE_LOCKS", None)
+
+    def _acquireInOtherThread(self, lock):
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            try:
+                executor.submit(lock.acquire).result()
+            except CacheLockException:
+                return False
+            executor.submit(lock.release).result()
+            return True
+
+    @unittest.skipUnless("flock" in LOCK_BACKENDS, "requires flock()")
+    def testFileLock(self):
+        os.environ["CLCACHE_LOCKS"] = "flock"
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "section")
+            lock = CacheLock.forPath(path, 0)
+            with lock:
+                # The thread holding the lock can acquire it again
+                with CacheLock.forPath(path, 0):
+                    pass
+                self.assertTrue(os.path.exists(path + ".lock"))
+                self.assertFalse(self._acquireInOtherThread(CacheLock.forPath(path, 0)))
+            self.assertTrue(self._acquireInOtherThread(CacheLock.forPath(path, 0)))
+
+    def testNoLock(self):
+        os.environ["CLCACHE_LOCKS"] = "none"
+        lock = CacheLock.forPath(os.path.join(tempfile.gettempdir(), "section"), 0)
+        with lock:
+            self.assertTrue(self._acquireInOtherThread(lock))
+
+    def testUnsupportedBackend(self):
+        os.environ["CLCACHE_LOCKS"] = "spinlock"
+        with self.assertRaises(LogicException):
+            CacheLock.forPath("section")
+
+    def testWaitStatistics(self):
+        os.environ["CLCACHE_LOCKS"] = "none"
+        with tempfile.TemporaryDirectory() as tempDir:
+            # Drop the waits recorded by other tests
+            with Statistics(os.path.join(tempDir, "earlier.txt")) as earlierStats:
+                CacheLock.flushStatistics(earlierStats)
+            for name in ["a", "b", "b"]:
+                with CacheLock.forPath(os.path.join(tempDir, name)):
+                    pass
+            with Statistics(os.path.join(tempDir, "stats.txt")) as stats:
+                self.assertEqual(stats.slowestLocks(5), [])
+                CacheLock.flushStatistics(stats)
+                stats.registerLockWaits(os.path.join(tempDir, "a"), 1, 10.0, 10.0)
+                slowestLocks = stats.slowestLocks(1)
+                self.assertEqual(len(slowestLocks), 1)
+                self.assertEqual(slowestLocks[0][:2], ("a", 2))
+                self.assertGreaterEqual(slowestLocks[0][2], 10.0)
+                self.assertEqual([path for path, _, _, _ in stats.slowestLocks(5)], ["a", "b"])
+                self.assertEqual(stats.slowestLocks(5)[1][1], 2)
+
+                stats.resetCounters()
+                self.assertEqual(stats.slowestLocks(5), [])
+
+    @unittest.skipUnless("flock" in SHARED_LOCK_BACKENDS, "requires flock()")
+    def testSharedFileLock(self):
+        os.environ["CLCACHE_LOCKS"] = "flock"
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "maintenance")
+
+            def holdShared():
+                with SharedCacheLock.forPath(path, 0).shared():
+                    pass
+
+            def holdExclusive():
+                with SharedCacheLock.forPath(path, 0).exclusive():
+                    pass
+
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                with SharedCacheLock.forPath(path, 0).shared():
+                    executor.submit(holdShared).result()
+                    with self.assertRaises(CacheLockException):
+                        executor.submit(holdExclusive).result()
+                with SharedCacheLock.forPath(path, 0).exclusive():
+                    with self.assertRaises(CacheLockException):
+                        executor.submit(holdShared).result()
+                executor.submit(holdExclusive).result()
+
+
+class TestManifestRepository(unittest.TestCase):
+    entry1 = ManifestEntry([r'somepath\myinclude.h'],
+                           "fdde59862785f9f0ad6e661b9b5746b7",
+                           "a649723940dc975ebd17167d29a532f8",
+                           ["8a33738d88be7edbacef48e262bbb5bc"],
+                           None)
+    entry2 = ManifestEntry([r'moreincludes.h', r'somepath\myinclude.h'],
+                           "474e7fc26a592d84dfa7416c10f036c6",
+                           "8771d7ebcf6c8bd57a3d6485f63e3a89",
+                           ["0623305942d216c165970948424ae7d1", "8a33738d88be7edbacef48e262bbb5bc"],
+                           None)
+    # Size in (120, 240] bytes
+    manifest1 = Manifest([entry1])
+    # Size in (120, 240] bytes
+    manifest2 = Manifest([entry2])
+
+    def _getDirectorySize(self, dirPath):
+        def filesize(path, filename):
+            return os.stat(os.path.join(path, filename)).st_size
+
+        size = 0
+        for path, _, filenames in WALK(dirPath):
+            size += sum(filesize(path, f) for f in filenames)
+
+        return size
+
+    def testPaths(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        mm = ManifestRepository(manifestsRootDir)
+        ms = mm.section("fdde59862785f9f0ad6e661b9b5746b7")
+
+        self.assertEqual(ms.manifestSectionDir, os.path.join(manifestsRootDir, "fd"))
+        self.assertEqual(ms.manifestPath("fdde59862785f9f0ad6e661b9b5746b7"),
+                         os.path.join(manifestsRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.manifest"))
+
+    def testIncludesContentHash(self):
+        self.assertEqual(
+            ManifestRepository.getIncludesContentHashForHashes([]),
+            ManifestRepository.getIncludesContentHashForHashes([])
+        )
+
+        self.assertEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
+        )
+
+        self.assertEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"])
+        )
+
+        # Wrong number of elements
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes([]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
+        )
+
+        # Wrong order
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
+            ManifestRepository.getIncludesContentHashForHashes(["f6c8bd5733", "d88be7edbf"])
+        )
+
+        # Content in different elements
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["", "d88be7edbf"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", ""])
+        )
+        self.assertNotEqual(
+            ManifestRepository.getIncludesContentHashForHashes(["d88be", "7edbf"]),
+            ManifestRepository.getIncludesContentHashForHashes(["d88b", "e7edbf"])
+        )
+
+    def testStoreAndGetManifest(self):
+        with tempfile.TemporaryDirectory() as manifestsRootDir:
+            mm = ManifestRepository(manifestsRootDir)
+
+            ms1 = mm.section("8a33738d88be7edbacef48e262bbb5bc")
+            ms2 = mm.section("0623305942d216c165970948424ae7d1")
+
+            ms1.setManifest("8a33738d88be7edbacef48e262bbb5bc", TestManifestRepository.manifest1)
+            ms2.setManifest("0623305942d216c165970948424ae7d1", TestManifestRepository.manifest2)
+
+            retrieved1 = ms1.getManifest("8a33738d88be7edbacef48e262bbb5bc")
+            self.assertIsNotNone(retrieved1)
+            retrieved1Entry = retrieved1.entries()[0]
+            self.assertEqual(retrieved1Entry, TestManifestRepository.entry1)
+
+            retrieved2 = ms2.getManifest("0623305942d216c165970948424ae7d1")
+            self.assertIsNotNone(retrieved2)
+            retrieved2Entry = retrieved2.entries()[0]
+            self.assertEqual(retrieved2Entry, TestManifestRepository.entry2)
+
+    def testIncludePathsStoredOnce(self):
+        with tempfile.TemporaryDirectory() as manifestsRootDir:
+            mm = ManifestRepository(manifestsRootDir)
+            mm.section("8a33738d88be7edbacef48e262bbb5bc").setManifest("8a33738d88be7edbacef48e262bbb5bc",
+                                                                       TestManifestRepository.manifest1)
+            mm.section("0623305942d216c165970948424ae7d1").setManifest("0623305942d216c165970948424ae7d1",
+                                                                       TestManifestRepository.manifest2)
+
+            with open(os.path.join(manifestsRootDir, "includepaths.txt"), 'rb') as f:
+                paths = f.read().split(b'\n')[1:-1]
+            self.assertEqual(sorted(paths), [b'moreincludes.h', b'somepath\\myinclude.h'])
+
+    def testHitLog(self):
+        with tempfile.TemporaryDirectory() as manifestsRootDir:
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            ms = ManifestRepository(manifestsRootDir).section(manifestHash)
+            ms.setManifest(manifestHash, Manifest([TestManifestRepository.entry1, TestManifestRepository.entry2]))
+            with open(ms.manifestPath(manifestHash), 'rb') as f:
+                manifestData = f.read()
+
+            manifest = ms.getManifest(manifestHash)
+            ms.touchManifest(manifestHash, manifest, TestManifestRepository.entry2.objectHash,
+                             "0623305942d216c165970948424ae7d1")
+            self.assertEqual(manifest.entries()[0].objectHash, TestManifestRepository.entry2.objectHash)
+
+            # A hit does not rewrite the manifest
+            with open(ms.manifestPath(manifestHash), 'rb') as f:
+                self.assertEqual(f.read(), manifestData)
+            self.assertEqual(ms.getManifest(manifestHash).entries(), manifest.entries())
+
+            # A record which is not completely written yet is ignored
+            with open(ms.hitLogPath(manifestHash), 'a') as f:
+                f.write(TestManifestRepository.entry1.objectHash[:10])
+            self.assertEqual(ms.getManifest(manifestHash).entries(), manifest.entries())
+
+            ms.setManifest(manifestHash, manifest)
+            self.assertFalse(os.path.exists(ms.hitLogPath(manifestHash)))
+            self.assertEqual(ms.getManifest(manifestHash).entries(), manifest.entries())
+
+    def testHitLogMerged(self):
+        with tempfile.TemporaryDirectory() as manifestsRootDir:
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            ms = ManifestRepository(manifestsRootDir).section(manifestHash)
+            ms.setManifest(manifestHash, Manifest([TestManifestRepository.entry1, TestManifestRepository.entry2]))
+
+            manifest = ms.getManifest(manifestHash)
+            for _ in range(MAX_MANIFEST_HIT_LOG_SIZE // len(TestManifestRepository.entry1.objectHash) + 1):
+                ms.touchManifest(manifestHash, manifest, manifest.entries()[1].objectHash)
+                if not os.path.exists(ms.hitLogPath(manifestHash)):
+                    break
+            self.assertFalse(os.path.exists(ms.hitLogPath(manifestHash)))
+            self.assertEqual(ms.getManifest(manifestHash).entries(), manifest.entries())
+
+    def testLegacyManifest(self):
+        # Written by clcache 4.1 for main.cpp compiled with /c, using the
+        # compiler, source and include files created below
+        legacyManifestHash = "d8b16478f794dc74082cd4a5b1de0250"
+        legacyManifestFile = os.path.join(ASSETS_DIR, "legacy-manifests", legacyManifestHash + ".json")
+        with tempfile.TemporaryDirectory() as tempDir:
+            baseDir = os.path.join(tempDir, "base")
+            os.makedirs(baseDir)
+            for name, content in [("cl.exe", "cl"), ("main.cpp", '#include "a.h"\nint main() {}\n'),
+                                  ("a.h", "int a;\n"), ("b.h", "int b;\n"), ("config.h", "#define CONFIG 2\n")]:
+                with open(os.path.join(baseDir, name), "w", newline="") as f:
+                    f.write(content)
+            compilerBinary = os.path.join(baseDir, "cl.exe")
+            os.utime(compilerBinary, (1500000000, 1500000000))
+
+            os.environ["CLCACHE_BASEDIR"] = baseDir
+            try:
+                self.assertEqual(ManifestRepository.getLegacyManifestHash(compilerBinary, ["/c"],
+                                                                          os.path.join(baseDir, "main.cpp")),
+                                 legacyManifestHash)
+
+                mr = ManifestRepository(os.path.join(tempDir, "manifests"))
+                legacySection = mr.section(legacyManifestHash)
+                os.makedirs(legacySection.manifestSectionDir)
+                shutil.copyfile(legacyManifestFile, legacySection.legacyManifestPath(legacyManifestHash))
+
+                manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+                includeHashes = IncludeHashes()
+                manifest = mr.migrateLegacyManifest(legacyManifestHash, manifestHash, includeHashes.hashFor)
+            finally:
+                del os.environ["CLCACHE_BASEDIR"]
+
+            # The oldest entry was created for a different config.h
+            self.assertEqual([e.objectHash for e in manifest.entries()],
+                             ["f222f62288f72fb2e66b8f0d38ccb7d8", "402d36b4ee4a9e132af0b7c2d415e671"])
+            self.assertEqual(manifest.findEntry(includeHashes.hashFor), 0)
+            self.assertFalse(os.path.exists(legacySection.legacyManifestPath(legacyManifestHash)))
+            self.assertEqual(mr.section(manifestHash).getManifest(manifestHash).entries(), manifest.entries())
+            self.assertIsNone(mr.migrateLegacyManifest(legacyManifestHash, manifestHash, includeHashes.hashFor))
+
+    def testTruncatedManifest(self):
+        with tempfile.TemporaryDirectory() as manifestsRootDir:
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            ms = ManifestRepository(manifestsRootDir).section(manifestHash)
+            ms.setManifest(manifestHash, TestManifestRepository.manifest2)
+            with open(ms.manifestPath(manifestHash), 'r+b') as f:
+                f.truncate(os.path.getsize(ms.manifestPath(manifestHash)) - 1)
+
+            self.assertIsNone(ms.getManifest(manifestHash))
+
+    def testNonExistingManifest(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        mm = ManifestRepository(manifestsRootDir)
+
+        retrieved = mm.section("ffffffffffffffffffffffffffffffff").getManifest("ffffffffffffffffffffffffffffffff")
+        self.assertIsNone(retrieved)
+
+    def testBrokenManifest(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        mm = ManifestRepository(manifestsRootDir)
+
+        retrieved = mm.section("brokenmanifest").getManifest("brokenmanifest")
+        self.assertIsNone(retrieved)
+
+    def testClean(self):
+        with tempfile.TemporaryDirectory() as manifestsRootDir:
+            mm = ManifestRepository(manifestsRootDir)
+
+            mm.section("8a33738d88be7edbacef48e262bbb5bc").setManifest("8a33738d88be7edbacef48e262bbb5bc",
+                                                                       TestManifestRepository.manifest1)
+            mm.section("0623305942d216c165970948424ae7d1").setManifest("0623305942d216c165970948424ae7d1",
+                                                                       TestManifestRepository.manifest2)
+
+            cleaningResultSize = mm.clean(240)
+            # Only one of those manifests can be left
+            self.assertLessEqual(cleaningResultSize, 240)
+            self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 240)
+
+            cleaningResultSize = mm.clean(240)
+            # The one remaining is remains alive
+            self.assertLessEqual(cleaningResultSize, 240)
+            self.assertGreaterEqual(cleaningResultSize, 120)
+            self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 240)
+            self.assertGreaterEqual(self._getDirectorySize(manifestsRootDir), 120)
+
+            cleaningResultSize = mm.clean(0)
+            # All manifest are gone
+            self.assertEqual(cleaningResultSize, 0)
+            self.assertEqual(self._getDirectorySize(manifestsRootDir), 0)
+
+    def testIndexedClean(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            index = CacheIndex(os.path.join(tempDir, "index.sqlite"))
+            manifestsRootDir = os.path.join(tempDir, "manifests")
+            os.makedirs(manifestsRootDir)
+            mm = ManifestRepository(manifestsRootDir, index)
+            index.rebuild(mm.indexEntries())
+
+            manifestHash1 = "8a33738d88be7edbacef48e262bbb5bc"
+            manifestHash2 = "0623305942d216c165970948424ae7d1"
+            mm.section(manifestHash1).setManifest(manifestHash1, TestManifestRepository.manifest1)
+            mm.section(manifestHash2).setManifest(manifestHash2, TestManifestRepository.manifest2)
+            manifest1 = mm.section(manifestHash1).getManifest(manifestHash1)
+            mm.section(manifestHash1).touchManifest(manifestHash1, manifest1, self.entry1.objectHash)
+
+            # The manifest hit last is kept
+            self.assertLessEqual(mm.clean(240), 240)
+            self.assertIsNotNone(mm.section(manifestHash1).getManifest(manifestHash1))
+            self.assertIsNone(mm.section(manifestHash2).getManifest(manifestHash2))
+            self.assertEqual([key for key, _, _ in index.entries(CacheIndex.MANIFEST)], [manifestHash1])
+
+            self.assertEqual(mm.clean(0), 0)
+            self.assertEqual(index.entries(CacheIndex.MANIFEST), [])
+            index.close()
+
+    def testCompactIncludePathTable(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            index = CacheIndex(os.path.join(tempDir, "index.sqlite"))
+            manifestsRootDir = os.path.join(tempDir, "manifests")
+            os.makedirs(manifestsRootDir)
+            mm = ManifestRepository(manifestsRootDir, index)
+            index.rebuild(mm.indexEntries())
+            tablePath = os.path.join(manifestsRootDir, "includepaths.txt")
+
+            manifestHash1 = "8a33738d88be7edbacef48e262bbb5bc"
+            manifestHash2 = "0623305942d216c165970948424ae7d1"
+            mm.section(manifestHash1).setManifest(manifestHash1, TestManifestRepository.manifest1)
+            mm.section(manifestHash2).setManifest(manifestHash2, TestManifestRepository.manifest2)
+            mm.section(manifestHash2).removeManifest(manifestHash2)
+            index.removeEntries(CacheIndex.MANIFEST, [manifestHash2])
+            tableSize = os.path.getsize(tablePath)
+
+            # Only the paths of the remaining manifest are kept; it is still readable
+            remainingSize = mm.compactIncludePathTable()
+            self.assertLess(os.path.getsize(tablePath), tableSize)
+            self.assertEqual(remainingSize, os.path.getsize(tablePath) + index.totalSize())
+            self.assertEqual(index.totalSize(), os.path.getsize(mm.section(manifestHash1).manifestPath(manifestHash1)))
+            self.assertFalse(os.path.exists(tablePath + ".previous"))
+            self.assertEqual(mm.section(manifestHash1).getManifest(manifestHash1).entries(),
+                             TestManifestRepository.manifest1.entries())
+            index.close()
+
+
+class TestIncludePathTable(unittest.TestCase):
+    def testPositions(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            tablePath = os.path.join(tempDir, "includepaths.txt")
+            table = IncludePathTable(tablePath)
+            generation, positions = table.positionsFor([r'a.h', r'b.h'])
+            self.assertEqual(table.positionsFor([r'b.h', r'a.h']), (generation, positions[::-1]))
+
+            # Other processes append to the same table
+            otherTable = IncludePathTable(tablePath)
+            otherGeneration, otherPositions = otherTable.positionsFor([r'c.h', r'a.h'])
+            self.assertEqual(otherGeneration, generation)
+            self.assertEqual(otherPositions[1], positions[0])
+
+            self.assertEqual(table.pathsAt(generation, positions + otherPositions), [r'a.h', r'b.h', r'c.h', r'a.h'])
+            self.assertEqual(table.positionsFor([r'c.h', r'd.h'])[1][0], otherPositions[0])
+
+            # Another process starts a new generation
+            otherTable.startNewGeneration()
+            newGeneration, newPositions = table.positionsFor([r'd.h'])
+            self.assertNotEqual(newGeneration, generation)
+            self.assertEqual(otherTable.pathsAt(newGeneration, newPositions), [r'd.h'])
+            self.assertEqual(otherTable.positionsFor([r'd.h']), (newGeneration, newPositions))
+
+    def testPartiallyWrittenPath(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            tablePath = os.path.join(tempDir, "includepaths.txt")
+            generation, positions = IncludePathTable(tablePath).positionsFor([r'a.h'])
+            with open(tablePath, 'ab') as f:
+                f.write(b'b.')
+
+            table = IncludePathTable(tablePath)
+            self.assertEqual(table.pathsAt(generation, positions), [r'a.h'])
+            _, newPositions = table.positionsFor([r'b.h'])
+            self.assertEqual(table.pathsAt(generation, newPositions), [r'b.h'])
+            self.assertEqual(table.size(), 33 + len("a.h\nb.h\n"))
+
+    def testNewGeneration(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            table = IncludePathTable(os.path.join(tempDir, "includepaths.txt"))
+            generation, positions = table.positionsFor([r'a.h', r'b.h'])
+            table.startNewGeneration()
+            self.assertEqual(table.size(), 0)
+            newGeneration, newPositions = table.positionsFor([r'b.h'])
+            self.assertNotEqual(newGeneration, generation)
+            self.assertEqual(table.size(), 33 + len("b.h\n"))
+
+            # Both generations resolve until the previous one is removed
+            self.assertEqual(table.pathsAt(generation, positions), [r'a.h', r'b.h'])
+            self.assertEqual(table.pathsAt(newGeneration, newPositions), [r'b.h'])
+            table.removePreviousGeneration()
+            with self.assertRaises(ValueError):
+                table.pathsAt(generation, positions)
+            self.assertEqual(table.pathsAt(newGeneration, newPositions), [r'b.h'])
+
+
+class TestCompilerArtifactsRepository(unittest.TestCase):
+    def tearDown(self):
+        os.environ.pop("CLCACHE_COMPRESS", None)
+        os.environ.pop("CLCACHE_HARDLINK", None)
+        os.environ.pop("CLCACHE_DEDUP", None)
+
+    def testPaths(self):
+        compilerArtifactsRepositoryRootDir = os.path.join(ASSETS_DIR, "compiler-artifacts-repository")
+        car = CompilerArtifactsRepository(compilerArtifactsRepositoryRootDir)
+        cas = car.section("fdde59862785f9f0ad6e661b9b5746b7")
+
+        # section path
+        self.assertEqual(cas.compilerArtifactsSectionDir, os.path.join(compilerArtifactsRepositoryRootDir, "fd"))
+
+        # entry path
+        self.assertEqual(cas.cachedObjectName("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
+            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7", "object"))
+        self.assertEqual(cas.cacheEntryFile("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
+            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.entry"))
+
+    KEY1 = "fdde59862785f9f0ad6e661b9b5746b7"
+    KEY2 = "fd0e59862785f9f0ad6e661b9b5746b7"
+
+    def _storeEntry(self, repository, tempDir, key, content, stdout=b"", stderr=b""):
+        # A separate object file per entry, since it may be hard linked into the cache
+        objectFile = os.path.join(tempDir, key + ".obj")
+        with open(objectFile, "wb") as f:
+            f.write(content)
+        return repository.section(key).setEntry(key, CompilerArtifacts(objectFile, stdout, stderr))
+
+    def _restoreEntry(self, repository, tempDir, key, restorer=None):
+        artifacts = repository.section(key).getEntry(key)
+        restoredFile = os.path.join(tempDir, "restored.obj")
+        (restorer or ObjectFileRestorer()).restore(artifacts, restoredFile)
+        with open(restoredFile, "rb") as f:
+            return f.read(), artifacts.stdout, artifacts.stderr
+
+    def testSingleFileEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"))
+            cas = repository.section(self.KEY1)
+            self.assertFalse(cas.hasEntry(self.KEY1))
+
+            size = self._storeEntry(repository, tempDir, self.KEY1, b"object1", b"out1", b"err\xc3\xa41")
+            self.assertTrue(cas.hasEntry(self.KEY1))
+            self.assertEqual(size, os.path.getsize(cas.cacheEntryFile(self.KEY1)))
+            self.assertFalse(os.path.exists(cas.cacheEntryDir(self.KEY1)))
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY1), (b"object1", b"out1", b"err\xc3\xa41"))
+
+            self._storeEntry(repository, tempDir, self.KEY2, b"")
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY2), (b"", b"", b""))
+            self.assertEqual(sorted(cas.cacheEntries()), sorted([self.KEY1, self.KEY2]))
+
+    def testDirectoryEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"))
+            cas = repository.section(self.KEY1)
+            os.environ["CLCACHE_HARDLINK"] = "1"
+            self._storeEntry(repository, tempDir, self.KEY1, b"object1", b"out1", b"err1")
+            del os.environ["CLCACHE_HARDLINK"]
+            self._storeEntry(repository, tempDir, self.KEY2, b"object2")
+            self.assertTrue(os.path.isdir(cas.cacheEntryDir(self.KEY1)))
+
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY1), (b"object1", b"out1", b"err1"))
+            self.assertEqual(sorted(cas.cacheEntries()), sorted([self.KEY1, self.KEY2]))
+
+            repository.removeEntry(self.KEY1)
+            repository.removeEntry(self.KEY2)
+            self.assertFalse(cas.hasEntry(self.KEY1))
+            self.assertFalse(cas.hasEntry(self.KEY2))
+            self.assertEqual(cas.tombstones(), [])
+
+    def testConcurrentRemoval(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            blobStore = BlobStore(os.path.join(tempDir, "blobs"))
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), blobStore=blobStore)
+            cas = repository.section(self.KEY1)
+            self._storeEntry(repository, tempDir, self.KEY1, b"object1", b"out1")
+            os.environ["CLCACHE_HARDLINK"] = "1"
+            self._storeEntry(repository, tempDir, self.KEY2, b"object2", b"out2")
+            del os.environ["CLCACHE_HARDLINK"]
+
+            # Entries removed after a reader looked them up can't be restored
+            artifacts1 = cas.getEntry(self.KEY1)
+            artifacts2 = cas.getEntry(self.KEY2)
+            repository.removeEntry(self.KEY1)
+            repository.removeEntry(self.KEY2)
+            restorer = ObjectFileRestorer()
+            for artifacts in [artifacts1, artifacts2]:
+                with self.assertRaises(FileNotFoundError):
+                    restorer.restore(artifacts, os.path.join(tempDir, "restored.obj"))
+            for key in [self.KEY1, self.KEY2]:
+                with self.assertRaises(FileNotFoundError):
+                    cas.getEntry(key)
+
+            # Left-over tombstones are no entries and are removed by cleaning
+            tombstone = cas.cacheEntryDir(self.KEY2) + "-1" + cas.TOMBSTONE_SUFFIX
+            os.makedirs(tombstone)
+            self.assertEqual(cas.cacheEntries(), [])
+            self.assertEqual(cas.tombstones(), [tombstone])
+            self.assertEqual(repository.clean(0), (0, 0))
+            self.assertEqual(cas.tombstones(), [])
+
+    def testCompressedEntries(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"))
+            content = b"".join(b"%d" % i for i in range(10000))
+            keys = ["fd{:030x}".format(i) for i in range(len(COMPRESSION_CODECS))]
+            for key, codecName in zip(keys, sorted(COMPRESSION_CODECS)):
+                os.environ["CLCACHE_COMPRESS"] = codecName
+                size = self._storeEntry(repository, tempDir, key, content, b"out")
+                if codecName != "none":
+                    self.assertLess(size, len(content))
+
+            # Entries are restored regardless of the codec they were written with
+            os.environ["CLCACHE_COMPRESS"] = "gzip"
+            for key in keys:
+                self.assertEqual(self._restoreEntry(repository, tempDir, key), (content, b"out", b""))
+            del os.environ["CLCACHE_COMPRESS"]
+            for key in keys:
+                self.assertEqual(self._restoreEntry(repository, tempDir, key), (content, b"out", b""))
+
+    def testCompressionPolicy(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            policy = CompressionPolicy()
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), policy)
+            compressible = b"".join(b"%d" % i for i in range(10000))
+            incompressible = os.urandom(len(compressible))
+            objectFile = os.path.join(tempDir, "object.obj")
+            with open(objectFile, "wb") as f:
+                f.write(compressible)
+
+            # Nothing is compressed unless enabled
+            self.assertEqual(policy.compressionFor(objectFile), (NO_COMPRESSION_CODEC, 0))
+            self._storeEntry(repository, tempDir, self.KEY1, compressible)
+            self.assertEqual(policy.inputSize, 0)
+
+            os.environ["CLCACHE_COMPRESS"] = "gzip"
+            gzipCodec = COMPRESSION_CODECS["gzip"]
+            self.assertEqual(policy.compressionFor(objectFile), (gzipCodec, gzipCodec.defaultLevel))
+            policy.setCacheUsage(90, 100)
+            self.assertEqual(policy.compressionFor(objectFile), (gzipCodec, gzipCodec.highLevel))
+            policy.setCacheUsage(10, 100)
+
+            entries = [(self.KEY1, compressible, gzipCodec.tag),
+                       (self.KEY2, incompressible, NO_COMPRESSION_CODEC.tag),
+                       ("fd1e59862785f9f0ad6e661b9b5746b7", b"tiny", NO_COMPRESSION_CODEC.tag)]
+            for key, content, _ in entries:
+                self._storeEntry(repository, tempDir, key, content)
+            for key, content, codecTag in entries:
+                self.assertEqual(repository.section(key).getEntry(key).objectCodec, codecTag)
+                self.assertEqual(self._restoreEntry(repository, tempDir, key)[0], content)
+
+            with Statistics(temporaryFileName()) as stats:
+                policy.flushStatistics(stats)
+                self.assertGreater(stats.compressionRatio(), 0.5)
+                self.assertLess(stats.compressionRatio(), 1)
+            self.assertEqual(policy.inputSize, 0)
+
+    def testLegacyCompressedDirectoryEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"))
+            cas = repository.section(self.KEY1)
+            os.makedirs(cas.cacheEntryDir(self.KEY1))
+            with gzip.open(cas.cachedObjectName(self.KEY1), "wb") as f:
+                f.write(b"object1")
+            clcache.setCachedCompilerConsoleOutput(os.path.join(cas.cacheEntryDir(self.KEY1), "output.txt"), b"")
+
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY1), (b"object1", b"", b""))
+
+    def testCorruptEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"))
+            cas = repository.section(self.KEY1)
+            self._storeEntry(repository, tempDir, self.KEY1, b"object1")
+            with open(cas.cacheEntryFile(self.KEY1), "r+b") as f:
+                f.seek(-1, os.SEEK_END)
+                f.write(b"X")
+            # Only a buffered copy sees the contents to verify them
+            with self.assertRaises(IOError):
+                self._restoreEntry(repository, tempDir, self.KEY1, ObjectFileRestorer(methods=["copy"]))
+            self.assertFalse(os.path.exists(os.path.join(tempDir, "restored.obj")))
+
+            with open(cas.cacheEntryFile(self.KEY1), "r+b") as f:
+                f.truncate(10)
+            with self.assertRaises(ValueError):
+                cas.getEntry(self.KEY1)
+
+    def testClean(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"))
+            os.environ["CLCACHE_HARDLINK"] = "1"
+            self._storeEntry(repository, tempDir, self.KEY1, bytes(1000))
+            del os.environ["CLCACHE_HARDLINK"]
+            self._storeEntry(repository, tempDir, self.KEY2, bytes(1000))
+
+            # Both layouts are counted and evicted
+            count, size = repository.clean(1 << 20)
+            self.assertEqual(count, 1)
+            self.assertGreater(size, 0)
+            self.assertEqual(repository.clean(0), (0, 0))
+            self.assertFalse(repository.section(self.KEY1).hasEntry(self.KEY1))
+            self.assertFalse(repository.section(self.KEY2).hasEntry(self.KEY2))
+
+    def testDeduplication(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            blobStore = BlobStore(os.path.join(tempDir, "blobs"))
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), blobStore=blobStore)
+            cas = repository.section(self.KEY1)
+
+            # Object files are only deduplicated on request
+            self._storeEntry(repository, tempDir, self.KEY1, bytes(1000), b"out1")
+            self.assertFalse(os.path.exists(cas.cacheEntryObjectFile(self.KEY1)))
+            self.assertEqual(list(blobStore.blobs()), [])
+
+            os.environ["CLCACHE_DEDUP"] = "1"
+            size1 = self._storeEntry(repository, tempDir, self.KEY1, bytes(1000), b"out1")
+            size2 = self._storeEntry(repository, tempDir, self.KEY2, bytes(1000), b"out2")
+            self.assertGreater(size1, 1000)
+            self.assertLess(size2, 1000)
+            self.assertTrue(os.path.samefile(cas.cacheEntryObjectFile(self.KEY1), cas.cacheEntryObjectFile(self.KEY2)))
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY1), (bytes(1000), b"out1", b""))
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY2), (bytes(1000), b"out2", b""))
+
+            with Statistics(temporaryFileName()) as stats:
+                blobStore.flushStatistics(stats)
+                self.assertEqual(stats.deduplicationRatio(), 2)
+
+            # The blob is only removed along with the last entry using it
+            blobDir = next(childDirectories(os.path.join(tempDir, "blobs")))
+            repository.removeEntry(self.KEY1)
+            blobStore.clean()
+            self.assertEqual(len(os.listdir(blobDir)), 1)
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY2), (bytes(1000), b"out2", b""))
+            self.assertEqual(repository.clean(0), (0, 0))
+            self.assertEqual(os.listdir(blobDir), [])
+
+
+    def testIndexedClean(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            index = CacheIndex(os.path.join(tempDir, "index.sqlite"))
+            blobStore = BlobStore(os.path.join(tempDir, "blobs"))
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), blobStore=blobStore,
+                                                     index=index)
+            key3 = "fd1e59862785f9f0ad6e661b9b5746b7"
+            os.environ["CLCACHE_DEDUP"] = "1"
+            self._storeEntry(repository, tempDir, self.KEY1, bytes(1000))
+            self._storeEntry(repository, tempDir, self.KEY2, bytes(1000))
+            self._storeEntry(repository, tempDir, key3, b"object3")
+
+            # Entries written before the index existed are found by rebuilding it
+            self.assertFalse(index.isComplete())
+            index.rebuild(repository.indexEntries())
+            self.assertTrue(index.isComplete())
+            self.assertEqual(len(index.entries(CacheIndex.BLOB)), 2)
+
+            # The least recently hit entry is evicted; its blob is still in use
+            repository.section(self.KEY1).getEntry(self.KEY1)
+            count, size = repository.clean(1 << 20)
+            self.assertEqual(count, 2)
+            self.assertGreater(size, 1000)
+            self.assertEqual([key for key, _, _ in index.entries(CacheIndex.OBJECT)], [key3, self.KEY1])
+            self.assertEqual(self._restoreEntry(repository, tempDir, self.KEY1)[0], bytes(1000))
+
+            self.assertEqual(repository.clean(0), (0, 0))
+            self.assertEqual(index.entries(CacheIndex.OBJECT), [])
+            self.assertEqual(index.entries(CacheIndex.BLOB), [])
+            self.assertEqual(list(blobStore.blobs()), [])
+            index.close()
+
+    def testCostAwareClean(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            index = CacheIndex(os.path.join(tempDir, "index.sqlite"))
+            repository = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), index=index)
+            keys = ["fd{:030x}".format(i) for i in range(4)]
+
+            def storeEntry(key, compileTime):
+                objectFile = os.path.join(tempDir, key + ".obj")
+                with open(objectFile, "wb") as f:
+                    f.write(bytes(1000))
+                return repository.section(key).setEntry(key, CompilerArtifacts(objectFile, b"", b"",
+                                                                               compileTime=compileTime))
+
+            def order(evictionPolicy):
+                return [key for key, _, _ in index.entries(CacheIndex.OBJECT, evictionPolicy=evictionPolicy)]
+
+            size = storeEntry(keys[0], 10.0)
+            storeEntry(keys[1], 1.0)
+            storeEntry(keys[2], 5.0)
+            repository.section(keys[1]).getEntry(keys[1])
+
+            # Hit counts and compile times survive rebuilding the index
+            index.rebuild(repository.indexEntries())
+            self.assertEqual(order('lru'), [keys[0], keys[2], keys[1]])
+            self.assertEqual(order('lfu'), [keys[0], keys[2], keys[1]])
+            self.assertEqual(order('gdsf'), [keys[1], keys[2], keys[0]])
+
+            # The entry saving the least compile time per byte is removed,
+            # even though it was hit most recently
+            self.assertEqual(repository.clean(2.5 * size, 'gdsf'), (2, 2 * size))
+            self.assertEqual(order('gdsf'), [keys[2], keys[0]])
+
+            # New entries start out with the priority of the removed ones
+            storeEntry(keys[3], 0.5)
+            self.assertEqual(order('gdsf'), [keys[3], keys[2], keys[0]])
+            index.close()
+
+
+class TestObjectFileRestorer(unittest.TestCase):
+    KEY = "fdde59862785f9f0ad6e661b9b5746b7"
+    CONTENT = b"".join(b"%d" % i for i in range(100000))
+
+    def tearDown(self):
+        os.environ.pop("CLCACHE_HARDLINK", None)
+
+    def _entry(self, tempDir):
+        objectFile = os.path.join(tempDir, "object.obj")
+        with open(objectFile, "wb") as f:
+            f.write(TestObjectFileRestorer.CONTENT)
+        entryFile = os.path.join(tempDir, "entry")
+        with open(entryFile, "wb") as f:
+            writeCacheEntry(f, TestObjectFileRestorer.KEY, CompilerArtifacts(objectFile, b"out", b""))
+        with open(entryFile, "rb") as f:
+            return readCacheEntry(f, entryFile, TestObjectFileRestorer.KEY)
+
+    def _assertRestored(self, path):
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), TestObjectFileRestorer.CONTENT)
+
+    def testMethods(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            artifacts = self._entry(tempDir)
+            restoredFile = os.path.join(tempDir, "restored.obj")
+            for method in ObjectFileRestorer.RESTORE_METHODS:
+                restorer = ObjectFileRestorer(methods=[method, "copy"])
+                restorer.restore(artifacts, restoredFile)
+                self._assertRestored(restoredFile)
+                self.assertGreater(restorer.numSyscalls, 0)
+                # Hard links can't point into a cache entry
+                self.assertFalse(os.path.samefile(restoredFile, artifacts.objectFilePath))
+
+    def testHardLinkDirectoryEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cachedFile = os.path.join(tempDir, "object")
+            with open(cachedFile, "wb") as f:
+                f.write(TestObjectFileRestorer.CONTENT)
+            restoredFile = os.path.join(tempDir, "restored.obj")
+            restorer = ObjectFileRestorer(methods=["link", "copy"])
+
+            restorer.restore(CompilerArtifacts(cachedFile, b"", b""), restoredFile)
+            self.assertFalse(os.path.samefile(restoredFile, cachedFile))
+
+            os.environ["CLCACHE_HARDLINK"] = "1"
+            restorer.restore(CompilerArtifacts(cachedFile, b"", b""), restoredFile)
+            self.assertTrue(os.path.samefile(restoredFile, cachedFile))
+            self.assertEqual(restorer.numBytesCopied, len(TestObjectFileRestorer.CONTENT))
+
+    def testUnsupportedMethodRemembered(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            artifacts = self._entry(tempDir)
+            restoredFile = os.path.join(tempDir, "restored.obj")
+            statePath = os.path.join(tempDir, "unsupported.txt")
+
+            def unsupported(*_):
+                raise OSError(errno.EOPNOTSUPP, "operation not supported")
+
+            restorer = ObjectFileRestorer(statePath, methods=["sendfile", "copy"])
+            restorer._restoreFunctions["sendfile"] = unsupported # pylint: disable=protected-access
+            restorer.restore(artifacts, restoredFile)
+            self._assertRestored(restoredFile)
+            self.assertEqual(restorer.unsupportedMethods(), {"sendfile"})
+
+            # Other instances skip the method right away
+            restorer = ObjectFileRestorer(statePath, methods=["sendfile", "copy"])
+            restorer.restore(artifacts, restoredFile)
+            self._assertRestored(restoredFile)
+            self.assertEqual(restorer.numBytesCopied, len(TestObjectFileRestorer.CONTENT))
+
+    def testFallbackNotRemembered(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            artifacts = self._entry(tempDir)
+            restoredFile = os.path.join(tempDir, "restored.obj")
+            statePath = os.path.join(tempDir, "unsupported.txt")
+
+            def crossDevice(*_):
+                raise OSError(errno.EXDEV, "cross-device copy")
+
+            restorer = ObjectFileRestorer(statePath, methods=["sendfile", "copy"])
+            restorer._restoreFunctions["sendfile"] = crossDevice # pylint: disable=protected-access
+            restorer.restore(artifacts, restoredFile)
+            self._assertRestored(restoredFile)
+            self.assertEqual(restorer.lastMethod, "copy")
+            # The method is tried again for the next object file
+            self.assertEqual(restorer.unsupportedMethods(), set())
+            self.assertFalse(os.path.exists(statePath))
+
+    def testErrorsPropagate(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            artifacts = self._entry(tempDir)
+            restoredFile = os.path.join(tempDir, "restored.obj")
+
+            def failing(*_):
+                raise OSError(errno.EIO, "I/O error")
+
+            restorer = ObjectFileRestorer(methods=["sendfile", "copy"])
+            restorer._restoreFunctions["sendfile"] = failing # pylint: disable=protected-access
+            with self.assertRaises(OSError):
+                restorer.restore(artifacts, restoredFile)
+            self.assertEqual(restorer.unsupportedMethods(), set())
+
+
+class TestPackedCompilerArtifactsRepository(unittest.TestCase):
+    KEYS = ["fd{:030x}".format(i) for i in range(100)]
+
+    def _storeEntry(self, repository, tempDir, key, content, stdout=b"", stderr=b""):
+        objectFile = os.path.join(tempDir, "object.obj")
+        with open(objectFile, "wb") as f:
+            f.write(content)
+        return repository.section(key).setEntry(key, CompilerArtifacts(objectFile, stdout, stderr))
+
+    def _restoreEntry(self, repository, tempDir, key):
+        artifacts = repository.section(key).getEntry(key)
+        restoredFile = os.path.join(tempDir, "restored.obj")
+        ObjectFileRestorer().restore(artifacts, restoredFile)
+        with open(restoredFile, "rb") as f:
+            return f.read(), artifacts.stdout, artifacts.stderr
+
+    def testStoreAndGetEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = PackedCompilerArtifactsRepository(os.path.join(tempDir, "packs"))
+            key1, key2 = TestPackedCompilerArtifactsRepository.KEYS[:2]
+            self.assertFalse(repository.section(key1).hasEntry(key1))
+
+            self._storeEntry(repository, tempDir, key1, b"object1", b"out1", b"err1")
+            self._storeEntry(repository, tempDir, key2, b"object2")
+
+            self.assertTrue(repository.section(key1).hasEntry(key1))
+            self.assertEqual(self._restoreEntry(repository, tempDir, key1), (b"object1", b"out1", b"err1"))
+            self.assertEqual(self._restoreEntry(repository, tempDir, key2), (b"object2", b"", b""))
+            # Both entries share a single pack file
+            self.assertEqual(repository.section(key1).packNumbers(), [0])
+
+    def testIndexGrows(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = PackedCompilerArtifactsRepository(os.path.join(tempDir, "packs"))
+            for i, key in enumerate(TestPackedCompilerArtifactsRepository.KEYS):
+                self._storeEntry(repository, tempDir, key, str(i).encode())
+            for i, key in enumerate(TestPackedCompilerArtifactsRepository.KEYS):
+                self.assertEqual(self._restoreEntry(repository, tempDir, key)[0], str(i).encode())
+
+    def testIncompleteRecordIgnored(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = PackedCompilerArtifactsRepository(os.path.join(tempDir, "packs"))
+            key1, key2 = TestPackedCompilerArtifactsRepository.KEYS[:2]
+            self._storeEntry(repository, tempDir, key1, b"object1")
+            # Simulate a process which died while appending a record
+            with open(repository.section(key1).packPath(0), "ab") as f:
+                f.write(b"CLCE garbage")
+
+            self._storeEntry(repository, tempDir, key2, b"object2")
+            self.assertEqual(self._restoreEntry(repository, tempDir, key1)[0], b"object1")
+            self.assertEqual(self._restoreEntry(repository, tempDir, key2)[0], b"object2")
+
+    def testRemoveEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = PackedCompilerArtifactsRepository(os.path.join(tempDir, "packs"))
+            key1, key2 = TestPackedCompilerArtifactsRepository.KEYS[:2]
+            self._storeEntry(repository, tempDir, key1, b"object1")
+            self._storeEntry(repository, tempDir, key2, b"object2")
+
+            repository.removeEntry(key1)
+            self.assertFalse(repository.section(key1).hasEntry(key1))
+            with self.assertRaises(FileNotFoundError):
+                repository.section(key1).getEntry(key1)
+            self.assertEqual(self._restoreEntry(repository, tempDir, key2)[0], b"object2")
+
+    def testClean(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = PackedCompilerArtifactsRepository(os.path.join(tempDir, "packs"))
+            keys = TestPackedCompilerArtifactsRepository.KEYS[:10]
+            entrySize = 0
+            for key in keys:
+                entrySize = self._storeEntry(repository, tempDir, key, bytes(1000))
+
+            # The least recently used entries are evicted
+            count, size = repository.clean(3 * entrySize + 1)
+            self.assertEqual(count, 3)
+            self.assertEqual(size, 3 * entrySize)
+            section = repository.section(keys[0])
+            self.assertEqual(sorted(section.cacheEntries()), sorted(keys[-3:]))
+            # The pack file is compacted separately
+            self.assertEqual(os.path.getsize(section.packPath(0)), 10 * entrySize)
+            repository.compact()
+            self.assertEqual(os.path.getsize(section.packPath(section.packNumbers()[0])), 3 * entrySize)
+            for key in keys[-3:]:
+                self.assertEqual(self._restoreEntry(repository, tempDir, key)[0], bytes(1000))
+
+            self.assertEqual(repository.clean(0), (0, 0))
+            self.assertEqual(section.packNumbers(), [])
+
+    def testEvict(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = PackedCompilerArtifactsRepository(os.path.join(tempDir, "packs"))
+            keys = TestPackedCompilerArtifactsRepository.KEYS[:10]
+            entrySize = 0
+            for key in keys:
+                entrySize = self._storeEntry(repository, tempDir, key, bytes(1000))
+
+            # Removes the same entries as clean(), in several batches
+            self.assertEqual(repository.evict(3 * entrySize + 1, 2), (3, 3 * entrySize))
+            section = repository.section(keys[0])
+            self.assertEqual(sorted(section.cacheEntries()), sorted(keys[-3:]))
+            self.assertEqual(os.path.getsize(section.packPath(0)), 10 * entrySize)
+            self.assertEqual(repository.evict(3 * entrySize + 1, 2), (3, 3 * entrySize))
+
+
+class TestCacheFileStrategy(unittest.TestCase):
+    def testEvict(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            strategy = clcache.CacheFileStrategy(os.path.join(tempDir, "cache"))
+            keys = ["fd{:030x}".format(i) for i in range(10)]
+            for i, key in enumerate(keys):
+                objectFile = os.path.join(tempDir, "{}.obj".format(i))
+                with open(objectFile, "wb") as f:
+                    f.write(os.urandom(1000))
+                strategy.setEntry(key, CompilerArtifacts(objectFile, b"", b""))
+
+            # The index is built first
+            strategy.evict(1 << 20)
+            self.assertTrue(strategy.index.isComplete())
+            self.assertTrue(all(strategy.hasEntry(key) for key in keys))
+
+            # The least recently hit entries are evicted
+            strategy.getEntry(keys[0])
+            strategy.evict(5000)
+            remainingKeys = [key for key in keys if strategy.hasEntry(key)]
+            self.assertGreater(len(remainingKeys), 1)
+            self.assertEqual(remainingKeys, [keys[0]] + keys[len(keys) - len(remainingKeys) + 1:])
+            with strategy.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), len(remainingKeys))
+                self.assertLess(stats.currentCacheSize(), 5000 * clcache.CLEAN_LOW_WATERMARK)
+
+            strategy.evict(0)
+            self.assertFalse(any(strategy.hasEntry(key) for key in keys))
+            strategy.index.close()
+
+    def testEvictPackFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            strategy = clcache.CachePackFileStrategy(os.path.join(tempDir, "cache"))
+            keys = ["fd{:030x}".format(i) for i in range(10)]
+            entrySize = 0
+            for i, key in enumerate(keys):
+                objectFile = os.path.join(tempDir, "{}.obj".format(i))
+                with open(objectFile, "wb") as f:
+                    f.write(os.urandom(1000))
+                entrySize = strategy.setEntry(key, CompilerArtifacts(objectFile, b"", b""))
+
+            # The least recently used entries are evicted, and the pack file is compacted
+            strategy.evict(5 * entrySize)
+            remainingKeys = [key for key in keys if strategy.hasEntry(key)]
+            self.assertEqual(remainingKeys, keys[len(keys) - len(remainingKeys):])
+            section = strategy.compilerArtifactsRepository.section(keys[0])
+            self.assertEqual(sum(os.path.getsize(section.packPath(packNumber)) for packNumber in section.packNumbers()),
+                             len(remainingKeys) * entrySize)
+            with strategy.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), len(remainingKeys))
+                self.assertEqual(stats.currentCacheSize(), len(remainingKeys) * entrySize)
+
+            strategy.evict(0)
+            self.assertFalse(any(strategy.hasEntry(key) for key in keys))
+            self.assertEqual(section.packNumbers(), [])
+            strategy.index.close()
+
+    def testRebuildIndexKeepsNewEntries(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            strategy = clcache.CacheFileStrategy(os.path.join(tempDir, "cache"))
+            keys = ["fd{:030x}".format(i) for i in range(2)]
+            for i, key in enumerate(keys):
+                objectFile = os.path.join(tempDir, "{}.obj".format(i))
+                with open(objectFile, "wb") as f:
+                    f.write(os.urandom(1000))
+                strategy.setEntry(key, CompilerArtifacts(objectFile, b"", b""))
+            strategy.rebuildIndex()
+
+            # An entry stored while the cache was walked is kept, even though
+            # the walk missed it
+            indexedEntries = strategy.index.entries(CacheIndex.OBJECT)
+            entries = [entry for entry in strategy.compilerArtifactsRepository.indexEntries() if entry[1] != keys[1]]
+            strategy.index.rebuild(entries, since=0)
+            self.assertEqual(strategy.index.entries(CacheIndex.OBJECT), indexedEntries)
+            strategy.index.rebuild(entries)
+            self.assertEqual([key for key, _, _ in strategy.index.entries(CacheIndex.OBJECT)], [keys[0]])
+            strategy.index.close()
+
+    @unittest.skipUnless(os.name == "nt", "compiler output is encoded using the 'mbcs' codec")
+    def testLockTimeoutWhileStoring(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "input.obj")
+            with open(objectFile, "wb") as f:
+                f.write(b"object")
+            key = "fd{:030x}".format(1)
+            os.environ["CLCACHE_OBJECT_CACHE_TIMEOUT_MS"] = "100"
+            try:
+                cache = clcache.Cache(os.path.join(tempDir, "cache"))
+
+                # The compiler result is passed on without storing it while
+                # the cache can't be locked
+                with concurrent.futures.ThreadPoolExecutor(1) as executor, cache.maintenanceLock.exclusive():
+                    result = executor.submit(clcache.ensureArtifactsExist, cache, key, Statistics.registerCacheMiss,
+                                             objectFile, (0, "out", "")).result(timeout=5)
+                self.assertEqual(result, (0, b"out", b"", False))
+                self.assertFalse(cache.hasEntry(key))
+                cache.strategy.index.close()
+            finally:
+                del os.environ["CLCACHE_OBJECT_CACHE_TIMEOUT_MS"]
+
+    def testClaimEviction(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            strategy = clcache.CacheFileStrategy(os.path.join(tempDir, "cache"))
+            self.assertTrue(strategy.claimEviction())
+            self.assertFalse(strategy.claimEviction())
+
+            # Once the interval passed, eviction is started again unless
+            # another process is still evicting entries
+            past = os.path.getmtime(strategy.evictionMarker) - clcache.MIN_EVICTION_INTERVAL
+            os.utime(strategy.evictionMarker, (past, past))
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                with strategy.evictionLock:
+                    self.assertFalse(executor.submit(strategy.claimEviction).result(timeout=5))
+                self.assertTrue(executor.submit(strategy.claimEviction).result(timeout=5))
+            strategy.index.close()
+
+    def testLockFreeHit(self):
+        for strategyClass in [clcache.CacheFileStrategy, clcache.CachePackFileStrategy]:
+            with tempfile.TemporaryDirectory() as tempDir:
+                cache = clcache.Cache(os.path.join(tempDir, "cache"))
+                cache.strategy = strategyClass(os.path.join(tempDir, "cache"))
+                key = "fd{:030x}".format(1)
+                objectFile = os.path.join(tempDir, "input.obj")
+                with open(objectFile, "wb") as f:
+                    f.write(b"object")
+                cache.setEntry(key, CompilerArtifacts(objectFile, b"out", b""))
+                restoredFile = os.path.join(tempDir, "restored.obj")
+
+                # Hits are served while another thread holds the lock of the section
+                with cache.lockFor(key), concurrent.futures.ThreadPoolExecutor(1) as executor:
+                    hit = executor.submit(clcache.processCacheHit, cache, restoredFile, key)
+                    self.assertEqual(hit.result(timeout=5), (0, b"out", b"", False))
+                with open(restoredFile, "rb") as f:
+                    self.assertEqual(f.read(), b"object")
+
+                # An entry evicted before it was read is a miss
+                cache.strategy.compilerArtifactsRepository.removeEntry(key)
+                self.assertIsNone(clcache.processCacheHit(cache, restoredFile, key))
+                with cache.statistics as stats:
+                    self.assertEqual(stats.numCacheHits(), 1)
+                cache.strategy.index.close()
+
+    def testLockFreeManifestHit(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            includeFile = os.path.join(tempDir, "a.h")
+            with open(includeFile, "w") as f:
+                f.write("int a;\n")
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            entry = clcache.createManifestEntry(manifestHash, [includeFile])
+            cache.setManifest(manifestHash, Manifest([entry]))
+
+            # Manifests are read while another thread holds the lock of the section
+            with cache.manifestLockFor(manifestHash), concurrent.futures.ThreadPoolExecutor(1) as executor:
+                lookUp = executor.submit(clcache.lookUpManifest, cache, manifestHash)
+                self.assertEqual(lookUp.result(timeout=5)[0], entry.objectHash)
+            cache.strategy.index.close()
+
+    def testLoggedHits(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            strategy = clcache.CacheFileStrategy(os.path.join(tempDir, "cache"))
+            keys = ["fd{:030x}".format(i) for i in range(3)]
+            for i, key in enumerate(keys):
+                objectFile = os.path.join(tempDir, "{}.obj".format(i))
+                with open(objectFile, "wb") as f:
+                    f.write(os.urandom(1000))
+                strategy.setEntry(key, CompilerArtifacts(objectFile, b"", b""))
+            strategy.rebuildIndex()
+
+            def order():
+                return [key for key, _, _ in strategy.index.entries(CacheIndex.OBJECT)]
+
+            # Hits are only applied to the index before entries are evicted
+            strategy.getEntry(keys[0])
+            strategy.getEntry(keys[1])
+            strategy.getEntry(keys[0])
+            self.assertEqual(order(), keys)
+            strategy.index.applyHits()
+            self.assertEqual(order(), [keys[2], keys[1], keys[0]])
+            self.assertEqual(order(), [key for key, _, _ in strategy.index.entries(CacheIndex.OBJECT,
+                                                                                    evictionPolicy='lfu')])
+
+            # Later hits go to a new log
+            strategy.getEntry(keys[2])
+            strategy.index.applyHits()
+            self.assertEqual(order(), [keys[1], keys[0], keys[2]])
+            strategy.index.close()
+
+    def testCleanWhileStoring(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = os.path.join(tempDir, "cache")
+            cache = clcache.Cache(cacheDir)
+            keys = ["fd{:030x}".format(i) for i in range(10)]
+            for i, key in enumerate(keys):
+                objectFile = os.path.join(tempDir, "{}.obj".format(i))
+                with open(objectFile, "wb") as f:
+                    f.write(os.urandom(1000))
+                with cache.statistics as stats:
+                    clcache.addObjectToCache(stats, cache, key, CompilerArtifacts(objectFile, b"", b""))
+            cache.strategy.rebuildIndex()
+
+            def clear():
+                otherCache = clcache.Cache(cacheDir)
+                otherCache.clean(0)
+                otherCache.strategy.index.close()
+
+            # Cleaning needs neither the locks of all sections nor exclusive
+            # access to the cache while another thread stores an entry
+            with cache.maintenanceLock.shared(), cache.lockFor("00{:030x}".format(0)), \
+                 concurrent.futures.ThreadPoolExecutor(1) as executor:
+                executor.submit(clear).result(timeout=5)
+            self.assertFalse(any(cache.hasEntry(key) for key in keys))
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 0)
+            cache.strategy.index.close()
+
+
+class TestEvictionSimulation(unittest.TestCase):
+    def testPolicies(self):
+        trace = simulation.syntheticTrace(5000, 1000)
+        maximumSize = sum(size for _, size, _ in set(trace)) // 5
+        results = {evictionPolicy: simulation.simulate(trace, maximumSize, evictionPolicy)
+                   for evictionPolicy in EVICTION_POLICIES}
+        for result in results.values():
+            self.assertEqual(result.hits + result.misses, len(trace))
+            self.assertGreater(result.hits, 0)
+        self.assertGreater(results['gdsf'].timeSaved, results['lru'].timeSaved)
+
+
+if __name__ == '__main__':
+    unittest.TestCase.longMessage = True
+    unittest.main()
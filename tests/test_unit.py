@@ -10,6 +10,8 @@
 # pylint: disable=no-self-use
 #
 from contextlib import contextmanager
+import concurrent.futures
+import json
 import multiprocessing
 import os
 import unittest
@@ -18,23 +20,55 @@ import shutil
 
 from clcache import __main__ as clcache
 
-from clcache.__main__ import (
-    CommandLineAnalyzer,
-    CompilerArtifactsRepository,
-    Configuration,
-    Manifest,
-    ManifestEntry,
-    ManifestRepository,
-    Statistics,
+from clcache.__main__ import CompilerArtifactsRepository
+from clcache.utils import (
+    basenameWithoutExtension,
+    EVICTION_POLICIES,
+    filesBeneath,
+    LogicException,
+    normalizeBaseDir,
 )
-from clcache.__main__ import (
+from clcache.compression import (
+    COMPRESSION_CODECS,
+    compressionCodec,
+    NO_COMPRESSION_CODEC,
+)
+from clcache.cmdline import (
     AnalysisError,
+    ArgumentT1,
+    ArgumentT2,
+    ArgumentT3,
+    ArgumentT4,
     CalledForLinkError,
     CalledForPreprocessingError,
+    CommandLineAnalyzer,
+    expandCommandLine,
+    extendCommandLineFromEnvironment,
     InvalidArgumentError,
     MultipleSourceFilesComplexError,
     NoSourceFileError,
+    splitCommandsFile,
+)
+from clcache.hashing import (
+    FileHashCache,
+    getFileHash,
+    getFileHashes,
+    getStringHash,
+    HASH_CHUNK_SIZE,
+    hashAlgorithmName,
+)
+from clcache.statistics import (
+    Configuration,
     PersistentJSONDict,
+    Statistics,
+)
+from clcache.entries import CompilerArtifacts
+from clcache.manifest import (
+    IncludeHashes,
+    IncludePathTable,
+    Manifest,
+    ManifestEntry,
+    MAX_MANIFEST_HASHES,
 )
 from clcache.storage import CacheMemcacheStrategy
 
@@ -58,50 +92,58 @@ def temporaryFileName():
 
 class TestHelperFunctions(unittest.TestCase):
     def testBasenameWithoutExtension(self):
-        self.assertEqual(clcache.basenameWithoutExtension(r"README.asciidoc"), "README")
-        self.assertEqual(clcache.basenameWithoutExtension(r"/home/user/README.asciidoc"), "README")
-        self.assertEqual(clcache.basenameWithoutExtension(r"C:\Project\README.asciidoc"), "README")
+        self.assertEqual(basenameWithoutExtension(r"README.asciidoc"), "README")
+        self.assertEqual(basenameWithoutExtension(r"/home/user/README.asciidoc"), "README")
+        self.assertEqual(basenameWithoutExtension(r"C:\Project\README.asciidoc"), "README")
 
-        self.assertEqual(clcache.basenameWithoutExtension(r"READ ME.asciidoc"), "READ ME")
-        self.assertEqual(clcache.basenameWithoutExtension(r"/home/user/READ ME.asciidoc"), "READ ME")
-        self.assertEqual(clcache.basenameWithoutExtension(r"C:\Project\READ ME.asciidoc"), "READ ME")
+        self.assertEqual(basenameWithoutExtension(r"READ ME.asciidoc"), "READ ME")
+        self.assertEqual(basenameWithoutExtension(r"/home/user/READ ME.asciidoc"), "READ ME")
+        self.assertEqual(basenameWithoutExtension(r"C:\Project\READ ME.asciidoc"), "READ ME")
 
-        self.assertEqual(clcache.basenameWithoutExtension(r"README.asciidoc.tmp"), "README.asciidoc")
-        self.assertEqual(clcache.basenameWithoutExtension(r"/home/user/README.asciidoc.tmp"), "README.asciidoc")
-        self.assertEqual(clcache.basenameWithoutExtension(r"C:\Project\README.asciidoc.tmp"), "README.asciidoc")
+        self.assertEqual(basenameWithoutExtension(r"README.asciidoc.tmp"), "README.asciidoc")
+        self.assertEqual(basenameWithoutExtension(r"/home/user/README.asciidoc.tmp"), "README.asciidoc")
+        self.assertEqual(basenameWithoutExtension(r"C:\Project\README.asciidoc.tmp"), "README.asciidoc")
 
     def testNormalizeBaseDir(self):
-        self.assertIsNone(clcache.normalizeBaseDir(None))
-        self.assertIsNone(clcache.normalizeBaseDir(r""))
+        self.assertIsNone(normalizeBaseDir(None))
+        self.assertIsNone(normalizeBaseDir(r""))
 
         # Note: raw string literals cannot end in an odd number of backslashes
         # https://docs.python.org/3/faq/design.html#why-can-t-raw-strings-r-strings-end-with-a-backslash
         # So we consistenly use basic literals
-        self.assertEqual(clcache.normalizeBaseDir("c:"), "c:")
-        self.assertEqual(clcache.normalizeBaseDir("c:\\projects"), "c:\\projects")
+        self.assertEqual(normalizeBaseDir("c:"), "c:")
+        self.assertEqual(normalizeBaseDir("c:\\projects"), "c:\\projects")
+
+        self.assertEqual(normalizeBaseDir("C:\\"), "c:")
+        self.assertEqual(normalizeBaseDir("C:\\Projects\\"), "c:\\projects")
 
-        self.assertEqual(clcache.normalizeBaseDir("C:\\"), "c:")
-        self.assertEqual(clcache.normalizeBaseDir("C:\\Projects\\"), "c:\\projects")
+        self.assertEqual(normalizeBaseDir("c:\\projects with space"), "c:\\projects with space")
+        self.assertEqual(normalizeBaseDir("c:\\projects with ö"), "c:\\projects with ö")
 
-        self.assertEqual(clcache.normalizeBaseDir("c:\\projects with space"), "c:\\projects with space")
-        self.assertEqual(clcache.normalizeBaseDir("c:\\projects with ö"), "c:\\projects with ö")
+    def testClConsoleOutput(self):
+        # ASCII output is passed through without decoding
+        output = b"main.cpp\r\nwarning C4100: unreferenced formal parameter\r\n"
+        self.assertIs(clcache.clConsoleOutput(output), output)
+        self.assertEqual(clcache.clConsoleOutput(b""), b"")
+        self.assertEqual(clcache.clConsoleOutput(clcache.storedConsoleOutput("c:\\projects with \u00f6")),
+                         "c:\\projects with \u00f6".encode(clcache.CL_DEFAULT_CODEC))
 
     def testFilesBeneathSimple(self):
         with cd(os.path.join(ASSETS_DIR, "files-beneath")):
-            files = list(clcache.filesBeneath("a"))
+            files = list(filesBeneath("a"))
             self.assertEqual(len(files), 2)
             self.assertIn(r"a\1.txt", files)
             self.assertIn(r"a\2.txt", files)
 
     def testFilesBeneathDeep(self):
         with cd(os.path.join(ASSETS_DIR, "files-beneath")):
-            files = list(clcache.filesBeneath("b"))
+            files = list(filesBeneath("b"))
             self.assertEqual(len(files), 1)
             self.assertIn(r"b\c\3.txt", files)
 
     def testFilesBeneathRecursive(self):
         with cd(os.path.join(ASSETS_DIR, "files-beneath")):
-            files = list(clcache.filesBeneath("."))
+            files = list(filesBeneath("."))
             self.assertEqual(len(files), 5)
             self.assertIn(r".\a\1.txt", files)
             self.assertIn(r".\a\2.txt", files)
@@ -112,17 +154,17 @@ class TestHelperFunctions(unittest.TestCase):
 
 class TestExtendCommandLineFromEnvironment(unittest.TestCase):
     def testEmpty(self):
-        cmdLine, env = clcache.extendCommandLineFromEnvironment([], {})
+        cmdLine, env = extendCommandLineFromEnvironment([], {})
         self.assertEqual(cmdLine, [])
         self.assertEqual(env, {})
 
     def testSimple(self):
-        cmdLine, env = clcache.extendCommandLineFromEnvironment(['/nologo'], {'USER': 'ab'})
+        cmdLine, env = extendCommandLineFromEnvironment(['/nologo'], {'USER': 'ab'})
         self.assertEqual(cmdLine, ['/nologo'])
         self.assertEqual(env, {'USER': 'ab'})
 
     def testPrepend(self):
-        cmdLine, env = clcache.extendCommandLineFromEnvironment(['/nologo'], {
+        cmdLine, env = extendCommandLineFromEnvironment(['/nologo'], {
             'USER': 'ab',
             'CL': '/MP',
         })
@@ -130,13 +172,13 @@ class TestExtendCommandLineFromEnvironment(unittest.TestCase):
         self.assertEqual(env, {'USER': 'ab'})
 
     def testPrependMultiple(self):
-        cmdLine, _ = clcache.extendCommandLineFromEnvironment(['INPUT.C'], {
+        cmdLine, _ = extendCommandLineFromEnvironment(['INPUT.C'], {
             'CL': r'/Zp2 /Ox /I\INCLUDE\MYINCLS \LIB\BINMODE.OBJ',
         })
         self.assertEqual(cmdLine, ['/Zp2', '/Ox', r'/I\INCLUDE\MYINCLS', r'\LIB\BINMODE.OBJ', 'INPUT.C'])
 
     def testAppend(self):
-        cmdLine, env = clcache.extendCommandLineFromEnvironment(['/nologo'], {
+        cmdLine, env = extendCommandLineFromEnvironment(['/nologo'], {
             'USER': 'ab',
             '_CL_': 'file.c',
         })
@@ -144,7 +186,7 @@ class TestExtendCommandLineFromEnvironment(unittest.TestCase):
         self.assertEqual(env, {'USER': 'ab'})
 
     def testAppendPrepend(self):
-        cmdLine, env = clcache.extendCommandLineFromEnvironment(['/nologo'], {
+        cmdLine, env = extendCommandLineFromEnvironment(['/nologo'], {
             'USER': 'ab',
             'CL': '/MP',
             '_CL_': 'file.c',
@@ -161,6 +203,7 @@ class TestConfiguration(unittest.TestCase):
     def testDefaults(self):
         with Configuration(temporaryFileName()) as cfg:
             self.assertGreaterEqual(cfg.maximumCacheSize(), 1024) # 1KiB
+            self.assertIn(cfg.evictionPolicy(), EVICTION_POLICIES)
 
 
 class TestStatistics(unittest.TestCase):
@@ -212,186 +255,153 @@ class TestStatistics(unittest.TestCase):
             # accumulated: headerChanged, sourceChanged, eviced, miss
             self.assertEqual(s.numCacheMisses(), 4)
 
+    def testCompression(self):
+        with Statistics(temporaryFileName()) as s:
+            self.assertIsNone(s.compressionRatio())
+            self.assertEqual(s.compressionCpuTime(), 0)
 
-class TestManifestRepository(unittest.TestCase):
-    entry1 = ManifestEntry([r'somepath\myinclude.h'],
-                           "fdde59862785f9f0ad6e661b9b5746b7",
-                           "a649723940dc975ebd17167d29a532f8")
-    entry2 = ManifestEntry([r'somepath\myinclude.h', r'moreincludes.h'],
-                           "474e7fc26a592d84dfa7416c10f036c6",
-                           "8771d7ebcf6c8bd57a3d6485f63e3a89")
-    # Size in (120, 240] bytes
-    manifest1 = Manifest([entry1])
-    # Size in (120, 240] bytes
-    manifest2 = Manifest([entry2])
-
-    def _getDirectorySize(self, dirPath):
-        def filesize(path, filename):
-            return os.stat(os.path.join(path, filename)).st_size
-
-        size = 0
-        for path, _, filenames in clcache.WALK(dirPath):
-            size += sum(filesize(path, f) for f in filenames)
-
-        return size
-
-    def testPaths(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-        ms = mm.section("fdde59862785f9f0ad6e661b9b5746b7")
-
-        self.assertEqual(ms.manifestSectionDir, os.path.join(manifestsRootDir, "fd"))
-        self.assertEqual(ms.manifestPath("fdde59862785f9f0ad6e661b9b5746b7"),
-                         os.path.join(manifestsRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.json"))
-
-    def testIncludesContentHash(self):
-        self.assertEqual(
-            ManifestRepository.getIncludesContentHashForHashes([]),
-            ManifestRepository.getIncludesContentHashForHashes([])
-        )
-
-        self.assertEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
-        )
-
-        self.assertEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"])
-        )
-
-        # Wrong number of elements
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes([]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf"])
-        )
-
-        # Wrong order
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", "f6c8bd5733"]),
-            ManifestRepository.getIncludesContentHashForHashes(["f6c8bd5733", "d88be7edbf"])
-        )
-
-        # Content in different elements
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["", "d88be7edbf"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88be7edbf", ""])
-        )
-        self.assertNotEqual(
-            ManifestRepository.getIncludesContentHashForHashes(["d88be", "7edbf"]),
-            ManifestRepository.getIncludesContentHashForHashes(["d88b", "e7edbf"])
-        )
-
-    def testStoreAndGetManifest(self):
-        with tempfile.TemporaryDirectory() as manifestsRootDir:
-            mm = ManifestRepository(manifestsRootDir)
-
-            ms1 = mm.section("8a33738d88be7edbacef48e262bbb5bc")
-            ms2 = mm.section("0623305942d216c165970948424ae7d1")
-
-            ms1.setManifest("8a33738d88be7edbacef48e262bbb5bc", TestManifestRepository.manifest1)
-            ms2.setManifest("0623305942d216c165970948424ae7d1", TestManifestRepository.manifest2)
-
-            retrieved1 = ms1.getManifest("8a33738d88be7edbacef48e262bbb5bc")
-            self.assertIsNotNone(retrieved1)
-            retrieved1Entry = retrieved1.entries()[0]
-            self.assertEqual(retrieved1Entry, TestManifestRepository.entry1)
-
-            retrieved2 = ms2.getManifest("0623305942d216c165970948424ae7d1")
-            self.assertIsNotNone(retrieved2)
-            retrieved2Entry = retrieved2.entries()[0]
-            self.assertEqual(retrieved2Entry, TestManifestRepository.entry2)
-
-    def testNonExistingManifest(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-
-        retrieved = mm.section("ffffffffffffffffffffffffffffffff").getManifest("ffffffffffffffffffffffffffffffff")
-        self.assertIsNone(retrieved)
-
-    def testBrokenManifest(self):
-        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
-        mm = ManifestRepository(manifestsRootDir)
-
-        retrieved = mm.section("brokenmanifest").getManifest("brokenmanifest")
-        self.assertIsNone(retrieved)
-
-    def testClean(self):
-        with tempfile.TemporaryDirectory() as manifestsRootDir:
-            mm = ManifestRepository(manifestsRootDir)
-
-            mm.section("8a33738d88be7edbacef48e262bbb5bc").setManifest("8a33738d88be7edbacef48e262bbb5bc",
-                                                                       TestManifestRepository.manifest1)
-            mm.section("0623305942d216c165970948424ae7d1").setManifest("0623305942d216c165970948424ae7d1",
-                                                                       TestManifestRepository.manifest2)
-
-            cleaningResultSize = mm.clean(240)
-            # Only one of those manifests can be left
-            self.assertLessEqual(cleaningResultSize, 240)
-            self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 240)
-
-            cleaningResultSize = mm.clean(240)
-            # The one remaining is remains alive
-            self.assertLessEqual(cleaningResultSize, 240)
-            self.assertGreaterEqual(cleaningResultSize, 120)
-            self.assertLessEqual(self._getDirectorySize(manifestsRootDir), 240)
-            self.assertGreaterEqual(self._getDirectorySize(manifestsRootDir), 120)
-
-            cleaningResultSize = mm.clean(0)
-            # All manifest are gone
-            self.assertEqual(cleaningResultSize, 0)
-            self.assertEqual(self._getDirectorySize(manifestsRootDir), 0)
-
+            s.registerCompression(1000, 250, 0.5)
+            s.registerCompression(1000, 1000, 0.25)
+            self.assertEqual(s.compressionRatio(), 0.625)
+            self.assertEqual(s.compressionCpuTime(), 0.75)
 
-class TestCompilerArtifactsRepository(unittest.TestCase):
-    def testPaths(self):
-        compilerArtifactsRepositoryRootDir = os.path.join(ASSETS_DIR, "compiler-artifacts-repository")
-        car = CompilerArtifactsRepository(compilerArtifactsRepositoryRootDir)
-        cas = car.section("fdde59862785f9f0ad6e661b9b5746b7")
+    def testDeduplication(self):
+        with Statistics(temporaryFileName()) as s:
+            self.assertIsNone(s.deduplicationRatio())
+            s.registerDeduplication(3000, 1000)
+            self.assertEqual(s.deduplicationRatio(), 3)
 
-        # section path
-        self.assertEqual(cas.compilerArtifactsSectionDir, os.path.join(compilerArtifactsRepositoryRootDir, "fd"))
+    def testJournal(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            statistics = Statistics(statsFile)
+            with statistics:
+                pass
+            with statistics.delta() as delta:
+                delta.registerCacheHit()
+                delta.registerCacheEntry(100)
+                delta.registerLockWaits(os.path.join(tempDir, "a"), 1, 1.0, 1.0)
+                self.assertEqual(delta.currentCacheSize(), 100)
+            with statistics.delta() as delta:
+                delta.registerCacheHit()
+                delta.registerLockWaits(os.path.join(tempDir, "a"), 1, 2.0, 2.0)
+            # Empty deltas aren't recorded
+            with statistics.delta():
+                pass
+            self.assertEqual(len(os.listdir(os.path.join(tempDir, "stats.journal"))), 2)
+
+            # The journal is folded into the statistics file when it is read
+            with statistics as s:
+                self.assertEqual(s.numCacheHits(), 2)
+                self.assertEqual(s.numCacheEntries(), 1)
+                self.assertEqual(s.currentCacheSize(), 100)
+                self.assertEqual(s.slowestLocks(1), [("a", 2, 3.0, 2.0)])
+            self.assertEqual(os.listdir(os.path.join(tempDir, "stats.journal")), [])
+            with statistics.delta() as delta:
+                self.assertEqual(delta.currentCacheSize(), 100)
+                self.assertEqual(delta.numCacheHits(), 0)
+
+    def testJournalCompaction(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            statistics = Statistics(statsFile)
+            with statistics.delta() as delta:
+                delta.registerCacheHit()
+            # The statistics file didn't exist, so it was stale
+            self.assertEqual(os.listdir(os.path.join(tempDir, "stats.journal")), [])
+            with open(statsFile, "r") as f:
+                self.assertEqual(json.load(f)["CacheHits"], 1)
+
+    def testBatch(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            journalDir = os.path.join(tempDir, "stats.journal")
+            statistics = Statistics(statsFile)
+            with statistics:
+                pass
 
-        # entry path
-        self.assertEqual(cas.cachedObjectName("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
-            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7", "object"))
+            def job():
+                with statistics.delta() as delta:
+                    delta.registerCacheMiss()
+                    delta.registerCacheEntry(10)
+                    self.assertGreaterEqual(delta.currentCacheSize(), 10)
+
+            with statistics.batch(), concurrent.futures.ThreadPoolExecutor(4) as executor:
+                for future in [executor.submit(job) for _ in range(20)]:
+                    future.result()
+                with statistics.delta() as delta:
+                    self.assertEqual(delta.currentCacheSize(), 200)
+                self.assertFalse(os.path.exists(journalDir))
+
+            # All deltas were journaled as a single record
+            self.assertEqual(len(os.listdir(journalDir)), 1)
+            with statistics as s:
+                self.assertEqual(s.numCacheMisses(), 20)
+                self.assertEqual(s.numCacheEntries(), 20)
+                self.assertEqual(s.currentCacheSize(), 200)
+
+            # Without a batch in progress, every delta is journaled on its own
+            job()
+            job()
+            self.assertEqual(len(os.listdir(journalDir)), 2)
+
+    def testJournalRecordsFoldedOnce(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            statistics = Statistics(statsFile)
+            with statistics:
+                pass
+            with statistics.delta() as delta:
+                delta.registerCacheHit()
+            recordFile = os.path.join(tempDir, "stats.journal", os.listdir(os.path.join(tempDir, "stats.journal"))[0])
+            with open(recordFile, "r") as f:
+                record = f.read()
+            with statistics as s:
+                self.assertEqual(s.numCacheHits(), 1)
+
+            # A record which wasn't removed after it was folded is not folded again
+            with open(recordFile, "w") as f:
+                f.write(record)
+            with statistics as s:
+                self.assertEqual(s.numCacheHits(), 1)
+            self.assertFalse(os.path.exists(recordFile))
 
 
 class TestArgumentClasses(unittest.TestCase):
     def testEquality(self):
-        self.assertEqual(clcache.ArgumentT1('Fo'), clcache.ArgumentT1('Fo'))
-        self.assertEqual(clcache.ArgumentT1('W'), clcache.ArgumentT1('W'))
-        self.assertEqual(clcache.ArgumentT2('W'), clcache.ArgumentT2('W'))
-        self.assertEqual(clcache.ArgumentT3('W'), clcache.ArgumentT3('W'))
-        self.assertEqual(clcache.ArgumentT4('W'), clcache.ArgumentT4('W'))
+        self.assertEqual(ArgumentT1('Fo'), ArgumentT1('Fo'))
+        self.assertEqual(ArgumentT1('W'), ArgumentT1('W'))
+        self.assertEqual(ArgumentT2('W'), ArgumentT2('W'))
+        self.assertEqual(ArgumentT3('W'), ArgumentT3('W'))
+        self.assertEqual(ArgumentT4('W'), ArgumentT4('W'))
 
-        self.assertNotEqual(clcache.ArgumentT1('Fo'), clcache.ArgumentT1('W'))
-        self.assertNotEqual(clcache.ArgumentT1('Fo'), clcache.ArgumentT1('FO'))
+        self.assertNotEqual(ArgumentT1('Fo'), ArgumentT1('W'))
+        self.assertNotEqual(ArgumentT1('Fo'), ArgumentT1('FO'))
 
-        self.assertNotEqual(clcache.ArgumentT1('W'), clcache.ArgumentT2('W'))
-        self.assertNotEqual(clcache.ArgumentT2('W'), clcache.ArgumentT3('W'))
-        self.assertNotEqual(clcache.ArgumentT3('W'), clcache.ArgumentT4('W'))
-        self.assertNotEqual(clcache.ArgumentT4('W'), clcache.ArgumentT1('W'))
+        self.assertNotEqual(ArgumentT1('W'), ArgumentT2('W'))
+        self.assertNotEqual(ArgumentT2('W'), ArgumentT3('W'))
+        self.assertNotEqual(ArgumentT3('W'), ArgumentT4('W'))
+        self.assertNotEqual(ArgumentT4('W'), ArgumentT1('W'))
 
     def testHash(self):
-        self.assertEqual(hash(clcache.ArgumentT1('Fo')), hash(clcache.ArgumentT1('Fo')))
-        self.assertEqual(hash(clcache.ArgumentT1('W')), hash(clcache.ArgumentT1('W')))
-        self.assertEqual(hash(clcache.ArgumentT2('W')), hash(clcache.ArgumentT2('W')))
-        self.assertEqual(hash(clcache.ArgumentT3('W')), hash(clcache.ArgumentT3('W')))
-        self.assertEqual(hash(clcache.ArgumentT4('W')), hash(clcache.ArgumentT4('W')))
+        self.assertEqual(hash(ArgumentT1('Fo')), hash(ArgumentT1('Fo')))
+        self.assertEqual(hash(ArgumentT1('W')), hash(ArgumentT1('W')))
+        self.assertEqual(hash(ArgumentT2('W')), hash(ArgumentT2('W')))
+        self.assertEqual(hash(ArgumentT3('W')), hash(ArgumentT3('W')))
+        self.assertEqual(hash(ArgumentT4('W')), hash(ArgumentT4('W')))
 
-        self.assertNotEqual(hash(clcache.ArgumentT1('Fo')), hash(clcache.ArgumentT1('W')))
-        self.assertNotEqual(hash(clcache.ArgumentT1('Fo')), hash(clcache.ArgumentT1('FO')))
+        self.assertNotEqual(hash(ArgumentT1('Fo')), hash(ArgumentT1('W')))
+        self.assertNotEqual(hash(ArgumentT1('Fo')), hash(ArgumentT1('FO')))
 
-        self.assertNotEqual(hash(clcache.ArgumentT1('W')), hash(clcache.ArgumentT2('W')))
-        self.assertNotEqual(hash(clcache.ArgumentT2('W')), hash(clcache.ArgumentT3('W')))
-        self.assertNotEqual(hash(clcache.ArgumentT3('W')), hash(clcache.ArgumentT4('W')))
-        self.assertNotEqual(hash(clcache.ArgumentT4('W')), hash(clcache.ArgumentT1('W')))
+        self.assertNotEqual(hash(ArgumentT1('W')), hash(ArgumentT2('W')))
+        self.assertNotEqual(hash(ArgumentT2('W')), hash(ArgumentT3('W')))
+        self.assertNotEqual(hash(ArgumentT3('W')), hash(ArgumentT4('W')))
+        self.assertNotEqual(hash(ArgumentT4('W')), hash(ArgumentT1('W')))
 
 
 class TestSplitCommandsFile(unittest.TestCase):
     def _genericTest(self, commandLine, expected):
-        self.assertEqual(clcache.splitCommandsFile(commandLine), expected)
+        self.assertEqual(splitCommandsFile(commandLine), expected)
 
     def testEmpty(self):
         self._genericTest('', [])
@@ -465,7 +475,7 @@ class TestSplitCommandsFile(unittest.TestCase):
 class TestExpandCommandLine(unittest.TestCase):
     def _genericTest(self, commandLine, expected):
         with cd(os.path.join(ASSETS_DIR, "response-files")):
-            self.assertEqual(clcache.expandCommandLine(commandLine), expected)
+            self.assertEqual(expandCommandLine(commandLine), expected)
 
     def testNoResponseFile(self):
         self._genericTest(['-A', '-B'], ['-A', '-B'])
@@ -975,10 +985,14 @@ class TestParseIncludes(unittest.TestCase):
 class TestManifest(unittest.TestCase):
     entry1 = ManifestEntry([r'somepath\myinclude.h'],
                            "fdde59862785f9f0ad6e661b9b5746b7",
-                           "a649723940dc975ebd17167d29a532f8")
-    entry2 = ManifestEntry([r'somepath\myinclude.h', r'moreincludes.h'],
+                           "a649723940dc975ebd17167d29a532f8",
+                           ["8a33738d88be7edbacef48e262bbb5bc"],
+                           None)
+    entry2 = ManifestEntry([r'moreincludes.h', r'somepath\myinclude.h'],
                            "474e7fc26a592d84dfa7416c10f036c6",
-                           "8771d7ebcf6c8bd57a3d6485f63e3a89")
+                           "8771d7ebcf6c8bd57a3d6485f63e3a89",
+                           ["0623305942d216c165970948424ae7d1", "8a33738d88be7edbacef48e262bbb5bc"],
+                           None)
     entries = [entry1, entry2]
 
     def testCreateEmpty(self):
@@ -994,10 +1008,25 @@ class TestManifest(unittest.TestCase):
         manifest = Manifest(TestManifest.entries)
         newEntry = ManifestEntry([r'somepath\myotherinclude.h'],
                                  "474e7fc26a592d84dfa7416c10f036c6",
-                                 "8771d7ebcf6c8bd57a3d6485f63e3a89")
+                                 "8771d7ebcf6c8bd57a3d6485f63e3a89",
+                                 ["0623305942d216c165970948424ae7d1"],
+                                 None)
         manifest.addEntry(newEntry)
         self.assertEqual(newEntry, manifest.entries()[0])
 
+    def testAddEntryReplacesSameIncludes(self):
+        manifest = Manifest(TestManifest.entries)
+        newEntry = TestManifest.entry2._replace(objectHash="0623305942d216c165970948424ae7d1")
+        manifest.addEntry(newEntry)
+        self.assertEqual(manifest.entries(), [newEntry, TestManifest.entry1])
+
+    def testAddEntryLimit(self):
+        manifest = Manifest()
+        for i in range(MAX_MANIFEST_HASHES + 1):
+            manifest.addEntry(ManifestEntry([r'config.h'], str(i), str(i), [str(i)], None))
+        self.assertEqual(len(manifest.entries()), MAX_MANIFEST_HASHES)
+        self.assertEqual(manifest.entries()[0].objectHash, str(MAX_MANIFEST_HASHES))
+
 
     def testTouchEntry(self):
         manifest = Manifest(TestManifest.entries)
@@ -1005,6 +1034,136 @@ class TestManifest(unittest.TestCase):
         manifest.touchEntry("8771d7ebcf6c8bd57a3d6485f63e3a89")
         self.assertEqual(TestManifest.entry2, manifest.entries()[0])
 
+    def testTouchEntriesKeepsTree(self):
+        manifest = Manifest(TestManifest.entries)
+        tree = manifest.tree()
+        manifest.touchEntries([("8771d7ebcf6c8bd57a3d6485f63e3a89", "2222"),
+                               ("a649723940dc975ebd17167d29a532f8", None),
+                               ("8771d7ebcf6c8bd57a3d6485f63e3a89", None),
+                               ("ffffffffffffffffffffffffffffffff", None)])
+        self.assertEqual(manifest.entries(), [TestManifest.entry2._replace(statFingerprint="2222"),
+                                              TestManifest.entry1])
+        self.assertEqual(len(manifest.tree()), len(tree))
+
+        hashes = {
+            r'somepath\myinclude.h': "8a33738d88be7edbacef48e262bbb5bc",
+            r'moreincludes.h': "0623305942d216c165970948424ae7d1",
+        }
+        self.assertEqual(manifest.findEntry(hashes.get), 0)
+        del hashes[r'moreincludes.h']
+        self.assertEqual(manifest.findEntry(hashes.get), 1)
+
+    def testFindEntry(self):
+        manifest = Manifest(TestManifest.entries)
+        hashes = {
+            r'somepath\myinclude.h': "8a33738d88be7edbacef48e262bbb5bc",
+            r'moreincludes.h': "0623305942d216c165970948424ae7d1",
+        }
+        # Both entries match, the most recently used one wins
+        self.assertEqual(manifest.findEntry(hashes.get), 0)
+        self.assertEqual(Manifest(TestManifest.entries[::-1]).findEntry(hashes.get), 0)
+
+        # entry1 does not depend on moreincludes.h
+        hashes[r'moreincludes.h'] = "ffffffffffffffffffffffffffffffff"
+        self.assertEqual(manifest.findEntry(hashes.get), 0)
+        del hashes[r'moreincludes.h']
+        self.assertEqual(manifest.findEntry(hashes.get), 0)
+
+        hashes[r'somepath\myinclude.h'] = "ffffffffffffffffffffffffffffffff"
+        self.assertIsNone(manifest.findEntry(hashes.get))
+
+        self.assertIsNone(Manifest().findEntry(hashes.get))
+
+    def testFindEntryHashesIncludesOnce(self):
+        manifest = Manifest()
+        for i in range(100):
+            manifest.addEntry(ManifestEntry([r'a.h', r'config.h', r'z.h'], str(i), str(i),
+                                            ["a", "config{}".format(i), "z"], None))
+
+        hashedIncludes = []
+        def hashForInclude(includeFile):
+            hashedIncludes.append(includeFile)
+            return {r'a.h': "a", r'config.h': "config42", r'z.h': "z"}[includeFile]
+
+        entryIndex = manifest.findEntry(hashForInclude)
+        self.assertEqual(manifest.entries()[entryIndex].objectHash, "42")
+        self.assertEqual(sorted(hashedIncludes), [r'a.h', r'config.h', r'z.h'])
+
+    def testFindEntryStopsEarly(self):
+        manifest = Manifest()
+        for i in range(100):
+            manifest.addEntry(ManifestEntry([r'a.h', r'config{}.h'.format(i)], str(i), str(i),
+                                            ["a", "config"], None))
+
+        hashedIncludes = []
+        prefetchedIncludes = []
+        def hashForInclude(includeFile):
+            hashedIncludes.append(includeFile)
+            return "changed"
+
+        self.assertIsNone(manifest.findEntry(hashForInclude, prefetchedIncludes.append))
+        self.assertEqual(hashedIncludes, [r'a.h'])
+        self.assertEqual(prefetchedIncludes, [[r'a.h']])
+
+    def testBinaryRoundTrip(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            includePathTable = IncludePathTable(os.path.join(tempDir, "includepaths.txt"))
+            entry1 = TestManifest.entry1._replace(statFingerprint="0623305942d216c165970948424ae7d1")
+            manifest = Manifest([entry1, TestManifest.entry2])
+            self.assertEqual(Manifest.fromBytes(manifest.toBytes(includePathTable), includePathTable).entries(),
+                             manifest.entries())
+            self.assertEqual(Manifest.fromBytes(Manifest().toBytes(includePathTable), includePathTable).entries(),
+                             [])
+
+    def testBinaryDuplicateEntries(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            includePathTable = IncludePathTable(os.path.join(tempDir, "includepaths.txt"))
+            duplicate = TestManifest.entry1._replace(objectHash="0623305942d216c165970948424ae7d1")
+            manifest = Manifest([TestManifest.entry1, duplicate, TestManifest.entry2])
+            self.assertEqual(Manifest.fromBytes(manifest.toBytes(includePathTable), includePathTable).entries(),
+                             [TestManifest.entry1, TestManifest.entry2])
+
+    def testBinaryInvalid(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            includePathTable = IncludePathTable(os.path.join(tempDir, "includepaths.txt"))
+            data = Manifest(TestManifest.entries).toBytes(includePathTable)
+            with self.assertRaises(ValueError):
+                Manifest.fromBytes(data[:-1], includePathTable)
+            with self.assertRaises(ValueError):
+                Manifest.fromBytes(b'XXXX' + data[4:], includePathTable)
+            with self.assertRaises(ValueError):
+                Manifest.fromBytes(b'', includePathTable)
+
+            # Positions are meaningless once the include path table was compacted
+            includePathTable.startNewGeneration()
+            includePathTable.removePreviousGeneration()
+            with self.assertRaises(ValueError):
+                Manifest.fromBytes(data, includePathTable)
+
+    def testFindEntryByStat(self):
+        entry1 = TestManifest.entry1._replace(statFingerprint="1111")
+        entry2 = TestManifest.entry2._replace(statFingerprint="2222")
+        manifest = Manifest([entry1, entry2])
+
+        fingerprints = {tuple(entry2.includeFiles): "2222"}
+        self.assertEqual(manifest.findEntryByStat(lambda includeFiles: fingerprints.get(tuple(includeFiles))), 1)
+
+        fingerprints = {tuple(entry2.includeFiles): "3333"}
+        self.assertIsNone(manifest.findEntryByStat(lambda includeFiles: fingerprints.get(tuple(includeFiles))))
+
+        # Entries without fingerprint never match
+        self.assertIsNone(Manifest(TestManifest.entries).findEntryByStat(lambda includeFiles: None))
+
+    def testTouchEntryUpdatesStatFingerprint(self):
+        manifest = Manifest(TestManifest.entries)
+        manifest.touchEntry("8771d7ebcf6c8bd57a3d6485f63e3a89", "2222")
+        self.assertEqual(manifest.entries()[0], TestManifest.entry2._replace(statFingerprint="2222"))
+
+    def testFromTree(self):
+        manifest = Manifest(TestManifest.entries)
+        entryInfos = [(e.includesContentHash, e.objectHash, e.statFingerprint) for e in manifest.entries()]
+        self.assertEqual(Manifest.fromTree(manifest.tree(), entryInfos).entries(), TestManifest.entries)
+
 
 class TestCreateManifestEntry(unittest.TestCase):
     @classmethod
@@ -1016,7 +1175,7 @@ class TestCreateManifestEntry(unittest.TestCase):
             with open(filePath, 'w') as f:
                 f.write('#define {}'.format(sampleName))
 
-        cls.includePaths = list(sorted(clcache.filesBeneath(cls.tempDir.name)))
+        cls.includePaths = list(sorted(filesBeneath(cls.tempDir.name)))
         cls.manifestHash = 'ffffffffffffffffffffffffffffffff'
         cls.expectedManifestEntry = clcache.createManifestEntry(TestCreateManifestEntry.manifestHash,
                                                                 TestCreateManifestEntry.includePaths)
@@ -1045,6 +1204,232 @@ class TestCreateManifestEntry(unittest.TestCase):
         self.assertManifestEntryIsCorrect(entry)
 
 
+class TestFileHash(unittest.TestCase):
+    def testHashInChunks(self):
+        import hashlib
+
+        content = os.urandom(HASH_CHUNK_SIZE * 2 + 1)
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "large.cpp")
+            with open(path, "wb") as f:
+                f.write(content)
+
+            self.assertEqual(getFileHash(path), hashlib.md5(content).hexdigest())
+            self.assertEqual(getFileHash(path, "data"), hashlib.md5(content + b"data").hexdigest())
+
+    def testEmptyFile(self):
+        import hashlib
+
+        self.assertEqual(getFileHash(os.path.join(ASSETS_DIR, "empty_file.txt")),
+                         hashlib.md5(b"").hexdigest())
+
+
+class TestFileHashes(unittest.TestCase):
+    def tearDown(self):
+        os.environ.pop("CLCACHE_HASH_THREADS", None)
+
+    def _createFiles(self, directory, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(directory, "header{}.h".format(i))
+            with open(path, "w") as f:
+                f.write("int i{};".format(i))
+            paths.append(path)
+        return paths
+
+    def testOrderIsPreserved(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            paths = self._createFiles(tempDir, 100)
+            expectedHashes = [getFileHash(path) for path in paths]
+
+            for threadCount in ["1", "4"]:
+                os.environ["CLCACHE_HASH_THREADS"] = threadCount
+                self.assertEqual(getFileHashes(paths), expectedHashes)
+                self.assertEqual(getFileHashes(paths, FileHashCache(tempDir)), expectedHashes)
+
+    def testMissingFile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            paths = self._createFiles(tempDir, 100)
+            missingPaths = [os.path.join(tempDir, "missing{}.h".format(i)) for i in range(2)]
+
+            os.environ["CLCACHE_HASH_THREADS"] = "4"
+            with self.assertRaises(FileNotFoundError) as cm:
+                getFileHashes(paths[:50] + missingPaths + paths[50:])
+            self.assertEqual(cm.exception.filename, missingPaths[0])
+
+
+class TestHashAlgorithm(unittest.TestCase):
+    def tearDown(self):
+        os.environ.pop("CLCACHE_HASH", None)
+
+    def testDefault(self):
+        self.assertEqual(hashAlgorithmName(), "md5")
+        self.assertEqual(getStringHash("clcache"), "07ae18f1f7975010e16db5f73e07f093")
+
+    def testSelectAlgorithm(self):
+        md5Hash = getStringHash("clcache")
+        md5Key = CompilerArtifactsRepository.computeKeyDirect("ffff", "eeee")
+
+        os.environ["CLCACHE_HASH"] = "blake2b"
+        self.assertNotEqual(getStringHash("clcache"), md5Hash)
+        self.assertNotEqual(CompilerArtifactsRepository.computeKeyDirect("ffff", "eeee"), md5Key)
+
+    def testUnsupportedAlgorithm(self):
+        os.environ["CLCACHE_HASH"] = "crc32"
+        with self.assertRaises(LogicException):
+            getStringHash("clcache")
+
+
+class TestFileHashCache(unittest.TestCase):
+    def _createFile(self, directory, content, age=60):
+        path = os.path.join(directory, "header.h")
+        with open(path, "wb") as f:
+            f.write(content)
+        # Pretend the file was written a while ago, recently modified files
+        # are never recorded in the cache.
+        mtime = os.stat(path).st_mtime - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def testHitAfterFirstHash(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self._createFile(tempDir, b"int i;")
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+
+            self.assertEqual(hashCache.getFileHash(path), getFileHash(path))
+            self.assertEqual(hashCache.getFileHash(path), getFileHash(path))
+            self.assertEqual(hashCache.misses, 1)
+            self.assertEqual(hashCache.hits, 1)
+
+    def testSharedBetweenInstances(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self._createFile(tempDir, b"int i;")
+            getFileHashes([path], FileHashCache(os.path.join(tempDir, "hashes")))
+
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            self.assertEqual(getFileHashes([path], hashCache), [getFileHash(path)])
+            self.assertEqual(hashCache.hits, 1)
+            self.assertEqual(hashCache.misses, 0)
+
+    def testModifiedFileIsHashedAgain(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self._createFile(tempDir, b"int i;")
+            getFileHashes([path], FileHashCache(os.path.join(tempDir, "hashes")))
+            self._createFile(tempDir, b"int j;", age=30)
+
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            self.assertEqual(getFileHashes([path], hashCache), [getFileHash(path)])
+            self.assertEqual(hashCache.misses, 1)
+
+    def testRecentlyModifiedFileNotRecorded(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self._createFile(tempDir, b"int i;", age=0)
+            getFileHashes([path], FileHashCache(os.path.join(tempDir, "hashes")))
+
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            getFileHashes([path], hashCache)
+            self.assertEqual(hashCache.misses, 1)
+
+    def testMissingFile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            with self.assertRaises(FileNotFoundError):
+                getFileHashes([os.path.join(tempDir, "missing.h")], hashCache)
+
+    def testTrim(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            paths = [os.path.join(tempDir, "{}.h".format(i)) for i in range(4)]
+            for path in paths:
+                with open(path, "wb") as f:
+                    f.write(b"int i;")
+                mtime = os.stat(path).st_mtime - 60
+                os.utime(path, (mtime, mtime))
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            # Record every file in the same section, one after the other
+            hashCache.sectionPath = lambda _: os.path.join(tempDir, "hashes", "section.json")
+            for path in paths:
+                getFileHashes([path], hashCache)
+            os.remove(paths[3])
+
+            # Records of removed files go first, then the oldest ones
+            hashCache.trim(2)
+            getFileHashes(paths[:3], hashCache)
+            self.assertEqual(hashCache.hits, 2)
+            self.assertEqual(hashCache.misses, 4 + 1)
+
+    def testStatistics(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self._createFile(tempDir, b"int i;")
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            getFileHashes([path, path], hashCache)
+
+            with Statistics(os.path.join(tempDir, "stats.txt")) as stats:
+                hashCache.flushStatistics(stats)
+                self.assertEqual(stats.numHashCacheHits(), 1)
+                self.assertEqual(stats.numHashCacheMisses(), 1)
+
+
+class TestIncludeHashes(unittest.TestCase):
+    def testEachFileHashedOnce(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "a.h")
+            with open(path, "w") as f:
+                f.write("int a;")
+            includeHashes = IncludeHashes()
+
+            self.assertEqual(includeHashes.hashFor(path), getFileHash(path))
+            self.assertEqual(includeHashes.hashFor(path), getFileHash(path))
+            self.assertEqual(includeHashes.numComputed, 1)
+            self.assertEqual(includeHashes.numReused, 1)
+
+    def testPrefetch(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            paths = [os.path.join(tempDir, name) for name in ["a.h", "b.h"]]
+            for path in paths:
+                with open(path, "w") as f:
+                    f.write(path)
+            hashCache = FileHashCache(os.path.join(tempDir, "hashes"))
+            savedHashCaches = []
+            hashCache.save = lambda: savedHashCaches.append(hashCache)
+            includeHashes = IncludeHashes(hashCache)
+
+            includeHashes.prefetch(paths + [paths[0], os.path.join(tempDir, "missing.h")])
+            self.assertEqual(len(savedHashCaches), 1)
+            # Prefetched hashes only count once they are used
+            self.assertEqual(includeHashes.numComputed, 0)
+            self.assertEqual([includeHashes.hashFor(path) for path in paths],
+                             [getFileHash(path) for path in paths])
+            self.assertIsNone(includeHashes.hashFor(os.path.join(tempDir, "missing.h")))
+            self.assertEqual(includeHashes.numComputed, 2)
+            self.assertEqual(includeHashes.hashFor(paths[0]), getFileHash(paths[0]))
+            self.assertEqual(includeHashes.numReused, 1)
+            self.assertEqual(len(savedHashCaches), 1)
+
+    def testMissingInclude(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            includeHashes = IncludeHashes()
+            self.assertIsNone(includeHashes.hashFor(os.path.join(tempDir, "missing.h")))
+            self.assertIsNone(includeHashes.statFingerprint([os.path.join(tempDir, "missing.h")]))
+
+    def testStatFingerprint(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "a.h")
+            with open(path, "w") as f:
+                f.write("int a;")
+
+            # Recently modified files can't be identified by their modification time
+            self.assertIsNone(IncludeHashes().statFingerprint([path]))
+
+            mtime = os.stat(path).st_mtime - 60
+            os.utime(path, (mtime, mtime))
+            fingerprint = IncludeHashes().statFingerprint([path])
+            self.assertIsNotNone(fingerprint)
+            self.assertEqual(IncludeHashes().statFingerprint([path]), fingerprint)
+
+            os.utime(path, (mtime - 60, mtime - 60))
+            self.assertNotEqual(IncludeHashes().statFingerprint([path]), fingerprint)
+
+
 class TestPersistentJSONDict(unittest.TestCase):
     def testEmptyFile(self):
         emptyFile = os.path.join(ASSETS_DIR, "empty_file.txt")
@@ -1058,7 +1443,6 @@ class TestPersistentJSONDict(unittest.TestCase):
 class TestMemcacheStrategy(unittest.TestCase):
     def testSetGet(self):
         from pymemcache.test.utils import MockMemcacheClient
-        from clcache.__main__ import CompilerArtifacts, getStringHash
 
         with tempfile.TemporaryDirectory() as tempDir:
             memcache = CacheMemcacheStrategy("localhost", cacheDirectory=tempDir)
@@ -1075,7 +1459,7 @@ class TestMemcacheStrategy(unittest.TestCase):
             with open(fileName, "wb") as f:
                 f.write(b'Content')
 
-            artifact = CompilerArtifacts(fileName, "", "")
+            artifact = CompilerArtifacts(fileName, b"", b"")
 
             memcache.setEntry(key, artifact)
             self.assertEqual(memcache.hasEntry(key), True)
@@ -1083,7 +1467,7 @@ class TestMemcacheStrategy(unittest.TestCase):
             self.assertEqual(memcache.getEntry(key).stdout, artifact.stdout)
             self.assertEqual(memcache.getEntry(key).stderr, artifact.stderr)
 
-            nonArtifact = CompilerArtifacts("random.txt", "stdout", "stderr")
+            nonArtifact = CompilerArtifacts("random.txt", b"stdout", b"stderr")
             with self.assertRaises(FileNotFoundError):
                 memcache.setEntry(key, nonArtifact)
 
@@ -1127,7 +1511,7 @@ class TestCompression(unittest.TestCase):
         os.environ.clear()
 
     def assertEntrySizeIsCorrect(self, expectedSize):
-        from clcache.__main__ import copyOrLink
+        from clcache.restore import copyOrLink
 
         with cd(self.testDir):
             srcFilePath = os.path.join(self.testDir, "src")
@@ -1151,8 +1535,22 @@ class TestCompression(unittest.TestCase):
     def testNoCompression(self):
         self.assertEntrySizeIsCorrect(2887)
 
+    def testCodecSelection(self):
+        self.assertEqual(compressionCodec(), (NO_COMPRESSION_CODEC, 0))
+        os.environ["CLCACHE_COMPRESS"] = "1"
+        self.assertEqual(compressionCodec(), (COMPRESSION_CODECS["gzip"], 6))
+        os.environ["CLCACHE_COMPRESSLEVEL"] = "1"
+        self.assertEqual(compressionCodec(), (COMPRESSION_CODECS["gzip"], 1))
+        for name in ["zstd", "lz4"]:
+            os.environ["CLCACHE_COMPRESS"] = name
+            if name in COMPRESSION_CODECS:
+                self.assertEqual(compressionCodec(), (COMPRESSION_CODECS[name], 1))
+            else:
+                with self.assertRaises(LogicException):
+                    compressionCodec()
+
     def testDecompression(self):
-        from clcache.__main__ import copyOrLink
+        from clcache.restore import copyOrLink
 
         os.environ["CLCACHE_COMPRESS"] = "1"
         with cd(self.testDir):
@@ -1166,6 +1564,11 @@ class TestCompression(unittest.TestCase):
             self.assertNotEqual(os.path.getsize(srcFilePath), os.path.getsize(tmpFilePath))
             self.assertEqual(os.path.getsize(srcFilePath), os.path.getsize(dstFilePath))
 
+            # Compressed files are restored even if compression was disabled
+            del os.environ["CLCACHE_COMPRESS"]
+            copyOrLink(tmpFilePath, dstFilePath)
+            self.assertEqual(os.path.getsize(srcFilePath), os.path.getsize(dstFilePath))
+
 
 if __name__ == '__main__':
     unittest.TestCase.longMessage = True